@@ -1,9 +1,101 @@
+import time
 import asyncio
+import functools
+import logging
+import contextvars
 
-from typing import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from django.db import close_old_connections, connection
+
+import settings
+from utils.metrics import Metrics
+from utils.tracing import get_trace
+
+
+class ExecutorSaturated(Exception):
+    pass
+
+
+class DbExecutor(object):
+    """
+    пул потоков для запросов к БД. У каждого потока свое соединение,
+    поэтому размер пула ограничивает число соединений с БД.
+    Если все потоки заняты и очередь заполнена, вызов либо ждет освобождения места (policy = 'wait'),
+    либо сразу завершается ошибкой ExecutorSaturated (policy = 'reject')
+    """
+    def __init__(self, max_workers: int, max_queue: int, policy: str, reuse_connections: bool):
+        self.max_workers: int = max_workers
+        self.max_queue: int = max_queue
+        self.policy: str = policy
+        self.reuse_connections: bool = reuse_connections
+        self.executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='db')
+        # вызовы, ожидающие в очереди или выполняющиеся, всего и по имени функции
+        self.pending: int = 0
+        self.pending_by_name: Dict[str, int] = {}
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def _get_slots(self) -> asyncio.Semaphore:
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_workers + self.max_queue)
+        return self._slots
+
+    def _set_pending(self, name: str, delta: int) -> None:
+        self.pending += delta
+        self.pending_by_name[name] = self.pending_by_name.get(name, 0) + delta
+        # общая очередь - отдельной метрикой: сумма db_executor_queue_depth по func не считает ее дважды
+        Metrics().set('db_executor_queue_depth_total', self.pending)
+        Metrics().set('db_executor_queue_depth', self.pending_by_name[name], func=name)
+
+    def _run(self, name: str, submitted: float, func: Callable, *args, **kwargs) -> Any:
+        started: float = time.monotonic()
+        Metrics().observe('db_executor_wait_seconds', started - submitted, func=name)
+        trace = get_trace()
+        if trace is not None:
+            trace.add_db_hop(started - submitted)
+        if self.reuse_connections:
+            # соединение потока переиспользуется, пока не истек CONN_MAX_AGE и оно исправно
+            close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if self.reuse_connections:
+                close_old_connections()
+            else:
+                connection.close()
+            Metrics().observe('db_executor_run_seconds', time.monotonic() - started, func=name)
+
+    async def run(self, name: str, func: Callable, *args, **kwargs) -> Any:
+        slots: asyncio.Semaphore = self._get_slots()
+        if slots.locked():
+            if self.policy == 'reject':
+                Metrics().inc('db_executor_rejected_total', func=name)
+                raise ExecutorSaturated(f'db executor is saturated: {self.pending} calls pending, {name} rejected')
+            logging.warning(f'db executor is saturated: {self.pending} calls pending, {name} waits')
+
+        submitted: float = time.monotonic()
+        async with slots:
+            self._set_pending(name, 1)
+            try:
+                loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+                # контекст (в т.ч. текущий update для учета запросов) передается в поток пула
+                context: contextvars.Context = contextvars.copy_context()
+                return await loop.run_in_executor(self.executor, functools.partial(context.run, self._run, name, submitted, func, *args, **kwargs))
+            finally:
+                self._set_pending(name, -1)
+
+
+db_executor: DbExecutor = DbExecutor(
+    settings.DB_MAX_CONNECTIONS,
+    settings.DB_MAX_QUEUE,
+    settings.DB_SATURATION_POLICY,
+    settings.DB_REUSE_CONNECTIONS)
 
 def sync_to_async(func) -> Callable:
-    def wraps(*args) -> Awaitable:
-        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
-        return loop.run_in_executor(None, func, *args)
-    return wraps
\ No newline at end of file
+    name: str = func.__qualname__
+
+    @functools.wraps(func)
+    def wraps(*args, **kwargs) -> Awaitable:
+        return db_executor.run(name, func, *args, **kwargs)
+    return wraps
@@ -1,15 +1,42 @@
+import asyncio
 import logging
 import ssl
-from settings import WEBHOOK_PATH, WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_URL, WEBHOOK_CERT, WEBHOOK_KEY
+from typing import Optional
+from settings import WEBHOOK_PATH, WEBAPP_HOST, WEBAPP_PORT, WEBHOOK_URL, WEBHOOK_CERT, WEBHOOK_KEY, METRICS_PATH, MEDIA_CACHE_SIZE, \
+    MEDIA_PREWARM_CHAT, MEDIA_PREWARM_CONCURRENCY, MEDIA_PREWARM_RATE
 
-from aiogram.utils.executor import start_webhook
+from aiohttp import web
+from aiogram.utils.executor import set_webhook
 from aiogram import types
 
 from handlers.handler import bot, dp 
+from data import repository
+from utils import MediaCache, Metrics
+from telegram.sender import Sender
+from telegram.prewarm import PrewarmStats, prewarm_media
+
+# загрузка картинок в служебный чат идет в фоне и не задерживает запуск бота
+prewarm_task: Optional[asyncio.Task] = None
+
+
+async def run_prewarm() -> None:
+    try:
+        stats: PrewarmStats = await prewarm_media(bot, MEDIA_PREWARM_CHAT, MEDIA_PREWARM_CONCURRENCY, MEDIA_PREWARM_RATE)
+    except Exception:
+        logging.exception('Media prewarm failed')
+        return
+    logging.info(f'Media prewarm: uploaded {stats.uploaded}, cached {stats.cached}, failed {stats.failed} in {stats.elapsed:.1f}s; '
+                 'slowest: ' + ', '.join(f'{name} {duration * 1000:.0f}ms' for name, duration in stats.slowest()))
+
 
 async def on_startup(dp) -> None:
+    global prewarm_task
     logging.info('Starting bot...')
     logging.info(f'... at {WEBHOOK_URL}')
+    MediaCache().load(await repository.get_media_files(MEDIA_CACHE_SIZE))
+    logging.info(f'Media cache: {len(MediaCache())} file ids loaded')
+    if MEDIA_PREWARM_CHAT:
+        prewarm_task = asyncio.ensure_future(run_prewarm())
     if WEBHOOK_CERT:
         await bot.set_webhook(WEBHOOK_URL, certificate=types.InputFile(WEBHOOK_CERT))
         logging.info('Certificate was uploaded successfully.')
@@ -21,33 +48,40 @@ async def on_startup(dp) -> None:
 
 async def on_shutdown(dp) -> None:
     logging.info('Shutting down...')
+    if prewarm_task is not None and not prewarm_task.done():
+        prewarm_task.cancel()
+    await Sender().drain()
     logging.info('Delete webhook...')
     await bot.delete_webhook()
     logging.info('Webhook was deleted.')
     logging.info('The bot was disabled.')
 
 
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=Metrics().render().encode('utf-8'), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
 if __name__ == '__main__':
+    executor = set_webhook(
+        dispatcher=dp,
+        webhook_path=WEBHOOK_PATH,
+        on_startup=on_startup,
+        on_shutdown=on_shutdown,
+        skip_updates=True
+    )
+    if METRICS_PATH:
+        executor.web_app.router.add_get(METRICS_PATH, metrics_handler)
+
     if WEBHOOK_CERT and WEBHOOK_KEY:
         ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_2)
         ssl_context.load_cert_chain(WEBHOOK_CERT, WEBHOOK_KEY)    
-        start_webhook(
-            dispatcher=dp,
-            webhook_path=WEBHOOK_PATH,
-            on_startup=on_startup,
-            on_shutdown=on_shutdown,
-            skip_updates=True,
+        executor.run_app(
             host=WEBAPP_HOST,
             port=WEBAPP_PORT,
             ssl_context=ssl_context
         )
     else:
-        start_webhook(
-            dispatcher=dp,
-            webhook_path=WEBHOOK_PATH,
-            on_startup=on_startup,
-            on_shutdown=on_shutdown,
-            skip_updates=True,
+        executor.run_app(
             host=WEBAPP_HOST,
             port=WEBAPP_PORT
         )
@@ -1,44 +1,89 @@
 import asyncio
+import contextlib
 import json
 import logging
-from typing import Dict, Optional, List
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, List, Set, Tuple
 from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 
 from .states import State
 
-from data import models
+from data import models, repository
 from telegram import message
+from cluedo.registry import GameRegistry
+from utils import KeyedLock, Metrics, tracing
 from aiogram import Bot, types
 
+# сколько чатов помнит Machine.chat_rooms
+MAX_CHAT_ROOMS = 4096
+
+# номер изменения сообщений: состояния перечитывают свои сообщения, когда он меняется
+messages_generation: int = 0
+
+
+@receiver([post_save, post_delete], sender=models.Message)
+@receiver([post_save, post_delete], sender=models.LinkedMessages)
+def _messages_changed(sender, **kwargs) -> None:
+    global messages_generation
+    messages_generation += 1
+
+
 class BotState(object):
-    def __init__(self, bot: Bot) -> None:
+    """
+    состояние бота. Объекты состояний создаются один раз при старте (см. Machine)
+    и не хранят данных пользователя: все, что относится к конкретному событию,
+    передается в методы аргументами
+    """
+    linked_message_name = 'NOMESSAGE'
+    context_class = message.MessageContext
+
+    def __init__(self, bot: Bot, states: Dict[str, 'BotState']) -> None:
         self.bot = bot
-        self.linked_message_name = 'NOMESSAGE'
+        self.states: Dict[str, 'BotState'] = states
 
-        self.context: Optional[message.MessageContext] = None
+        self.linked_message: Optional[models.LinkedMessages] = None
+        self.message_list: Optional[Tuple[models.Message, ...]] = None
+        self.loaded_generation: int = -1
+
+    """
+    загружает сообщения состояния: при первом обращении и после изменения сообщений в БД
+    """
+    async def prepare(self) -> None:
+        if self.message_list is None or self.loaded_generation != messages_generation:
+            generation: int = messages_generation
+            linked_message: models.LinkedMessages = await self.get_linked_message()
+            self.message_list = await repository.get_message_list(linked_message.group)
+            self.linked_message = linked_message
+            self.loaded_generation = generation
+
+    def create_context(self, **params) -> message.MessageContext:
+        return self.context_class(self.bot, self.linked_message, self.message_list, **params)
 
     """
     возвращает новое состояние объекта в зависимости от текущего 
+    и параметры, с которыми новое состояние обрабатывает событие
     """
-    async def update_state(self, user: models.User, message_payload, message_id):
+    async def update_state(self, user: models.User, message_payload, message_id) -> Tuple['BotState', Dict]:
         raise NotImplementedError()
 
     """
     обработчик события в данном состоянии
     """
-    async def handler(self, user: models.User, message_payload: Optional[str] = None, message_id: Optional[int] = None, outcoming_flag: bool = False) -> Optional[bool]:
-        if self.context:
-            await self.context.update(user, message_payload, message_id)
-        return await self.send_and_save(user, message_payload, message_id)
+    async def handler(self, user: models.User, message_payload: Optional[str] = None, message_id: Optional[int] = None, outcoming_flag: bool = False, **params) -> Optional[bool]:
+        context: message.MessageContext = self.create_context(**params)
+        await context.update(user, message_payload, message_id)
+        return await self.send_and_save(context, user, message_payload, message_id)
 
     """
     посылает пользователю телеграм сообщение, которое определяется текущим состоянием 
     и сохраняет состояние пользователя в БД
     """
-    async def send_and_save(self, user: models.User, message_payload, message_id: Optional[int] = None) -> Optional[bool]:
+    async def send_and_save(self, context: message.MessageContext, user: models.User, message_payload, message_id: Optional[int] = None) -> Optional[bool]:
         user_substate: int = self.get_user_current_substate(user)
-        message: models.Message = self.context.get_message(user_substate)
-        await self.context.send_message(user, message, message_id)
+        message: models.Message = context.get_message(user_substate)
+        await context.send_message(user, message, message_id)
         user.last_message_id=message_id
         await user.async_save()
         return None
@@ -54,626 +99,473 @@ class BotState(object):
         return self.message_list[substate]
 
     async def get_linked_message(self) -> models.LinkedMessages:
-        return models.LinkedMessages.get_linked_message_by_name(self.linked_message_name)
+        return await repository.get_linked_message(self.linked_message_name)
 
-    async def get_rooms(self) -> 'CluedoRooms':
-        return models.CluedoRoom.get_all_rooms()
+    async def get_rooms(self) -> List[models.CluedoRoom]:
+        return await repository.get_rooms()
 
 
 
 class ExitState(BotState):
-    def __init__(self, bot: Bot) -> None:
-        self.bot = bot
+    linked_message_name = 'EXIT'
+    context_class = message.ExitContext
 
-        self.linked_message_name = 'EXIT'
-        self.context: Optional[message.MessageContext] = None
-        self._prepare_context()
+    async def prepare(self) -> None:
+        pass
 
-    def _prepare_context(self) -> None:
-        self.context: message.ExitContext = message.ExitContext(self.bot)
+    def create_context(self, **params) -> message.ExitContext:
+        return self.context_class(self.bot)
 
 class RoomsState(BotState):
-    def __init__(self, bot: Bot) -> None:
-        self.bot = bot
-
-        self.linked_message_name = 'ROOMS'
-        self.context: Optional[message.MessageContext] = None
-
-    async def set_context(self) -> None:
-        linked_message: models.LinkedMessages = await self.get_linked_message()
-        self.context = message.RoomsContext(self.bot, linked_message)
-        await self.context.init_context()    
+    linked_message_name = 'ROOMS'
+    context_class = message.RoomsContext
 
     """
     возвращает новое состояние объекта в зависимости от текущего 
     """
-    async def update_state(self, user: models.User, message_payload, message_id):
+    async def update_state(self, user: models.User, message_payload, message_id) -> Tuple[BotState, Dict]:
         if message_payload ==  'next':
             user.substate += 1
-            return self
+            return self, {}
         elif message_payload == 'prev':
             user.substate = user.substate - 1 if user.substate > 0 else 0
-            return self
+            return self, {}
         elif message_payload == 'home':
             user.substate = 0
-            return self
+            return self, {}
         elif message_payload == 'to_rules':
             user.state = 'RULES'
             user.substate = 0
-            state = RulesState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['RULES'], {}
         elif message_payload == 'to_greeting':
             user.state = 'GREETING'
             user.substate = 0
-            state = GreetingState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['GREETING'], {}
         else:
             try:
                 room = json.loads(message_payload)
                 if room.get('room', 0) > 0:
                     user.state = 'ROOM'
                     user.substate = 0
-                    user.room = models.CluedoRoom.get_room_by_id(room['room'])
-                    state = RoomState(self.bot)
-                    await state.set_context()
-                    return state
+                    user.room = await repository.get_room(room['room'])
+                    return self.states['ROOM'], {}
                 else:
                     raise ValueError
             except ValueError as e:
-                return self
+                return self, {}
 
 
 class RoomState(BotState):
-    def __init__(self, bot: Bot) -> None:
-        self.bot = bot
-
-        self.linked_message_name = 'ROOM'
-        self.context: Optional[message.MessageContext] = None
-
-    async def set_context(self) -> None:
-        linked_message: models.LinkedMessages = await self.get_linked_message()
-        self.context = message.RoomContext(self.bot, linked_message)
-        await self.context.init_context()    
-
+    linked_message_name = 'ROOM'
+    context_class = message.RoomContext
 
     """
     возвращает новое состояние объекта в зависимости от текущего 
     """
-    async def update_state(self, user: models.User, message_payload, message_id):
+    async def update_state(self, user: models.User, message_payload, message_id) -> Tuple[BotState, Dict]:
         if message_payload == 'to_rooms':
             user.state = 'ROOMS'
             user.substate = 0
             user.room = None
-            state = RoomsState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['ROOMS'], {}
         else:
             try:
                 room = json.loads(message_payload)
                 if room.get('room', 0) > 0:
-                    users = await models.User.get_all_players_are_not_ready(user)
+                    users = await repository.get_all_players_are_not_ready(user)
                     if len(users) > 0:
                         user.state = 'GAME_WAITING'
                         user.substate = 0
-                        state = GameWaitingState(self.bot)
+                        state = self.states['GAME_WAITING']
                     else:
                         user.state = 'GAME'
                         user.substate = 0
-                        state = GameState(self.bot)
+                        state = self.states['GAME']
 
-                    await state.set_context()
-                    return state
+                    return state, {}
                 else:
                     raise ValueError
             except ValueError as e:
-                return self
+                return self, {}
 
 class GameWaitingState(BotState):
-    def __init__(self, bot: Bot) -> None:
-        self.bot = bot
-
-        self.linked_message_name = 'GAME_WAITING'
-        self.context: Optional[message.MessageContext] = None
-
-    async def set_context(self) -> None:
-        linked_message: models.LinkedMessages = await self.get_linked_message()
-        self.context = message.GameWaitingContext(self.bot, linked_message)
-        await self.context.init_context()    
+    linked_message_name = 'GAME_WAITING'
+    context_class = message.GameWaitingContext
 
     """
     возвращает новое состояние объекта в зависимости от текущего 
     """
-    async def update_state(self, user: models.User, message_payload, message_id):
+    async def update_state(self, user: models.User, message_payload, message_id) -> Tuple[BotState, Dict]:
         if message_payload == 'to_room':
             user.state = 'ROOM'
             user.substate = 0
-            state = RoomState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['ROOM'], {}
         elif message_payload == 'to_game':
             user.state = 'GAME'
             user.substate = 0
-            state = GameState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['GAME'], {}
         else:
-            return self
+            return self, {}
 
 class GameState(BotState):
-    def __init__(self, bot: Bot) -> None:
-        self.bot = bot
-
-        self.linked_message_name = 'GAME'
-        self.context: Optional[message.MessageContext] = None
-
-    async def set_context(self) -> None:
-        linked_message: models.LinkedMessages = await self.get_linked_message()
-        self.context = message.GameContext(self.bot, linked_message)
-        await self.context.init_context()    
+    linked_message_name = 'GAME'
+    context_class = message.GameContext
 
     """
     возвращает новое состояние объекта в зависимости от текущего 
     """
-    async def update_state(self, user: models.User, message_payload, message_id):
+    async def update_state(self, user: models.User, message_payload, message_id) -> Tuple[BotState, Dict]:
         if message_payload == 'to_room':
             user.state = 'ROOM'
             user.substate = 0
-            state = RoomState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['ROOM'], {}
         elif message_payload == 'throw_dice':
             user.state = 'THROW_DICE'
             user.substate = user.substate
-            state = ThrowDiceState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['THROW_DICE'], {}
         elif message_payload == 'hide_state':
             user.substate = 1
-            return self
+            return self, {}
         elif message_payload == 'show_state':
             user.substate = 0
-            return self
+            return self, {}
         else:
-            return self
+            return self, {}
 
 class ThrowDiceState(BotState):
-    def __init__(self, bot: Bot) -> None:
-        self.bot = bot
-
-        self.linked_message_name = 'THROW_DICE'
-        self.context: Optional[message.MessageContext] = None
-
-    async def set_context(self) -> None:
-        linked_message: models.LinkedMessages = await self.get_linked_message()
-        self.context = message.GameContext(self.bot, linked_message)
-        await self.context.init_context()    
+    linked_message_name = 'THROW_DICE'
+    context_class = message.GameContext
 
     """
     возвращает новое состояние объекта в зависимости от текущего 
     """
-    async def update_state(self, user: models.User, message_payload, message_id):
+    async def update_state(self, user: models.User, message_payload, message_id) -> Tuple[BotState, Dict]:
         if message_payload == 'to_room':
             user.state = 'ROOM'
             user.substate = 0
-            state = RoomState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['ROOM'], {}
         elif message_payload == 'select_place':
             user.state = 'SELECT_PLACE'
             user.substate = user.substate
-            state = SelectPlaceState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['SELECT_PLACE'], {}
         elif message_payload == 'hide_state':
             user.substate = 1
-            return self
+            return self, {}
         elif message_payload == 'show_state':
             user.substate = 0
-            return self
+            return self, {}
         else:
-            return self
+            return self, {}
 
 class  GameFinishedState(BotState):
-    def __init__(self, bot: Bot, suspiction: Dict=None) -> None:
-        self.bot = bot
-
-        self.linked_message_name = 'GAME_FINISHED'
-        self.context: Optional[message.MessageContext] = None
-        self.suspiction = suspiction
-
-    async def set_context(self) -> None:
-        linked_message: models.LinkedMessages = await self.get_linked_message()
-        self.context = message.GameFinishedContext(self.bot, linked_message)
-        await self.context.init_context()    
+    linked_message_name = 'GAME_FINISHED'
+    context_class = message.GameFinishedContext
 
     """
     возвращает новое состояние объекта в зависимости от текущего 
     """
-    async def update_state(self, user: models.User, message_payload, message_id):
+    async def update_state(self, user: models.User, message_payload, message_id) -> Tuple[BotState, Dict]:
         if message_payload == 'to_greeting':
             user.state = 'GREETING'
             user.substate = 0
-            state = GreetingState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['GREETING'], {}
         else:
-            return self
+            return self, {}
 
 class  GameWonState(BotState):
-    def __init__(self, bot: Bot, suspiction: Dict=None) -> None:
-        self.bot = bot
-
-        self.linked_message_name = 'GAME_WON'
-        self.context: Optional[message.MessageContext] = None
-        self.suspiction = suspiction
-
-    async def set_context(self) -> None:
-        linked_message: models.LinkedMessages = await self.get_linked_message()
-        self.context = message.GameWonContext(self.bot, linked_message)
-        await self.context.init_context()    
+    linked_message_name = 'GAME_WON'
+    context_class = message.GameWonContext
 
     """
     возвращает новое состояние объекта в зависимости от текущего 
     """
-    async def update_state(self, user: models.User, message_payload, message_id):
+    async def update_state(self, user: models.User, message_payload, message_id) -> Tuple[BotState, Dict]:
         if message_payload == 'to_greeting':
             user.state = 'GREETING'
             user.substate = 0
-            state = GreetingState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['GREETING'], {}
         else:
-            return self
+            return self, {}
 
 class  CheckSuspictionState(BotState):
-    def __init__(self, bot: Bot, suspiction: Dict=None) -> None:
-        self.bot = bot
-
-        self.linked_message_name = 'CHECK_SUSPICTION'
-        self.context: Optional[message.MessageContext] = None
-        self.suspiction = suspiction
-
-    async def set_context(self) -> None:
-        linked_message: models.LinkedMessages = await self.get_linked_message()
-        self.context = message.GameContext(self.bot, linked_message, suspiction=self.suspiction)
-        await self.context.init_context()    
+    linked_message_name = 'CHECK_SUSPICTION'
+    context_class = message.GameContext
 
     """
     возвращает новое состояние объекта в зависимости от текущего 
     """
-    async def update_state(self, user: models.User, message_payload, message_id):
+    async def update_state(self, user: models.User, message_payload, message_id) -> Tuple[BotState, Dict]:
         if message_payload == 'to_room':
             user.state = 'ROOM'
             user.substate = 0
-            state = RoomState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['ROOM'], {}
         elif message_payload == 'throw_dice':
             user.state = 'THROW_DICE'
             user.substate = user.substate
-            state = ThrowDiceState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['THROW_DICE'], {}
         elif message_payload == 'hide_state':
             user.substate = 1
-            return self
+            return self, {}
         elif message_payload == 'show_state':
             user.substate = 0
-            return self
+            return self, {}
         else:
-            return self
+            return self, {}
 
 class  CheckAccuseState(BotState):
-    def __init__(self, bot: Bot, suspiction: Dict=None) -> None:
-        self.bot = bot
-
-        self.linked_message_name = 'CHECK_ACCUSE'
-        self.context: Optional[message.MessageContext] = None
-        self.suspiction = suspiction
-
-    async def set_context(self) -> None:
-        linked_message: models.LinkedMessages = await self.get_linked_message()
-        self.context = message.GameContext(self.bot, linked_message, suspiction=self.suspiction)
-        await self.context.init_context()    
+    linked_message_name = 'CHECK_ACCUSE'
+    context_class = message.GameContext
 
     """
     возвращает новое состояние объекта в зависимости от текущего 
     """
-    async def update_state(self, user: models.User, message_payload, message_id):
+    async def update_state(self, user: models.User, message_payload, message_id) -> Tuple[BotState, Dict]:
         if message_payload == 'to_room':
             user.state = 'ROOM'
             user.substate = 0
-            state = RoomState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['ROOM'], {}
         elif message_payload == 'throw_dice':
             user.state = 'THROW_DICE'
             user.substate = user.substate
-            state = ThrowDiceState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['THROW_DICE'], {}
         elif message_payload == 'hide_state':
             user.substate = 1
-            return self
+            return self, {}
         elif message_payload == 'show_state':
             user.substate = 0
-            return self
+            return self, {}
         else:
-            return self
+            return self, {}
 
 class  ConfirmAccuseState(BotState):
-    def __init__(self, bot: Bot, accused_weapon: int=-1) -> None:
-        self.bot = bot
-
-        self.linked_message_name = 'CONFIRM_ACCUSE'
-        self.context: Optional[message.MessageContext] = None
-        self.accused_weapon = accused_weapon
-
-    async def set_context(self) -> None:
-        linked_message: models.LinkedMessages = await self.get_linked_message()
-        self.context = message.GameContext(self.bot, linked_message, accuse_weapon=self.accused_weapon)
-        await self.context.init_context()    
+    linked_message_name = 'CONFIRM_ACCUSE'
+    context_class = message.GameContext
 
     """
     возвращает новое состояние объекта в зависимости от текущего 
     """
-    async def update_state(self, user: models.User, message_payload, message_id):
+    async def update_state(self, user: models.User, message_payload, message_id) -> Tuple[BotState, Dict]:
         if message_payload == 'to_room':
             user.state = 'ROOM'
             user.substate = 0
-            state = RoomState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['ROOM'], {}
         elif message_payload == 'hide_state':
             user.substate = 1
-            return self
+            return self, {}
         elif message_payload == 'show_state':
             user.substate = 0
-            return self
+            return self, {}
         else:
             try:
                 data = json.loads(message_payload)
                 if data.get('suspiction', None) is not None:
                     user.state = 'CHECK_SUSPICTION'
-                    state = CheckSuspictionState(self.bot, data['suspiction'])
-                    await state.set_context()
-                    return state
+                    return self.states['CHECK_SUSPICTION'], {'suspiction': data['suspiction']}
                 elif data.get('accuse', None) is not None:
                     user.state = 'CHECK_ACCUSE'
-                    state = CheckAccuseState(self.bot, data['accuse'])
-                    await state.set_context()
-                    return state
+                    return self.states['CHECK_ACCUSE'], {'suspiction': data['accuse']}
                 else:
                     raise ValueError
             except ValueError as e:
-                return self
+                return self, {}
 
 
 class  AccuseWeaponState(BotState):
-    def __init__(self, bot: Bot, accused_person: int=-1) -> None:
-        self.bot = bot
-
-        self.linked_message_name = 'ACCUSE_WEAPON'
-        self.context: Optional[message.MessageContext] = None
-        self.accused_person = accused_person
-
-    async def set_context(self) -> None:
-        linked_message: models.LinkedMessages = await self.get_linked_message()
-        self.context = message.GameContext(self.bot, linked_message, accuse_person=self.accused_person)
-        await self.context.init_context()    
+    linked_message_name = 'ACCUSE_WEAPON'
+    context_class = message.GameContext
 
     """
     возвращает новое состояние объекта в зависимости от текущего 
     """
-    async def update_state(self, user: models.User, message_payload, message_id):
+    async def update_state(self, user: models.User, message_payload, message_id) -> Tuple[BotState, Dict]:
         if message_payload == 'to_room':
             user.state = 'ROOM'
             user.substate = 0
-            state = RoomState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['ROOM'], {}
         elif message_payload == 'hide_state':
             user.substate = 1
-            return self
+            return self, {}
         elif message_payload == 'show_state':
             user.substate = 0
-            return self
+            return self, {}
         else:
             try:
                 person = json.loads(message_payload)
                 if person.get('accused_weapon', -1) >= 0:
                     user.state = 'CONFIRM_ACCUSE'
-                    state = ConfirmAccuseState(self.bot, person['accused_weapon'])
-
-                    await state.set_context()
-                    return state
+                    return self.states['CONFIRM_ACCUSE'], {'accuse_weapon': person['accused_weapon']}
                 else:
                     raise ValueError
             except ValueError as e:
-                return self
+                return self, {}
 
 class  AccusePersonState(BotState):
-    def __init__(self, bot: Bot, new_location: int = -1) -> None:
-        self.bot = bot
-
-        self.linked_message_name = 'ACCUSE_PERSON'
-        self.context: Optional[message.MessageContext] = None
-        self.location = new_location
-
-    async def set_context(self) -> None:
-        linked_message: models.LinkedMessages = await self.get_linked_message()
-        self.context = message.GameContext(self.bot, linked_message, location=self.location)
-        await self.context.init_context()    
+    linked_message_name = 'ACCUSE_PERSON'
+    context_class = message.GameContext
 
     """
     возвращает новое состояние объекта в зависимости от текущего 
     """
-    async def update_state(self, user: models.User, message_payload, message_id):
+    async def update_state(self, user: models.User, message_payload, message_id) -> Tuple[BotState, Dict]:
         if message_payload == 'to_room':
             user.state = 'ROOM'
             user.substate = 0
-            state = RoomState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['ROOM'], {}
         elif message_payload == 'hide_state':
             user.substate = 1
-            return self
+            return self, {}
         elif message_payload == 'show_state':
             user.substate = 0
-            return self
+            return self, {}
         else:
             try:
                 person = json.loads(message_payload)
                 if person.get('accused_person', -1) >= 0:
                     user.state = 'ACCUSE_WEAPON'
-                    state = AccuseWeaponState(self.bot, person['accused_person'])
-
-                    await state.set_context()
-                    return state
+                    return self.states['ACCUSE_WEAPON'], {'accuse_person': person['accused_person']}
                 else:
                     raise ValueError
             except ValueError as e:
-                return self
+                return self, {}
 
 class  SelectPlaceState(BotState):
-    def __init__(self, bot: Bot) -> None:
-        self.bot = bot
-
-        self.linked_message_name = 'SELECT_PLACE'
-        self.context: Optional[message.MessageContext] = None
-
-    async def set_context(self) -> None:
-        linked_message: models.LinkedMessages = await self.get_linked_message()
-        self.context = message.GameContext(self.bot, linked_message)
-        await self.context.init_context()    
+    linked_message_name = 'SELECT_PLACE'
+    context_class = message.GameContext
 
     """
     возвращает новое состояние объекта в зависимости от текущего 
     """
-    async def update_state(self, user: models.User, message_payload, message_id):
+    async def update_state(self, user: models.User, message_payload, message_id) -> Tuple[BotState, Dict]:
         if message_payload == 'to_room':
             user.state = 'ROOM'
             user.substate = 0
-            state = RoomState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['ROOM'], {}
         elif message_payload == 'hide_state':
             user.substate = 1
-            return self
+            return self, {}
         elif message_payload == 'show_state':
             user.substate = 0
-            return self
+            return self, {}
         else:
             try:
                 place = json.loads(message_payload)
                 if place.get('new_location', -1) >= 0:
                     user.state = 'ACCUSE_PERSON'
-                    state = AccusePersonState(self.bot, place['new_location'])
-
-                    await state.set_context()
-                    return state
+                    return self.states['ACCUSE_PERSON'], {'location': place['new_location']}
                 else:
                     raise ValueError
             except ValueError as e:
-                return self
+                return self, {}
 
 
 class RulesState(BotState):
-    def __init__(self, bot: Bot) -> None:
-        self.bot = bot
-
-        self.linked_message_name = 'RULES'
-        self.context: Optional[message.MessageContext] = None
-
-    async def set_context(self) -> None:
-        linked_message: models.LinkedMessages = await self.get_linked_message()
-        self.context = message.MessageContext(self.bot, linked_message)
-        await self.context.init_context()    
+    linked_message_name = 'RULES'
 
     """
     возвращает новое состояние объекта в зависимости от текущего 
     """
-    async def update_state(self, user: models.User, message_payload, message_id):
+    async def update_state(self, user: models.User, message_payload, message_id) -> Tuple[BotState, Dict]:
         if message_payload ==  'next':
             user.substate += 1
-            return self
+            return self, {}
         elif message_payload == 'prev':
             user.substate = user.substate - 1 if user.substate > 0 else 0
-            return self
+            return self, {}
         elif message_payload == 'home':
             user.substate = 0
-            return self
+            return self, {}
         elif message_payload == 'to_exit':
             user.state = '-'
             user.substate = 0
-            return ExitState(self.bot)
+            return self.states['EXIT'], {}
         elif message_payload == 'to_greeting':
             user.state = 'GREETING'
             user.substate = 0
-            state = GreetingState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['GREETING'], {}
         elif message_payload == 'to_rooms':
             user.state = 'ROOMS'
             user.substate = 0
-            state = RoomsState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['ROOMS'], {}
         else:
-            return self
+            return self, {}
 
 class GreetingState(BotState):
-    def __init__(self, bot: Bot) -> None:
-        self.bot = bot
-        self.linked_message_name = 'GREETING'
-        self.context: Optional[message.MessageContext] = None
-
-    async def set_context(self) -> None:
-        linked_message: models.LinkedMessages = await self.get_linked_message()
-        self.context = message.MessageContext(self.bot, linked_message)
-        await self.context.init_context()
-    
+    linked_message_name = 'GREETING'
 
     """
     возвращает новое состояние объекта в зависимости от текущего 
     """
-    async def update_state(self, user: models.User, message_payload, message_id):
+    async def update_state(self, user: models.User, message_payload, message_id) -> Tuple[BotState, Dict]:
         if message_payload ==  'next':
             user.substate += 1
-            return self
+            return self, {}
         elif message_payload == 'prev':
             user.substate = user.substate - 1 if user.substate > 0 else 0
-            return self
+            return self, {}
         elif message_payload == 'home':
             user.substate = 0
-            return self
+            return self, {}
         elif message_payload == 'to_exit':
             user.state = '-'
             user.substate = 0
-            return ExitState(self.bot)
+            return self.states['EXIT'], {}
         elif message_payload == 'to_rules':
             user.state = 'RULES'
             user.substate = 0
-            state = RulesState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['RULES'], {}
         elif message_payload == 'to_rooms':
             user.state = 'ROOMS'
             user.substate = 0
-            state = RoomsState(self.bot)
-            await state.set_context()
-            return state
+            return self.states['ROOMS'], {}
         else:
-            return self
+            return self, {}
 
 
 class Machine(object):
+    # состояния, в которых может находиться пользователь; 
+    # пользователи с любым другим состоянием (в т.ч. GAME_WON) обрабатываются как GREETING
+    STATE_CLASSES = {
+        State.GREETING.name: GreetingState,
+        State.EXIT.name: ExitState,
+        State.RULES.name: RulesState,
+        State.ROOMS.name: RoomsState,
+        State.ROOM.name: RoomState,
+        State.GAME_WAITING.name: GameWaitingState,
+        State.GAME.name: GameState,
+        State.THROW_DICE.name: ThrowDiceState,
+        State.SELECT_PLACE.name: SelectPlaceState,
+        State.ACCUSE_PERSON.name: AccusePersonState,
+        State.ACCUSE_WEAPON.name: AccuseWeaponState,
+        State.CONFIRM_ACCUSE.name: ConfirmAccuseState,
+        State.CHECK_SUSPICTION.name: CheckSuspictionState,
+        State.CHECK_ACCUSE.name: CheckAccuseState,
+        State.GAME_FINISHED.name: GameFinishedState,
+    }
+
     def __init__(self, bot: Bot, loop: asyncio.AbstractEventLoop) -> None:
         self.bot: Bot = bot
         self.event_loop: asyncio.AbstractEventLoop = loop
 
+        self.states: Dict[str, BotState] = {}
+        for name, state_class in self.STATE_CLASSES.items():
+            self.states[name] = state_class(bot, self.states)
+
+        # события одного чата и одной комнаты обрабатываются по очереди, разных комнат - параллельно
+        self.chat_locks: KeyedLock = KeyedLock()
+        self.room_locks: KeyedLock = KeyedLock()
+        # комната, в которой находится пользователь чата (по последнему обработанному событию).
+        # Хранятся только чаты пользователей в комнатах, не более MAX_CHAT_ROOMS (LRU)
+        self.chat_rooms: 'OrderedDict[int, int]' = OrderedDict()
+        # нажатия кнопок, которые ждут обработки или обрабатываются: (chat_id, message_id, data)
+        self.pending_callbacks: Set[Tuple[int, int, str]] = set()
+        Metrics().add_collector(self.collect_metrics)
+
+    def collect_metrics(self, metrics: Metrics) -> None:
+        # чаты и комнаты, события которых сейчас обрабатываются или ждут очереди
+        metrics.set('machine_active_chats', len(self.chat_locks))
+        metrics.set('machine_active_rooms', len(self.room_locks))
+        metrics.set('machine_chat_rooms', len(self.chat_rooms))
+
     async def _create_new_user(self, tg_message: types.Message) -> None:
         user: models.User = await models.User.create(tg_message)
         return user
@@ -682,87 +574,98 @@ class Machine(object):
         chat_id: int = tg_message.chat.id
         user_object: models.User = None
         try:
-            user_object = await models.User.get_user_by_chat_id(chat_id)
+            user_object = await repository.get_user_by_chat_id(chat_id)
         except models.User.DoesNotExist:
             user_object = await self._create_new_user(tg_message)
         return user_object
 
     async def _get_current_state(self, user: models.User) -> BotState:
-        state: BotState = None
-        if user.state == State.GREETING.name:
-            state = GreetingState(self.bot)
-            await state.set_context()
-        elif user.state == State.EXIT.name:
-            state = ExitState(self.bot)
-        elif user.state == State.RULES.name:
-            state = RulesState(self.bot)
-            await state.set_context()
-        elif user.state == State.ROOMS.name:
-            state = RoomsState(self.bot)
-            await state.set_context()
-        elif user.state == State.ROOM.name:
-            state = RoomState(self.bot)
-            await state.set_context()
-        elif user.state == State.GAME_WAITING.name:
-            state = GameWaitingState(self.bot)
-            await state.set_context()
-        elif user.state == State.GAME.name:
-            state = GameState(self.bot)
-            await state.set_context()
-        elif user.state == State.THROW_DICE.name:
-            state = ThrowDiceState(self.bot)
-            await state.set_context()
-        elif user.state == State.SELECT_PLACE.name:
-            state = SelectPlaceState(self.bot)
-            await state.set_context()
-        elif user.state == State.ACCUSE_PERSON.name:
-            state = AccusePersonState(self.bot)
-            await state.set_context()
-        elif user.state == State.ACCUSE_WEAPON.name:
-            state = AccuseWeaponState(self.bot)
-            await state.set_context()
-        elif user.state == State.CONFIRM_ACCUSE.name:
-            state = ConfirmAccuseState(self.bot)
-            await state.set_context()
-        elif user.state == State.CHECK_SUSPICTION.name:
-            state = CheckSuspictionState(self.bot)
-            await state.set_context()
-        elif user.state == State.CHECK_ACCUSE.name:
-            state = CheckAccuseState(self.bot)
-            await state.set_context()
-        elif user.state == State.GAME_FINISHED.name:
-            state = GameFinishedState(self.bot)
-            await state.set_context()
-        elif user.state == State.GAME_FINISHED.name:
-            state = GameWonState(self.bot)
-            await state.set_context()
-        else:
-            state = GreetingState(self.bot)
-            await state.set_context()
-        
+        state: BotState = self.states.get(user.state, None)
+        if state is None:
+            state = self.states[State.GREETING.name]
+        await state.prepare()
         return state
 
+    def _invalidate_game(self, user: models.User) -> None:
+        # игра в памяти могла измениться, но не сохраниться в БД - при следующем событии загружаем ее заново
+        if user.room_id is not None:
+            GameRegistry().invalidate(user.room_id)
+
+    async def _run_serialized(self, tg_message: types.Message, handle: Callable[[models.User], Awaitable]) -> None:
+        """
+        обрабатывает событие под блокировками чата и комнаты пользователя.
+        Пользователь загружается уже под блокировкой комнаты, поэтому изменения,
+        сделанные событиями других игроков комнаты, видны обработчику
+        """
+        chat_id: int = tg_message.chat.id
+        async with self.chat_locks.hold(chat_id):
+            user: Optional[models.User] = None
+            room_id: Optional[int] = self.chat_rooms.get(chat_id, None)
+            if room_id is None:
+                user = await self._get_user_by_message(tg_message)
+                room_id = user.room_id
+
+            room_lock = self.room_locks.hold(room_id) if room_id is not None else contextlib.nullcontext()
+            async with room_lock:
+                if room_id is not None:
+                    user = await self._get_user_by_message(tg_message)
+                tracing.tag(state=user.state)
+                try:
+                    await handle(user)
+                except Exception:
+                    self._invalidate_game(user)
+                    raise
+                finally:
+                    self._remember_room(chat_id, user.room_id)
+                    tracing.tag(new_state=user.state)
+
+    def _remember_room(self, chat_id: int, room_id: Optional[int]) -> None:
+        if room_id is None:
+            self.chat_rooms.pop(chat_id, None)
+            return
+        self.chat_rooms[chat_id] = room_id
+        self.chat_rooms.move_to_end(chat_id)
+        while len(self.chat_rooms) > MAX_CHAT_ROOMS:
+            self.chat_rooms.popitem(last=False)
 
     async def message_handler(self, tg_message: types.Message) -> None:
-        user: models.User = await self._get_user_by_message(tg_message)
-        state: BotState = await self._get_current_state(user)
-        new_state: BotState = await state.update_state(user, tg_message.text, tg_message.message_id)
-        logging.info(f'message: User {user.id}:{user.name}, message {tg_message.message_id} got new state {user.state}:{user.substate}')
-        await new_state.handler(user, tg_message.text, tg_message.message_id, outcoming_flag=False)
+        async def _handle(user: models.User) -> None:
+            state: BotState = await self._get_current_state(user)
+            new_state, params = await state.update_state(user, tg_message.text, tg_message.message_id)
+            logging.info(f'message: User {user.id}:{user.name}, message {tg_message.message_id} got new state {user.state}:{user.substate}')
+            await new_state.prepare()
+            await new_state.handler(user, tg_message.text, tg_message.message_id, outcoming_flag=False, **params)
+
+        await self._run_serialized(tg_message, _handle)
 
     async def callback_handler(self, callback_query: types.CallbackQuery) -> None:
-        user: models.User = await self._get_user_by_message(callback_query.message)
-        state: BotState = await self._get_current_state(user)
-        new_state: BotState = await state.update_state(user, str(callback_query.data), callback_query.message.message_id)
-        logging.info(f'callback: User {user.id}:{user.name}, message {callback_query.message.message_id} got new state {user.state}:{user.substate}')
-        await new_state.handler(user, str(callback_query.data), callback_query.message.message_id, outcoming_flag=False)
+        # повторное нажатие той же кнопки, пока первое еще не обработано, пропускаем
+        key: Tuple[int, int, str] = (callback_query.message.chat.id, callback_query.message.message_id, str(callback_query.data))
+        if key in self.pending_callbacks:
+            logging.info(f'callback: chat {key[0]}, message {key[1]}: duplicate {key[2]} skipped')
+            Metrics().inc('machine_duplicate_callbacks_total')
+            return
+
+        async def _handle(user: models.User) -> None:
+            state: BotState = await self._get_current_state(user)
+            new_state, params = await state.update_state(user, str(callback_query.data), callback_query.message.message_id)
+            logging.info(f'callback: User {user.id}:{user.name}, message {callback_query.message.message_id} got new state {user.state}:{user.substate}')
+            await new_state.prepare()
+            await new_state.handler(user, str(callback_query.data), callback_query.message.message_id, outcoming_flag=False, **params)
+
+        self.pending_callbacks.add(key)
+        try:
+            await self._run_serialized(callback_query.message, _handle)
+        finally:
+            self.pending_callbacks.discard(key)
 
     async def reset_user_by_message(self, tg_message: types.Message) -> None:
-         user_object: models.User = await self._get_user_by_message(tg_message)
-         user_object.state = 'GREETING'
-         user_object.substate = None
-         user_object.solving_mode = False
-         user_object.substate = None
-         user_object.current_task = None
-
-         await user_object.async_save()
+        async with self.chat_locks.hold(tg_message.chat.id):
+            user_object: models.User = await self._get_user_by_message(tg_message)
+            user_object.state = 'GREETING'
+            user_object.substate = None
+            user_object.solving_mode = False
+            user_object.substate = None
+            user_object.current_task = None
+
+            await user_object.async_save()
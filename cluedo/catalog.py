@@ -0,0 +1,81 @@
+import json
+from typing import Dict, Iterable, List, Optional
+
+import utils.card_utils as cu
+from utils.bits import iter_indices
+
+# формат хранения набора карт: 'k:' + ключи карт через запятую ('person:3,place:7').
+# Хранятся id карт, а не номера в каталоге: номера сдвигаются при добавлении и удалении карт
+KEYS_PREFIX = 'k:'
+
+
+class CardCatalog:
+    """
+    каталог карт комнаты: каждой карте сопоставляется ее номер (0..n-1)
+    в порядке подозреваемые, орудия, места (внутри типа - по id).
+    Наборы карт (карты игрока, известные карты, открытые карты) хранятся в памяти битовыми масками,
+    в БД - списками ключей карт (см. encode)
+    """
+    def __init__(self, cards: List[cu.Card]):
+        self.cards: List[cu.Card] = list(cards)
+        self.by_key: Dict[cu.CardKey, cu.Card] = cu.cards_to_catalog(self.cards)
+        self.keys: List[cu.CardKey] = list(self.by_key.keys())
+        self.index: Dict[cu.CardKey, int] = {key: idx for idx, key in enumerate(self.keys)}
+
+    def __len__(self) -> int:
+        return len(self.cards)
+
+    def card_index(self, card: cu.Card) -> int:
+        return self.index[cu.card_key(card)]
+
+    def get_card(self, index: int) -> cu.Card:
+        return self.cards[index]
+
+    def to_mask(self, cards: Iterable[cu.Card]) -> int:
+        mask: int = 0
+        for card in cards:
+            mask |= 1 << self.card_index(card)
+        return mask
+
+    def get_cards(self, mask: int) -> List[cu.Card]:
+        return [self.cards[idx] for idx in iter_indices(mask)]
+
+    def encode(self, mask: int) -> str:
+        return KEYS_PREFIX + ','.join(f'{card_type}:{card_id}' for card_type, card_id in (self.keys[idx] for idx in iter_indices(mask)))
+
+    def decode(self, src: Optional[str]) -> int:
+        if not src:
+            return 0
+        if src.startswith(KEYS_PREFIX):
+            mask: int = 0
+            for item in src[len(KEYS_PREFIX):].split(','):
+                if not item:
+                    continue
+                card_type, card_id = item.split(':')
+                idx: Optional[int] = self.index.get((card_type, int(card_id)), None)
+                if idx is not None:
+                    mask |= 1 << idx
+            return mask
+
+        # старый формат: [{"type": "person", "id": N}, ...]
+        mask = 0
+        for card in json.loads(src):
+            idx = self.index.get((card['type'], card['id']), None)
+            if idx is not None:
+                mask |= 1 << idx
+        return mask
+
+
+_room_catalogs: Dict[int, CardCatalog] = {}
+
+
+def get_room_catalog(room_id: int, cards: List[cu.Card]) -> CardCatalog:
+    catalog: Optional[CardCatalog] = _room_catalogs.get(room_id, None)
+    if catalog is None:
+        catalog = CardCatalog(cards)
+        _room_catalogs[room_id] = catalog
+    return catalog
+
+
+def invalidate_room_catalog(room_id: int) -> None:
+    _room_catalogs.pop(room_id, None)
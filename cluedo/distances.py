@@ -1,31 +1,105 @@
+import base64
 import random as rd
-from typing import List
+from typing import Dict, List, Optional, Sequence
+
+from utils.bits import iter_indices
+from utils.consts import MAX_EDGES_ON_DICE
+
+# наибольшая сумма очков на двух кубиках
+MAX_DICE_TOTAL = 2 * MAX_EDGES_ON_DICE
+# наибольшее расстояние между местами в новой игре
+MAX_DISTANCE = 10
+
+# формат хранения расстояний: 'p1:' + base64 от байтов [n, d(0,1), d(0,2), ..., d(0,n-1), d(1,2), ..., d(n-2,n-1)],
+# то есть число мест и расстояния над диагональю по строкам, по байту на расстояние
+PACKED_PREFIX = 'p1:'
 
 
 class Distances:
-    def __init__(self, dist: List[List[int]]):
-        self.dist: List[List[int]] = dist
+    """
+    симметричная матрица расстояний между n местами комнаты с нулевой диагональю.
+    Хранится только ее часть над диагональю (packed), расстояние читается прямо из байтов
+    """
+    def __init__(self, n: int, packed: bytes):
+        self.n: int = n
+        self.packed: bytes = packed
+        # для каждого места (по номеру) - битовые маски мест, достижимых при сумме очков 0..MAX_DICE_TOTAL.
+        # Таблица места строится при первом обращении к нему
+        self.reachable: Dict[int, List[int]] = {}
+        # номер места по его id; матрица может быть больше числа мест комнаты
+        self.place_index: Optional[Dict[int, int]] = None
+        self.size: int = n
 
     def get_dist(self, index1: int, index2: int) -> int:
-        return self.dist[index1][index2]
+        if index1 == index2:
+            return 0
+        if index1 > index2:
+            index1, index2 = index2, index1
+        return self.packed[index1 * (2 * self.n - index1 - 1) // 2 + index2 - index1 - 1]
+
+    @property
+    def dist(self) -> List[List[int]]:
+        return [[self.get_dist(i, j) for j in range(self.n)] for i in range(self.n)]
+
+    def _get_reachable(self, index: int) -> List[int]:
+        table: Optional[List[int]] = self.reachable.get(index, None)
+        if table is None:
+            table = [0] * (MAX_DICE_TOTAL + 1)
+            for other in range(self.size):
+                dist: int = self.get_dist(index, other)
+                if dist <= MAX_DICE_TOTAL:
+                    table[max(dist, 0)] |= 1 << other
+            for total in range(1, MAX_DICE_TOTAL + 1):
+                table[total] |= table[total - 1]
+            self.reachable[index] = table
+        return table
+
+    def get_reachable_mask(self, index: int, dice_total: int) -> int:
+        if dice_total < 0:
+            return 0
+        return self._get_reachable(index)[min(dice_total, MAX_DICE_TOTAL)]
+
+    def bind_places(self, places: Sequence) -> None:
+        self.place_index = {p.id: idx for idx, p in enumerate(places)}
+        self.size = min(len(places), self.n)
+        self.reachable = {}
+
+    def get_accessible_places(self, places: Sequence, place, dice_total: int) -> List:
+        """
+        места, до которых можно дойти из place, выбросив dice_total очков.
+        places - места комнаты в порядке, в котором заданы расстояния (по id)
+        """
+        if place is None or dice_total < 0:
+            return []
+        if self.place_index is None:
+            self.bind_places(places)
+        mask: int = self.get_reachable_mask(self.place_index[place.id], dice_total)
+        return [places[idx] for idx in iter_indices(mask)]
 
     def __str__(self):
         return '\n'.join(map(lambda x: ','.join(map(str,x)), self.dist))
 
+    def encode(self) -> str:
+        # число мест хранится в одном байте
+        assert self.n <= 255, f'too many places to pack: {self.n}'
+        return PACKED_PREFIX + base64.b64encode(bytes([self.n]) + self.packed).decode('ascii')
+
     @staticmethod
-    def new_dist() -> 'Distances':
-        r = [[0, 0, 0, 0, 0, 0, 0, 0, 0, 0]]
-        for i in range(10):
-            r[i - 1][i - 1] = 0
-            for j in range(i, 10):
-                if j >= len(r):
-                    r.append([0, 0, 0, 0, 0, 0, 0, 0, 0, 0])
-                r[i][j] = rd.randint(1,10)
-                r[j][i] = r[i][j]
-        r[9][9] = 0
-        return Distances(r)
+    def from_matrix(dist: List[List[int]]) -> 'Distances':
+        n: int = len(dist)
+        return Distances(n, bytes(dist[i][j] for i in range(n) for j in range(i + 1, n)))
+
+    @staticmethod
+    def new_dist(n: int, rng: Optional[rd.Random] = None) -> 'Distances':
+        if rng is None:
+            rng = rd.Random()
+        return Distances(n, bytes(rng.randint(1, MAX_DISTANCE) for _ in range(n * (n - 1) // 2)))
 
     @staticmethod
     def get_from_string(src: str) -> 'Distances':
-        return Distances(list(map(lambda x: list(map(int, x.split(','))), src.split('\n'))))
-        
\ No newline at end of file
+        if src.startswith(PACKED_PREFIX):
+            data: bytes = base64.b64decode(src[len(PACKED_PREFIX):])
+            return Distances(data[0], data[1:])
+
+        # старый формат: строки матрицы через перевод строки, расстояния через запятую
+        return Distances.from_matrix(list(map(lambda x: list(map(int, x.split(','))), src.strip().split('\n'))))
@@ -1,20 +1,56 @@
+from typing import Optional, Sequence, Tuple
+
 from data import models
+from cluedo.catalog import CardCatalog, get_room_catalog
 
 class Field:
-    def __init__(self, room: models.CluedoRoom):
-        self.people = models.CluedoPerson.get_room_people(room)
-        self.weapons = models.CluedoWeapon.get_room_weapons(room)
-        self.places = models.CluedoPlace.get_room_places(room)
+    def __init__(self, room: models.CluedoRoom,
+                 people: Optional[Sequence[models.CluedoPerson]] = None,
+                 weapons: Optional[Sequence[models.CluedoWeapon]] = None,
+                 places: Optional[Sequence[models.CluedoPlace]] = None):
+        self.room = room
+        # карты комнаты загружаются при первом обращении (в пуле потоков БД, см. Game.async_create),
+        # если не переданы явно (симулятор игр)
+        self._people: Optional[Tuple[models.CluedoPerson, ...]] = tuple(people) if people is not None else None
+        self._weapons: Optional[Tuple[models.CluedoWeapon, ...]] = tuple(weapons) if weapons is not None else None
+        self._places: Optional[Tuple[models.CluedoPlace, ...]] = tuple(places) if places is not None else None
+        self.catalog = None
+
+    @property
+    def people(self) -> Tuple[models.CluedoPerson, ...]:
+        if self._people is None:
+            self._people = models.CluedoPerson.get_room_people(self.room)
+        return self._people
+
+    @property
+    def weapons(self) -> Tuple[models.CluedoWeapon, ...]:
+        if self._weapons is None:
+            self._weapons = models.CluedoWeapon.get_room_weapons(self.room)
+        return self._weapons
+
+    @property
+    def places(self) -> Tuple[models.CluedoPlace, ...]:
+        if self._places is None:
+            self._places = models.CluedoPlace.get_room_places(self.room)
+        return self._places
 
     def get_people(self):
         return list(self.people)
-        
+
     def get_weapons(self):
         return list(self.weapons)
-    
+
     def get_places(self):
         return list(self.places)
 
     def cards(self):
         return list(self.people) + list(self.weapons) + list(self.places)
 
+    def get_catalog(self) -> CardCatalog:
+        if self.catalog is None:
+            if self.room.id is None:
+                # комнаты нет в БД - каталог нельзя делить с другими играми по id комнаты
+                self.catalog = CardCatalog(self.cards())
+            else:
+                self.catalog = get_room_catalog(self.room.id, self.cards())
+        return self.catalog
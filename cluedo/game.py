@@ -1,19 +1,27 @@
 import json
 import logging
 import random as rd
-from typing import Dict, List, Union
-from cluedo.distances import Distances
+from typing import Dict, List, Optional, Tuple, Union
+from cluedo.distances import PACKED_PREFIX, Distances
 from data import models
+from aioutils import sync_to_async
 from cluedo.field import Field
+from cluedo.catalog import CardCatalog
+from cluedo.tracker import ChangeTracker
 import utils.card_utils as cu
-from utils.consts import MAX_EDGES_ON_DICE
+from utils.consts import MAX_EDGES_ON_DICE, MAX_PLAYERS
 
-class Player:
-    def __init__(self, user: models.User):
-        self.cards: List = []
+class Player(ChangeTracker):
+    # атрибуты, которые сохраняются в одноименные поля CluedoPlayer
+    tracked_fields: Tuple[str, ...] = ('user', 'number', 'dice_throw_result', 'place', 'alias', 'alive', 'cards', 'known_cards')
+
+    def __init__(self, user: models.User, catalog: CardCatalog):
+        self.catalog: CardCatalog = catalog
+        # карты хранятся битовыми масками по номерам карт в каталоге комнаты
+        self.cards: int = 0
         self.alive = True
         self.auto = False
-        self.known_cards: List = []
+        self.known_cards: int = 0
         self.number = -1
         self.dice_throw_result = -1
         self.accessible_places = []
@@ -23,6 +31,8 @@ class Player:
         self.alias = None
         self.game = None
         self.player = None
+        # заголовок -> (маска карт, текст), см. _describe_cards
+        self._cards_text: Dict[str, Tuple[int, str]] = {}
 
         self.id = user.id
         self.username = user.name
@@ -32,50 +42,88 @@ class Player:
 
 
     def populate_accessible_places(self, places: List[models.CluedoPlace], distances: Distances):
-        self.accessible_places = []
-        index1 = places.index(self.place)
-        for place in places:
-            index2 = places.index(place)
-            if distances.get_dist(index1, index2) <= self.dice_throw_result:
-                self.accessible_places.append(place)
+        self.accessible_places = distances.get_accessible_places(places, self.place, self.dice_throw_result)
 
 
 
-    def throw_dice(self):
+    def throw_dice(self, rng: Optional[rd.Random] = None):
         if self.dice_throw_result < 0:
-            self.dice_throw_result = rd.randrange(1, MAX_EDGES_ON_DICE + 1) + rd.randrange(1, MAX_EDGES_ON_DICE + 1)
+            if rng is None:
+                rng = rd.Random()
+            self.dice_throw_result = rng.randrange(1, MAX_EDGES_ON_DICE + 1) + rng.randrange(1, MAX_EDGES_ON_DICE + 1)
 
-    def set_cards(self, cards):
-        self.cards = cards[:] 
+    def set_cards(self, cards: int):
+        self.cards = cards
 
-    def add_known_cards(self, cards):
-        self.known_cards = cards[:] 
+    def add_known_cards(self, cards: int):
+        self.known_cards = cards
 
     def get_cards(self):
-        return cu.cards_to_json(self.cards)
+        return self.catalog.encode(self.cards)
 
     def get_known_cards(self):
-        return cu.cards_to_json(self.known_cards)
+        return self.catalog.encode(self.known_cards)
+
+    def get_changed_values(self) -> Dict:
+        values: Dict = {name: getattr(self, name) for name in self.get_dirty()}
+        if 'cards' in values:
+            values['cards'] = self.get_cards()
+        if 'known_cards' in values:
+            values['known_cards'] = self.get_known_cards()
+        return values
+
+    def _describe_cards(self, title: str, mask: int) -> str:
+        # текст меняется только вместе с маской карт, поэтому хранится последний по каждому заголовку
+        cached: Optional[Tuple[int, str]] = self._cards_text.get(title, None)
+        if cached is None or cached[0] != mask:
+            cached = (mask, title + ', '.join(map(lambda x: f"{x['type']}:{x['name']}", cu.cards_to_info(self.catalog.get_cards(mask)))))
+            self._cards_text[title] = cached
+        return cached[1]
 
     def get_cards_info(self):
-        return 'Мои карты:' + ', '.join(map(lambda x: f"{x['type']}:{x['name']}", cu.cards_to_info(self.cards)))
+        return self._describe_cards('Мои карты:', self.cards)
 
     def get_known_cards_info(self):
-        return 'Известные мне карты:' + ', '.join(map(lambda x: f"{x['type']}:{x['name']}", cu.cards_to_info(self.known_cards)))
+        return self._describe_cards('Известные мне карты:', self.known_cards)
 
     def update_known_cards(self, reflute_players):
         if self.user.state == 'CHECK_SUSPICTION' or self.user.state == 'GAME':
             if reflute_players is not None:
                 for pp in reflute_players:
-                    self.known_cards.append(pp[1])
-
-
-
-class Game:
-    def __init__(self, user: models.User):
-        self.am_open = (0, 0, 0, 0, 0, 0)
+                    self.known_cards |= 1 << pp[1]
+
+
+
+def new_seed() -> int:
+    return rd.SystemRandom().getrandbits(63)
+
+
+class Game(ChangeTracker):
+    """
+    игра комнаты. Все случайные решения берутся из генераторов, зависящих только от seed:
+    раздача и поле - из rng, созданного по seed, бросок кубиков номер k - из Random(f'{seed}:{k}').
+    Поэтому игру можно повторить по seed и последовательности ходов, где бы она ни загружалась
+    """
+    tracked_fields: Tuple[str, ...] = ('winner', 'secret', 'place_distances', 'opencards', 'started', 'alive', 'won', 'turn_number',
+                                       'accused_place', 'accused_person', 'accused_weapon', 'seed', 'dice_throws')
+    # поля CluedoGame, имена которых отличаются от имен атрибутов игры
+    MODEL_FIELDS: Dict[str, str] = {
+        'place_distances': 'distances',
+        'opencards': 'open_cards',
+        'accused_place': 'accuse_place',
+        'accused_person': 'accuse_person',
+        'accused_weapon': 'accuse_weapon',
+    }
+
+    def __init__(self, user: models.User, seed: Optional[int] = None, rng: Optional[rd.Random] = None, field: Optional[Field] = None):
+        # сколько карт открывается всем в начале игры, по числу игроков 0..MAX_PLAYERS
+        self.am_open = (0,) * (MAX_PLAYERS + 1)
+        # при переданном rng воспроизводимость раздачи обеспечивает вызывающий
+        self.seed: int = seed if seed is not None else new_seed()
+        self.rng: rd.Random = rng if rng is not None else rd.Random(self.seed)
+        self.dice_throws: int = 0
         self.user = user
-        self.field: Field = Field(user.room)
+        self.field: Field = field if field is not None else Field(user.room)
         self.secret: Dict = None
         self.place_distances: Distances = None
         self.players: List[Player] = []
@@ -92,20 +140,31 @@ class Game:
         self.reflute_players = None
         self.accuse_matches = None
 
-    def create(self):
-        self.secret = {'person': rd.choice(self.field.people), 'weapon': rd.choice(self.field.weapons), 'place': rd.choice(self.field.places)}
-        self.place_distances = Distances.new_dist()
+        # тексты для сообщений игры, см. get_general_game_info и get_open_cards_info
+        self._general_info: Optional[str] = None
+        self._open_cards_info: Optional[Tuple[Optional[int], str]] = None
+
+    @property
+    def catalog(self) -> CardCatalog:
+        return self.field.get_catalog()
+
+    def create(self, users: List[models.User] = None):
+        rng: rd.Random = self.rng
+        self.secret = {'person': rng.choice(self.field.people), 'weapon': rng.choice(self.field.weapons), 'place': rng.choice(self.field.places)}
+        self.place_distances = Distances.new_dist(len(self.field.places), rng)
         self.cards = self.field.cards()
-        rd.shuffle(self.cards)
+        rng.shuffle(self.cards)
 
         logging.info(f'game create for user: {self.user.name}:{self.user.id}')
-        users: List[models.User] = list(models.User.objects.filter(room=self.user.room))
-        rd.shuffle(users)
+        if users is None:
+            users = list(models.User.objects.filter(room=self.user.room).order_by('id'))
+        users = sorted(users, key=lambda u: u.id)
+        rng.shuffle(users)
         for p in users:
             if p.id == self.user.id:
-                pp = Player(self.user)
+                pp = Player(self.user, self.catalog)
             else:
-                pp = Player(p)
+                pp = Player(p, self.catalog)
             self.players.append(pp)
             logging.info(f'player create: user:{pp.user.id} for game {self.user.id}')
 
@@ -115,8 +174,8 @@ class Game:
 
         self.alive = len(self.players)
         self.n = len(self.players)
-        self.turn_number = rd.randint(0,self.n-1)
-        self.opencards = deal_cards[:self.am_open[self.n]]
+        self.turn_number = rng.randint(0,self.n-1)
+        self.opencards = self.catalog.to_mask(deal_cards[:self.am_open[self.n]])
         aliases = self.field.get_people()[:]
         places = self.field.get_places()[:]
 
@@ -126,11 +185,11 @@ class Game:
             player.number = player_idx
             player.dice_throw_result = -1
             deal = deal_cards[self.am_open[self.n] + player_idx * deal_size: self.am_open[self.n] + (player_idx + 1) * deal_size]
-            player.set_cards(deal)
-            player.add_known_cards(deal)
+            player.set_cards(self.catalog.to_mask(deal))
+            player.add_known_cards(player.cards)
 
-            player.place = rd.choice(places)
-            player.alias = rd.choice(aliases)
+            player.place = rng.choice(places)
+            player.alias = rng.choice(aliases)
             aliases.remove(player.alias)
             
         self.started = True
@@ -138,22 +197,59 @@ class Game:
             # player.message_content = f'Ваши карты: {player.cards_in_hand()}'
         
     def get_general_game_info(self):
-        return "Карты в игре:" + '\n\t' + \
+        # карты комнаты не меняются, пока игра жива: текст собирается один раз
+        if self._general_info is None:
+            self._general_info = "Карты в игре:" + '\n\t' + \
                  "      Подозреваемые:" + ', '.join(map(lambda x: x.name, self.field.get_people())) + '\n\t' + \
                  "      Места:" + ', '.join(map(lambda x: x.name, self.field.get_places()))  + '\n\t' + \
                  "      Орудия:" + ', '.join(map(lambda x: x.name, self.field.get_weapons()))  + '\n'
+        return self._general_info
 
     def get_open_cards_info(self):
-        if self.opencards:
-            return "Известные всем карты:" + ', '.join(map(lambda x: x.name, self.opencards))
-        else:
-            return "Нет известных всем карт"
+        if self._open_cards_info is None or self._open_cards_info[0] != self.opencards:
+            if self.opencards:
+                text: str = "Известные всем карты:" + ', '.join(map(lambda x: x.name, self.catalog.get_cards(self.opencards)))
+            else:
+                text = "Нет известных всем карт"
+            self._open_cards_info = (self.opencards, text)
+        return self._open_cards_info[1]
 
     def get_secret(self):
         return json.dumps({'person': self.secret['person'].id, 'weapon': self.secret['weapon'].id, 'place': self.secret['place'].id})
 
     def get_open_cards(self):
-        return cu.cards_to_json(self.opencards)
+        return self.catalog.encode(self.opencards)
+
+    def get_changed_values(self) -> Dict:
+        """
+        значения полей CluedoGame, изменившихся после загрузки или последнего сохранения игры
+        """
+        values: Dict = {}
+        for name in self.get_dirty():
+            if name == 'secret':
+                value = self.get_secret()
+            elif name == 'place_distances':
+                value = self.place_distances.encode()
+            elif name == 'opencards':
+                value = self.get_open_cards()
+            else:
+                value = getattr(self, name)
+            values[self.MODEL_FIELDS.get(name, name)] = value
+        return values
+
+    def mark_clean(self) -> None:
+        super().mark_clean()
+        for p in self.players:
+            p.mark_clean()
+
+    def get_dice_rng(self) -> rd.Random:
+        """
+        генератор для очередного броска кубиков; не зависит от того, сколько раз
+        игра загружалась из БД и что еще брало случайные числа
+        """
+        rng: rd.Random = rd.Random(f'{self.seed}:{self.dice_throws}')
+        self.dice_throws += 1
+        return rng
 
     def get_player(self, user: models.User):
         for p in self.players:
@@ -174,12 +270,19 @@ class Game:
         return None
 
 
+    def get_card(self, card_type: str, card_id: int) -> Union[models.CluedoPerson, models.CluedoPlace, models.CluedoWeapon]:
+        # только из каталога комнаты: метод вызывается и в event loop (update_state), где запросов к БД быть не должно
+        card: Optional[cu.Card] = self.catalog.by_key.get((card_type, card_id), None)
+        if card is None:
+            raise ValueError(f'card {card_type}:{card_id} is not in the room catalog')
+        return card
+
     def parse_secret(self, secret: str) -> Dict:
         d = json.loads(secret)
 
-        person = models.CluedoPerson.objects.filter(id=d['person']).first()
-        place = models.CluedoPlace.objects.filter(id=d['place']).first()
-        weapon=models.CluedoWeapon.objects.filter(id=d['weapon']).first()
+        person, place, weapon = cu.json_to_cards([{'type': 'person', 'id': d['person']}, 
+                                                  {'type': 'place', 'id': d['place']}, 
+                                                  {'type': 'weapon', 'id': d['weapon']}], self.catalog.by_key)
 
         d['person'] = person
         d['place'] = place
@@ -192,40 +295,52 @@ class Game:
         #     self.cards.remove(cc)
 
 
-    def parse_opencards(self, cards: str) -> List[Union[models.CluedoPerson, models.CluedoPlace, models.CluedoWeapon]]:
-        self.opencards = cu.json_to_cards(json.loads(cards))
+    def parse_opencards(self, cards: str) -> int:
+        self.opencards = self.catalog.decode(cards)
 
-    def parse_cards(self, player: Player, cards: str) -> List[Union[models.CluedoPerson, models.CluedoPlace, models.CluedoWeapon]]:
-        player.cards = cu.json_to_cards(json.loads(cards))
+    def parse_cards(self, player: Player, cards: str) -> int:
+        player.cards = self.catalog.decode(cards)
 
-    def parse_known_cards(self, player: Player, cards: str) -> List[Union[models.CluedoPerson, models.CluedoPlace, models.CluedoWeapon]]:
-        player.known_cards = cu.json_to_cards(json.loads(cards))
+    def parse_known_cards(self, player: Player, cards: str) -> int:
+        player.known_cards = self.catalog.decode(cards)
 
     def parse_players(self, game: models.CluedoGame):
-        plist = models.CluedoPlayer.objects.filter(game=game)
+        plist = models.CluedoPlayer.objects.filter(game=game).select_related('user')
         for pp in plist:
             p = pp
             if p.user.id == self.user.id:
                 p.user = self.user
-            player = Player(p.user)
+            player = Player(p.user, self.catalog)
             player.player = pp
             logging.info(f'player load: user:{pp.user.id} in game {self.user.id}')
             player.alive = p.alive
             player.number = p.number
             player.game = game
-            player.place = p.place
-            player.alias = p.alias
+            player.place = self.get_card('place', p.place_id) if p.place_id is not None else None
+            player.alias = self.get_card('person', p.alias_id) if p.alias_id is not None else None
             player.dice_throw_result = p.dice_throw_result
-            player.populate_accessible_places(self.field.get_places(), self.place_distances)
+            if player.dice_throw_result >= 0:
+                player.populate_accessible_places(self.field.places, self.place_distances)
             self.parse_cards(player, p.cards)
             self.parse_known_cards(player, p.known_cards)
 
 
             self.players.append(player)
         
+    """
+    создание и загрузка игры обращаются к БД, поэтому из обработчиков
+    они вызываются в пуле потоков БД
+    """
+    @sync_to_async
+    def async_create(self, users: List[models.User] = None) -> None:
+        self.create(users)
+
+    @sync_to_async
+    def async_from_model(self, game: models.CluedoGame) -> None:
+        self.from_model(game)
+
     def from_model(self, game: models.CluedoGame):
         self.cards = self.field.cards()
-        rd.shuffle(self.cards)
 
         self.place_distances = Distances.get_from_string(game.distances)
         logging.info(f'game load for user: {self.user.name}:{self.user.id}')
@@ -239,9 +354,33 @@ class Game:
         self.winner = game.winner
         self.n = len(self.players)
 
-        self.accused_person = game.accuse_person
-        self.accused_place = game.accuse_place
-        self.accused_weapon = game.accuse_weapon
+        self.accused_person = self.get_card('person', game.accuse_person_id) if game.accuse_person_id is not None else None
+        self.accused_place = self.get_card('place', game.accuse_place_id) if game.accuse_place_id is not None else None
+        self.accused_weapon = self.get_card('weapon', game.accuse_weapon_id) if game.accuse_weapon_id is not None else None
+        self.dice_throws = game.dice_throws
+        if game.seed is not None:
+            self.seed = game.seed
+        self.mark_clean()
+        if game.seed is None:
+            # игра начата до появления seed: сохраняется seed, выбранный при загрузке
+            self.get_dirty().add('seed')
+        if game.distances and not game.distances.startswith(PACKED_PREFIX):
+            # расстояния в старом формате: при сохранении записываются в упакованном
+            self.get_dirty().add('place_distances')
+
+    def bind_users(self, user: models.User, users: List[models.User]):
+        """
+        подготавливает загруженную ранее игру к обработке нового события:
+        подставляет актуальных пользователей комнаты и сбрасывает результаты прошлого хода
+        """
+        self.user = user
+        self.reflute_players = None
+        self.accuse_matches = None
+
+        room_users: Dict[int, models.User] = {u.id: u for u in users}
+        room_users[user.id] = user
+        for p in self.players:
+            p.user = room_users.get(p.user.id, p.user)
 
     def get_next_player(self):
         index = 0
@@ -272,8 +411,7 @@ class Game:
         player_turn: Player = self.get_player_whos_turn()
         for pp in self.players:
             if pp.user.id != player_turn.user.id:
-                for c in pp.cards:
-                    pp.known_cards.append(c)
+                pp.known_cards |= pp.cards
 
     async def update_after_send(self, user: models.User):
         if self.user.state == 'CHECK_SUSPICTION':
@@ -290,51 +428,49 @@ class Game:
     def update_state(self, **kwargs):
         if self.user.state == 'THROW_DICE':
             player: Player = self.get_player_whos_turn()
-            player.throw_dice()
-            player.populate_accessible_places(self.field.get_places(), self.place_distances)
+            if player.dice_throw_result < 0:
+                player.throw_dice(self.get_dice_rng())
+            player.populate_accessible_places(self.field.places, self.place_distances)
         elif self.user.state == 'ACCUSE_PERSON':
             player: Player = self.get_player_whos_turn()
             if kwargs.get('accused_location', -1) >= 0:
-                player.place = models.CluedoPlace.objects.filter(id=kwargs['accused_location']).first()
+                player.place = self.get_card('place', kwargs['accused_location'])
                 self.accused_place = player.place
         elif self.user.state == 'ACCUSE_WEAPON':
             player: Player = self.get_player_whos_turn()
             if kwargs.get('accused_person', -1) >= 0:
-                self.accused_person = models.CluedoPerson.objects.filter(id=kwargs['accused_person']).first()
+                self.accused_person = self.get_card('person', kwargs['accused_person'])
         elif self.user.state == 'CONFIRM_ACCUSE':
             player: Player = self.get_player_whos_turn()
             if kwargs.get('accused_weapon', -1) >= 0:
-                self.accused_weapon = models.CluedoWeapon.objects.filter(id=kwargs['accused_weapon']).first()
+                self.accused_weapon = self.get_card('weapon', kwargs['accused_weapon'])
         elif self.user.state == 'CHECK_SUSPICTION':
             player: Player = self.get_player_whos_turn()
             if kwargs.get('suspiction', None) is not None:
-                player.place = models.CluedoPlace.objects.filter(id=kwargs['suspiction']['place']).first()
+                player.place = self.get_card('place', kwargs['suspiction']['place'])
                 self.accused_place = player.place
-                self.accused_person = models.CluedoPerson.objects.filter(id=kwargs['suspiction']['person']).first()
-                self.accused_weapon = models.CluedoWeapon.objects.filter(id=kwargs['suspiction']['weapon']).first()
+                self.accused_person = self.get_card('person', kwargs['suspiction']['person'])
+                self.accused_weapon = self.get_card('weapon', kwargs['suspiction']['weapon'])
                 self.check_suspiction(player)
         elif self.user.state == 'CHECK_ACCUSE':
             player: Player = self.get_player_whos_turn()
             if kwargs.get('suspiction', None) is not None:
-                player.place = models.CluedoPlace.objects.filter(id=kwargs['suspiction']['place']).first()
+                player.place = self.get_card('place', kwargs['suspiction']['place'])
                 self.accused_place = player.place
-                self.accused_person = models.CluedoPerson.objects.filter(id=kwargs['suspiction']['person']).first()
-                self.accused_weapon = models.CluedoWeapon.objects.filter(id=kwargs['suspiction']['weapon']).first()
+                self.accused_person = self.get_card('person', kwargs['suspiction']['person'])
+                self.accused_weapon = self.get_card('weapon', kwargs['suspiction']['weapon'])
                 self.check_accuse(player)
 
     def check_suspiction(self, player) -> List[Player]:
-        lfc_place = lambda x: type(x) is models.CluedoPlace and self.accused_place.id == x.id
-        lfc_person = lambda x: type(x) is models.CluedoPerson and self.accused_person.id == x.id
-        lfc_weapon = lambda x: type(x) is models.CluedoWeapon and self.accused_weapon.id == x.id
-        lf_place = lambda y: next(filter(lfc_place, y.cards), None) is not None
-        lf_person = lambda y: next(filter(lfc_person, y.cards), None) is not None
-        lf_weapon = lambda y: next(filter(lfc_weapon, y.cards), None) is not None
-        players = list(filter(lambda z: (z != player) and (lf_place(z) or lf_person(z) or lf_weapon(z)), self.players))
+        # опровержение - пересечение карт игрока с картами подозрения
+        accused = [self.catalog.card_index(self.accused_place), 
+                   self.catalog.card_index(self.accused_person), 
+                   self.catalog.card_index(self.accused_weapon)]
+        accused_mask = (1 << accused[0]) | (1 << accused[1]) | (1 << accused[2])
         self.reflute_players = []
-        for pp in players:
-            self.reflute_players.extend(map(lambda x: (pp, x), filter(lfc_place, pp.cards)))
-            self.reflute_players.extend(map(lambda x: (pp, x), filter(lfc_person, pp.cards)))
-            self.reflute_players.extend(map(lambda x: (pp, x), filter(lfc_weapon, pp.cards)))
+        for pp in self.players:
+            if pp != player and pp.cards & accused_mask:
+                self.reflute_players.extend((pp, idx) for idx in accused if pp.cards & (1 << idx))
             
         return self.reflute_players
 
@@ -0,0 +1,57 @@
+import time
+import logging
+from typing import Dict, Optional
+
+import settings
+from utils.cache import SingletonMeta
+from utils.metrics import Metrics
+from cluedo.game import Game
+
+
+class GameEntry:
+    def __init__(self, game: Game, version: int):
+        self.game: Game = game
+        self.version: int = version
+        self.last_access: float = time.monotonic()
+
+
+class GameRegistry(metaclass=SingletonMeta):
+    """
+    хранит в памяти процесса загруженные игры по id комнаты,
+    чтобы не собирать Game из БД на каждое нажатие кнопки.
+    Игра из реестра используется, только если ее версия совпадает с версией в БД
+    """
+    def __init__(self, idle_timeout: float = settings.GAME_IDLE_TIMEOUT):
+        self._games: Dict[int, GameEntry] = {}
+        self.idle_timeout: float = idle_timeout
+        Metrics().add_collector(self.collect_metrics)
+
+    def find(self, room_id: int, version: int) -> Optional[Game]:
+        self.evict_idle()
+        entry: Optional[GameEntry] = self._games.get(room_id, None)
+        if entry is None:
+            return None
+        if entry.version != version:
+            logging.info(f'game registry: room {room_id} version {entry.version} is stale, db version {version}')
+            self.invalidate(room_id)
+            return None
+        entry.last_access = time.monotonic()
+        return entry.game
+
+    def update(self, room_id: int, game: Game, version: int) -> None:
+        self._games[room_id] = GameEntry(game, version)
+
+    def invalidate(self, room_id: int) -> None:
+        self._games.pop(room_id, None)
+
+    def evict_idle(self) -> None:
+        now: float = time.monotonic()
+        for room_id in [k for k, v in self._games.items() if now - v.last_access > self.idle_timeout]:
+            logging.info(f'game registry: evict idle game in room {room_id}')
+            self.invalidate(room_id)
+
+    def __len__(self) -> int:
+        return len(self._games)
+
+    def collect_metrics(self, metrics: Metrics) -> None:
+        metrics.set('game_registry_games', len(self._games))
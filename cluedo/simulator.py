@@ -0,0 +1,212 @@
+"""
+прогон игр без Telegram и БД: игроками управляют боты, карты комнаты создаются в памяти.
+Игра проходит через те же переходы, что и в боте (update_state, check_suspiction,
+check_accuse, next_turn), время каждого перехода собирается в гистограммы
+"""
+import random as rd
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from data import models
+from cluedo.field import Field
+from cluedo.game import Game, Player
+from utils.metrics import Timing
+
+# границы корзин гистограммы времени переходов, в секундах (переходы игры занимают микросекунды)
+SIMULATION_BUCKETS: Tuple[float, ...] = (0.000005, 0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+
+
+@dataclass(frozen=True)
+class Move:
+    """
+    ход игрока: куда пошел, кого и чем подозревает (id карт) и обвиняет ли
+    """
+    place: int
+    person: int
+    weapon: int
+    accuse: bool
+
+
+class SimulationBot(object):
+    def choose_move(self, game: Game, player: Player) -> Move:
+        raise NotImplementedError()
+
+
+class RandomBot(SimulationBot):
+    """
+    идет в случайное доступное место и подозревает случайные неизвестные ему карты.
+    Обвиняет, когда неизвестной осталась ровно одна карта каждого типа, или наугад,
+    если patience ходов подряд не узнал ничего нового (нерозданные карты не узнать никак)
+    """
+    def __init__(self, rng: rd.Random, patience: int = 20):
+        self.rng: rd.Random = rng
+        self.patience: int = patience
+        # id пользователя -> (известные карты, сколько ходов они не менялись)
+        self.progress: Dict[int, Tuple[int, int]] = {}
+
+    def _unknown(self, game: Game, player: Player, cards) -> List:
+        known: int = player.known_cards | (game.opencards or 0)
+        return [c for c in cards if not known & (1 << game.catalog.card_index(c))]
+
+    def choose_move(self, game: Game, player: Player) -> Move:
+        people: List[models.CluedoPerson] = self._unknown(game, player, game.field.people) or list(game.field.people)
+        weapons: List[models.CluedoWeapon] = self._unknown(game, player, game.field.weapons) or list(game.field.weapons)
+        places: List[models.CluedoPlace] = self._unknown(game, player, game.field.places)
+        accessible: List[models.CluedoPlace] = player.accessible_places or [player.place]
+
+        # неизвестное место, до которого можно дойти, интереснее уже известного
+        targets: List[models.CluedoPlace] = [p for p in accessible if p in places] or accessible
+        place: models.CluedoPlace = self.rng.choice(targets)
+        known, stale = self.progress.get(player.id, (player.known_cards, 0))
+        stale = stale + 1 if known == player.known_cards else 0
+        self.progress[player.id] = (player.known_cards, stale)
+
+        accuse: bool = len(people) == 1 and len(weapons) == 1 and places == [place] or stale >= self.patience
+        return Move(place.id, self.rng.choice(people).id, self.rng.choice(weapons).id, accuse)
+
+
+class ScriptedBot(SimulationBot):
+    """
+    повторяет заданные ходы (например, записанные в GameResult.moves), затем передает ход fallback
+    """
+    def __init__(self, moves: Iterable[Move], fallback: Optional[SimulationBot] = None):
+        self.moves: Iterator[Move] = iter(moves)
+        self.fallback: Optional[SimulationBot] = fallback
+
+    def choose_move(self, game: Game, player: Player) -> Move:
+        move: Optional[Move] = next(self.moves, None)
+        if move is not None:
+            return move
+        if self.fallback is None:
+            raise Exception('ScriptedBot: ходы закончились')
+        return self.fallback.choose_move(game, player)
+
+
+@dataclass
+class GameResult:
+    seed: int
+    moves: List[Tuple[int, Move]] = field(default_factory=list)
+    winner: Optional[int] = None
+    finished: bool = False
+
+
+@dataclass
+class SimulationStats:
+    games: int = 0
+    moves: int = 0
+    won: int = 0
+    elapsed: float = 0.0
+    transitions: Dict[str, Timing] = field(default_factory=dict)
+
+    def observe(self, name: str, value: float) -> None:
+        timing: Optional[Timing] = self.transitions.get(name, None)
+        if timing is None:
+            timing = Timing(SIMULATION_BUCKETS)
+            self.transitions[name] = timing
+        timing.observe(value)
+
+    @property
+    def games_per_second(self) -> float:
+        return self.games / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def moves_per_second(self) -> float:
+        return self.moves / self.elapsed if self.elapsed > 0 else 0.0
+
+
+def make_field(people: int = 6, weapons: int = 6, places: int = 9) -> Field:
+    """
+    поле с картами в памяти: комната и карты не сохранены в БД (id комнаты - None)
+    """
+    room: models.CluedoRoom = models.CluedoRoom(name='simulator')
+    return Field(room,
+                 people=[models.CluedoPerson(id=idx + 1, name=f'person{idx + 1}') for idx in range(people)],
+                 weapons=[models.CluedoWeapon(id=idx + 1, name=f'weapon{idx + 1}') for idx in range(weapons)],
+                 places=[models.CluedoPlace(id=idx + 1, name=f'place{idx + 1}') for idx in range(places)])
+
+
+def make_users(room: models.CluedoRoom, players: int) -> List[models.User]:
+    return [models.User(id=idx + 1, chat_id=idx + 1, name=f'bot{idx + 1}', state='GAME', room=room) for idx in range(players)]
+
+
+class Simulator(object):
+    def __init__(self, field_factory: Callable[[], Field] = make_field, max_moves: int = 1000):
+        self.field_factory: Callable[[], Field] = field_factory
+        self.max_moves: int = max_moves
+        self.stats: SimulationStats = SimulationStats()
+
+    async def _timed(self, name: str, func, *args, **kwargs):
+        started: float = time.perf_counter()
+        result = func(*args, **kwargs)
+        if hasattr(result, '__await__'):
+            result = await result
+        self.stats.observe(name, time.perf_counter() - started)
+        return result
+
+    async def _update(self, game: Game, user: models.User, state: str, **kwargs) -> None:
+        user.state = state
+        await self._timed(state, game.update_state, **kwargs)
+
+    async def play(self, players: int, seed: int, bots: Optional[Dict[int, SimulationBot]] = None) -> GameResult:
+        """
+        играет одну игру; bots - боты по id пользователя, для остальных игроков - RandomBot
+        """
+        result: GameResult = GameResult(seed)
+        game_field: Field = self.field_factory()
+        users: List[models.User] = make_users(game_field.room, players)
+        bot_rng: rd.Random = rd.Random(f'{seed}:bots')
+        bots = dict(bots or {})
+        for u in users:
+            bots.setdefault(u.id, RandomBot(bot_rng))
+
+        game: Game = Game(users[0], seed=seed, field=game_field)
+        await self._timed('CREATE', game.create, users)
+
+        while len(result.moves) < self.max_moves:
+            player: Player = game.get_player_whos_turn()
+            if player.user.state == 'GAME_FINISHED':
+                break
+            user: models.User = player.user
+            game.user = user
+
+            await self._update(game, user, 'THROW_DICE')
+            move: Move = bots[user.id].choose_move(game, player)
+            result.moves.append((user.id, move))
+            await self._update(game, user, 'ACCUSE_PERSON', accused_location=move.place)
+            await self._update(game, user, 'ACCUSE_WEAPON', accused_person=move.person)
+            await self._update(game, user, 'CONFIRM_ACCUSE', accused_weapon=move.weapon)
+
+            suspiction: Dict = {'place': move.place, 'person': move.person, 'weapon': move.weapon}
+            if move.accuse:
+                await self._update(game, user, 'CHECK_ACCUSE', suspiction=suspiction)
+                if game.accuse_matches:
+                    result.winner = user.id
+                    break
+                await self._timed('NEXT_TURN', game.update_after_send, user)
+                user.state = 'GAME_FINISHED'
+            else:
+                await self._update(game, user, 'CHECK_SUSPICTION', suspiction=suspiction)
+                player.update_known_cards(game.reflute_players)
+                await self._timed('NEXT_TURN', game.update_after_send, user)
+                user.state = 'GAME'
+
+            if all(p.user.state == 'GAME_FINISHED' for p in game.players):
+                break
+
+        result.finished = result.winner is not None or all(p.user.state == 'GAME_FINISHED' for p in game.players)
+        self.stats.games += 1
+        self.stats.moves += len(result.moves)
+        if result.winner is not None:
+            self.stats.won += 1
+        return result
+
+    async def run(self, games: int, players: int, seed: int = 0) -> SimulationStats:
+        """
+        играет games игр подряд с seed, seed + 1, ... - при одинаковых параметрах игры повторяются
+        """
+        started: float = time.perf_counter()
+        for idx in range(games):
+            await self.play(players, seed + idx)
+        self.stats.elapsed += time.perf_counter() - started
+        return self.stats
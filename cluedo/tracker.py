@@ -0,0 +1,27 @@
+from typing import Set, Tuple
+
+_MISSING = object()
+
+
+class ChangeTracker(object):
+    """
+    запоминает, какие из отслеживаемых атрибутов (tracked_fields) изменились
+    после последнего вызова mark_clean. При сохранении игры записываются только они
+    """
+    tracked_fields: Tuple[str, ...] = ()
+
+    def __setattr__(self, name: str, value) -> None:
+        if name in self.tracked_fields:
+            old_value = self.__dict__.get(name, _MISSING)
+            if old_value is _MISSING or old_value != value:
+                self.__dict__.setdefault('_dirty', set()).add(name)
+        object.__setattr__(self, name, value)
+
+    def get_dirty(self) -> Set[str]:
+        return self.__dict__.get('_dirty', set())
+
+    def is_dirty(self) -> bool:
+        return len(self.get_dirty()) > 0
+
+    def mark_clean(self) -> None:
+        self.__dict__['_dirty'] = set()
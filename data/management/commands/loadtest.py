@@ -0,0 +1,41 @@
+import asyncio
+import logging
+
+from django.core.management.base import BaseCommand, CommandError
+
+from telegram.loadtest import LoadStats, LoadTest, is_test_db, percentile
+from utils.consts import MAX_PLAYERS, MIN_PLAYERS
+
+
+class Command(BaseCommand):
+    help = 'Нагрузочный тест: синтетические игроки комнат через dp и Machine против имитации Bot API. Пишет в БД: запускается только на тестовой БД или с --i-know-this-db-is-disposable'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rooms', type=int, default=1, help='количество одновременно играющих комнат')
+        parser.add_argument('--min-players', type=int, default=MIN_PLAYERS, help='наименьшее число игроков в комнате')
+        parser.add_argument('--max-players', type=int, default=MAX_PLAYERS, help='наибольшее число игроков в комнате')
+        parser.add_argument('--duration', type=float, default=30, help='длительность теста, с')
+        parser.add_argument('--updates', type=int, default=None, help='остановить тест после стольких updates')
+        parser.add_argument('--latency', type=float, default=0.05, help='задержка ответа Bot API, с')
+        parser.add_argument('--think-time', type=float, default=0.0, help='среднее время между нажатиями игрока, с')
+        parser.add_argument('--accuse-probability', type=float, default=0.05, help='вероятность обвинения вместо подозрения')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--i-know-this-db-is-disposable', action='store_true', dest='disposable',
+                            help='разрешить запуск на БД, которая не считается тестовой')
+        parser.add_argument('--log-level', default='WARNING', help='уровень логирования во время теста')
+
+    def handle(self, *args, **options):
+        if not options['disposable'] and not is_test_db():
+            raise CommandError('БД не тестовая: тест создает в ней пользователей и игры. '
+                               'Запустите на отдельной БД (DATABASE_URL) с --i-know-this-db-is-disposable')
+        logging.getLogger().setLevel(options['log_level'])
+        test: LoadTest = LoadTest(options['rooms'], options['min_players'], options['max_players'], options['latency'],
+                                  options['think_time'], options['accuse_probability'], options['seed'], disposable=True)
+        stats: LoadStats = asyncio.run(test.run(options['duration'], options['updates']))
+
+        self.stdout.write(f'updates: {stats.updates} (ошибок: {stats.errors}), время: {stats.elapsed:.1f} с, updates/с: {stats.updates_per_second:.1f}')
+        self.stdout.write(f'время обработки update: p50 {percentile(stats.latencies, 0.5) * 1000:.1f} мс, '
+                          f'p99 {percentile(stats.latencies, 0.99) * 1000:.1f} мс, максимум {max(stats.latencies, default=0) * 1000:.1f} мс')
+        self.stdout.write(f'запросов к БД: {stats.queries}, на update: {stats.queries_per_update:.1f}')
+        self.stdout.write('вызовы Bot API: ' + ', '.join(f'{method}: {count}' for method, count in sorted(test.api.calls.items())) +
+                          f', пропущено неизменных правок: {stats.edits_skipped}, объединено правок: {stats.edits_coalesced}')
@@ -0,0 +1,38 @@
+import asyncio
+
+from django.core.management.base import BaseCommand
+
+from cluedo.simulator import SimulationStats, Simulator
+from utils.consts import MAX_PLAYERS, MIN_PLAYERS
+from utils.metrics import Timing
+
+
+class Command(BaseCommand):
+    help = 'Прогон игр ботами без Telegram и БД: игр/с, ходов/с и гистограммы времени переходов игры'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, default=100, help='количество игр')
+        parser.add_argument('--players', type=int, default=MAX_PLAYERS, choices=range(MIN_PLAYERS, MAX_PLAYERS + 1), help='игроков в игре')
+        parser.add_argument('--seed', type=int, default=0, help='seed первой игры, следующие игры - seed + 1, ...')
+        parser.add_argument('--max-moves', type=int, default=1000, help='наибольшее число ходов в игре')
+
+    def _format_timing(self, name: str, timing: Timing) -> str:
+        mean: float = timing.total / timing.count if timing.count else 0.0
+        lines = [f'{name}: {timing.count} раз, среднее {mean * 1e6:.1f} мкс, максимум {timing.max * 1e6:.1f} мкс']
+        previous: int = 0
+        for bound, count in zip(timing.bounds, timing.buckets):
+            if count > previous:
+                lines.append(f'    <= {bound * 1e6:8.0f} мкс: {count - previous}')
+            previous = count
+        if timing.count > previous:
+            lines.append(f'     > {timing.bounds[-1] * 1e6:8.0f} мкс: {timing.count - previous}')
+        return '\n'.join(lines)
+
+    def handle(self, *args, **options):
+        simulator: Simulator = Simulator(max_moves=options['max_moves'])
+        stats: SimulationStats = asyncio.run(simulator.run(options['games'], options['players'], options['seed']))
+
+        self.stdout.write(f"игр: {stats.games} (с победителем: {stats.won}), ходов: {stats.moves}, время: {stats.elapsed:.3f} с")
+        self.stdout.write(f'игр/с: {stats.games_per_second:.1f}, ходов/с: {stats.moves_per_second:.1f}')
+        for name, timing in stats.transitions.items():
+            self.stdout.write(self._format_timing(name, timing))
@@ -0,0 +1,90 @@
+import copy
+import threading
+from typing import Dict, List, Optional
+
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from utils.cache import SingletonMeta
+from utils.metrics import Metrics
+from . import models
+
+
+class RoomMembers(metaclass=SingletonMeta):
+    """
+    пользователи комнат в памяти: room_id -> {user_id: user}.
+    Комната загружается из БД при первом обращении, дальше индекс обновляется
+    при каждом сохранении пользователя (post_save), в т.ч. из потоков пула БД.
+    Индекс хранит и отдает копии: изменения пользователя в обработчике не попадают
+    в индекс и в списки других обработчиков до сохранения
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rooms: Dict[int, Dict[int, models.User]] = {}
+        self._user_rooms: Dict[int, int] = {}
+        # номер изменения комнаты: загруженный из БД список не заменяет более свежие данные
+        self._generations: Dict[int, int] = {}
+        Metrics().add_collector(self.collect_metrics)
+
+    def get_generation(self, room_id: int) -> int:
+        return self._generations.get(room_id, 0)
+
+    def _touch(self, room_id: Optional[int]) -> None:
+        if room_id is not None:
+            self._generations[room_id] = self._generations.get(room_id, 0) + 1
+
+    def get_members(self, room_id: int) -> Optional[List[models.User]]:
+        with self._lock:
+            members: Optional[Dict[int, models.User]] = self._rooms.get(room_id, None)
+            if members is None:
+                return None
+            return [copy.copy(members[user_id]) for user_id in sorted(members)]
+
+    def set_members(self, room_id: int, users: List[models.User], generation: int) -> None:
+        with self._lock:
+            if self._generations.get(room_id, 0) != generation:
+                return
+            self._rooms[room_id] = {u.id: copy.copy(u) for u in users}
+            for u in users:
+                self._user_rooms[u.id] = room_id
+
+    def update_user(self, user: models.User) -> None:
+        with self._lock:
+            old_room_id: Optional[int] = self._user_rooms.pop(user.id, None)
+            if old_room_id is not None and old_room_id != user.room_id:
+                self._rooms.get(old_room_id, {}).pop(user.id, None)
+                self._touch(old_room_id)
+
+            self._touch(user.room_id)
+            members: Optional[Dict[int, models.User]] = self._rooms.get(user.room_id, None)
+            if members is not None:
+                members[user.id] = copy.copy(user)
+                self._user_rooms[user.id] = user.room_id
+
+    def remove_user(self, user: models.User) -> None:
+        with self._lock:
+            room_id: Optional[int] = self._user_rooms.pop(user.id, None)
+            if room_id is not None:
+                self._rooms.get(room_id, {}).pop(user.id, None)
+                self._touch(room_id)
+
+    def collect_metrics(self, metrics: Metrics) -> None:
+        with self._lock:
+            metrics.set('room_members_rooms', sum(1 for members in self._rooms.values() if members))
+            metrics.set('room_members_users', len(self._user_rooms))
+
+    def invalidate(self, room_id: int) -> None:
+        with self._lock:
+            for user_id in self._rooms.pop(room_id, {}):
+                self._user_rooms.pop(user_id, None)
+            self._touch(room_id)
+
+
+@receiver(post_save, sender=models.User)
+def _user_saved(sender, instance: models.User, **kwargs) -> None:
+    RoomMembers().update_user(instance)
+
+
+@receiver(post_delete, sender=models.User)
+def _user_deleted(sender, instance: models.User, **kwargs) -> None:
+    RoomMembers().remove_user(instance)
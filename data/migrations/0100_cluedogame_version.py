@@ -0,0 +1,18 @@
+# Generated by Django 4.0.2 on 2026-10-18 15:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0099_init'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cluedogame',
+            name='version',
+            field=models.IntegerField(default=0, verbose_name='Версия состояния игры'),
+        ),
+    ]
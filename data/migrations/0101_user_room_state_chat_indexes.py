@@ -0,0 +1,21 @@
+# Generated by Django 4.0.2 on 2026-10-18 15:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0100_cluedogame_version'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['room', 'state'], name='data_user_room_id_7ebd7d_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['chat_id'], name='data_user_chat_id_9e9ac5_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.0.2 on 2026-10-18 15:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0101_user_room_state_chat_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cluedogame',
+            name='dice_throws',
+            field=models.IntegerField(default=0, verbose_name='Количество бросков кубиков в игре'),
+        ),
+        migrations.AddField(
+            model_name='cluedogame',
+            name='seed',
+            field=models.BigIntegerField(blank=True, null=True, verbose_name='Начальное значение генератора случайных чисел игры'),
+        ),
+    ]
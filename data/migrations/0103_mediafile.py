@@ -0,0 +1,31 @@
+# Generated by Django 4.0.2 on 2026-10-18 15:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0102_cluedogame_seed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaFile',
+            fields=[
+                ('id', models.AutoField(primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255, verbose_name='Имя файла в STATIC_ROOT')),
+                ('content_hash', models.CharField(max_length=64, verbose_name='sha256 содержимого файла')),
+                ('file_id', models.CharField(max_length=255, verbose_name='file_id в Telegram')),
+                ('used_at', models.DateTimeField(auto_now=True, verbose_name='Последнее обновление')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='mediafile',
+            index=models.Index(fields=['used_at'], name='data_mediaf_used_at_b5cfdd_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='mediafile',
+            constraint=models.UniqueConstraint(fields=('name', 'content_hash'), name='media_file_name_hash'),
+        ),
+    ]
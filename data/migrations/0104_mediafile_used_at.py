@@ -0,0 +1,18 @@
+# Generated by Django 4.0.2 on 2026-10-18 16:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data', '0103_mediafile'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='mediafile',
+            name='used_at',
+            field=models.DateTimeField(auto_now=True, verbose_name='Последнее использование'),
+        ),
+    ]
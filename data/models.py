@@ -1,11 +1,14 @@
-import functools
-from typing import List
+from typing import List, Tuple
 from unicodedata import name
 from django.db import models
 from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from aiogram import types
 from botstate import states
 from aioutils import sync_to_async
+from utils.refcache import ref_cached
+from .snapshots import LinkedMessageInfo, MessageInfo, RoomInfo
 
 class CluedoGame(models.Model):
     id = models.AutoField(primary_key=True)
@@ -20,6 +23,9 @@ class CluedoGame(models.Model):
     started = models.BooleanField(default=False, verbose_name='игра началась')
     won = models.BooleanField(default=False, verbose_name=' Победа в игре')
     turn_number = models.IntegerField(default=-1, verbose_name='')
+    version = models.IntegerField(default=0, verbose_name='Версия состояния игры')
+    seed = models.BigIntegerField(blank=True, null=True, verbose_name='Начальное значение генератора случайных чисел игры')
+    dice_throws = models.IntegerField(default=0, verbose_name='Количество бросков кубиков в игре')
     winner = models.ForeignKey('User', on_delete=models.CASCADE, blank=True, null=True, verbose_name='Победитель')
 
     accuse_place = models.ForeignKey('CluedoPlace', on_delete=models.CASCADE, blank=True, null=True, verbose_name='Подозрение на место преступления')
@@ -27,32 +33,6 @@ class CluedoGame(models.Model):
     accuse_weapon = models.ForeignKey('CluedoWeapon', on_delete=models.CASCADE, blank=True, null=True, verbose_name='Подозрение на орудие')
 
 
-    @classmethod
-    @sync_to_async
-    def create(cls, old_game: 'CluedoGame'=None, room: 'CluedoRoom'=None, winner: 'User'=None, 
-            secret: str = '', distances: str = '', open_cards:str='', started:bool=False, alive:int=0, won:bool=True,
-            turn_number:int=0,
-            accused_place: 'CluedoPlace' = None, accused_person: 'CluedoPerson'=None, accused_weapon: 'CluedoWeapon'=None) -> 'CluedoGame':
-        if old_game is not None:
-            game: 'CluedoGame' = old_game
-        else:
-            game: 'CluedoGame' = cls()
-        game.room = room
-        game.winner = winner
-        game.secret = secret
-        game.open_cards = open_cards
-        game.distances = distances
-        game.started = started
-        game.alive = alive
-        game.won = won
-        game.turn_number = turn_number
-        game.accuse_place = accused_place
-        game.accuse_person = accused_person
-        game.accuse_weapon = accused_weapon
-
-        game.save()
-        return game
-    
     @sync_to_async
     def async_save(self) -> None:
         self.save()
@@ -72,27 +52,6 @@ class CluedoPlayer(models.Model):
     place = models.ForeignKey('CluedoPlace', on_delete=models.CASCADE, blank=True, null=True, verbose_name='место, в котором находится игрок')
     alias = models.ForeignKey('CluedoPerson', on_delete=models.CASCADE, blank=True, null=True, verbose_name='игровой псевдоним игрока')
 
-    @classmethod
-    @sync_to_async
-    def create(cls, old_player: 'CluedoPlayer'=None, user: 'User'=None, game: CluedoGame=-1, number:int=-1, dice_throw_result:int=None, place: 'CluedoPlace'=None, alias: 'CluedoPerson'=None, alive:bool = True, 
-                    cards: str='', known_cards: str=''):
-        if old_player is not None:
-            player = old_player
-        else:
-            player: 'CluedoPlayer' = cls()
-            player.user = user
-        player.game = game
-        player.number = number
-        player.dice_throw_result = dice_throw_result
-        player.place = place
-        player.alias = alias
-        player.alive = alive
-        player.cards = cards
-        player.known_cards = known_cards
-
-        player.save()
-        return player
-    
     @sync_to_async
     def async_save(self) -> None:
         self.save()
@@ -105,14 +64,9 @@ class CluedoRoom(models.Model):
     game = models.OneToOneField(CluedoGame, on_delete=models.SET_NULL, blank=True, null=True, verbose_name='Игра в комнате')
     
     @staticmethod
-    @functools.lru_cache(maxsize=None)
-    def get_all_rooms() -> 'CluedoRooms':
-        return CluedoRoom.objects.all()
-
-    @staticmethod
-    @functools.lru_cache(maxsize=None)
-    def get_room_by_id(id) -> 'CluedoRoom':
-        return CluedoRoom.objects.get(id=id)
+    @ref_cached('rooms')
+    def get_all_rooms() -> Tuple[RoomInfo, ...]:
+        return tuple(RoomInfo.from_model(room) for room in CluedoRoom.objects.all())
 
     @sync_to_async
     def async_save(self) -> None:
@@ -130,9 +84,13 @@ class CluedoPerson(models.Model):
     room=models.ForeignKey(CluedoRoom, on_delete=models.CASCADE,  verbose_name='Комната')
 
     @staticmethod
-    @functools.lru_cache(maxsize=None)
-    def get_room_people(room: CluedoRoom) -> 'CluedoPeople':
-        return CluedoPerson.objects.filter(room=room).order_by('id')
+    def get_room_people(room: CluedoRoom) -> Tuple['CluedoPerson', ...]:
+        return CluedoPerson._get_room_people(room.id)
+
+    @staticmethod
+    @ref_cached('room_people')
+    def _get_room_people(room_id: int) -> Tuple['CluedoPerson', ...]:
+        return tuple(CluedoPerson.objects.filter(room_id=room_id).order_by('id'))
 
     def get_name_str(self):
         return 'подозреваемый:' + self.name
@@ -148,9 +106,13 @@ class CluedoPlace(models.Model):
     room=models.ForeignKey(CluedoRoom, on_delete=models.CASCADE,  verbose_name='Комната')
 
     @staticmethod
-    @functools.lru_cache(maxsize=None)
-    def get_room_places(room: CluedoRoom) -> 'CluedoPlaces':
-        return CluedoPlace.objects.filter(room=room).order_by('id')
+    def get_room_places(room: CluedoRoom) -> Tuple['CluedoPlace', ...]:
+        return CluedoPlace._get_room_places(room.id)
+
+    @staticmethod
+    @ref_cached('room_places')
+    def _get_room_places(room_id: int) -> Tuple['CluedoPlace', ...]:
+        return tuple(CluedoPlace.objects.filter(room_id=room_id).order_by('id'))
 
     def get_name_str(self):
         return 'место:' + self.name
@@ -165,9 +127,13 @@ class CluedoWeapon(models.Model):
     room=models.ForeignKey(CluedoRoom, on_delete=models.CASCADE,  verbose_name='Комната')
 
     @staticmethod
-    @functools.lru_cache(maxsize=None)
-    def get_room_weapons(room: CluedoRoom) -> 'CluedoWeapons':
-        return CluedoWeapon.objects.filter(room=room).order_by('id')
+    def get_room_weapons(room: CluedoRoom) -> Tuple['CluedoWeapon', ...]:
+        return CluedoWeapon._get_room_weapons(room.id)
+
+    @staticmethod
+    @ref_cached('room_weapons')
+    def _get_room_weapons(room_id: int) -> Tuple['CluedoWeapon', ...]:
+        return tuple(CluedoWeapon.objects.filter(room_id=room_id).order_by('id'))
 
     def get_name_str(self):
         return 'орудие:' + self.name
@@ -186,6 +152,12 @@ class User(models.Model):
     substate = models.IntegerField(null=True, verbose_name='Подстатус')
     room = models.ForeignKey(CluedoRoom, blank=True, null=True, on_delete=models.SET_NULL, verbose_name='Комната')
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'state']),
+            models.Index(fields=['chat_id']),
+        ]
+
     @classmethod
     @sync_to_async
     def create(cls, message: types.Message) -> 'User':
@@ -196,16 +168,6 @@ class User(models.Model):
         user.save()
         return user
 
-    @staticmethod
-    @sync_to_async
-    def get_user_by_chat_id(chat_id: int) -> 'User':
-        return User.objects.get(chat_id=chat_id)
-
-    @staticmethod
-    @sync_to_async
-    def get_all_players_are_not_ready(user) :
-        return User.objects.filter(Q(room=user.room) & ~Q(state='GAME_WAITING') & ~Q(id=user.id))
-
     @sync_to_async
     def async_save(self) -> None:
         self.save()
@@ -225,14 +187,14 @@ class Message(models.Model):
     actions = models.TextField(null=True)
 
     @staticmethod
-    @functools.lru_cache(maxsize=None)
-    def get_message_by_name(name: str) -> 'Messages':
-        return Message.objects.get(name=name)
+    @ref_cached('messages')
+    def get_message_by_name(name: str) -> MessageInfo:
+        return MessageInfo.from_model(Message.objects.get(name=name))
 
     @staticmethod
-    @functools.lru_cache(maxsize=None)
-    def filter_message_by_group(group: str) -> 'Messages':
-        return Message.objects.filter(group=group).order_by('id')
+    @ref_cached('message_groups')
+    def filter_message_by_group(group: str) -> Tuple[MessageInfo, ...]:
+        return tuple(MessageInfo.from_model(message) for message in Message.objects.filter(group=group).order_by('id'))
 
 
 class LinkedMessages(models.Model):
@@ -243,7 +205,60 @@ class LinkedMessages(models.Model):
     group = models.CharField(max_length=255, null=True)
 
     @staticmethod
-    @functools.lru_cache(maxsize=None)
-    def get_linked_message_by_name(name: str) -> 'LinkedMessages':
-        return LinkedMessages.objects.get(name=name)
+    @ref_cached('linked_messages')
+    def get_linked_message_by_name(name: str) -> LinkedMessageInfo:
+        return LinkedMessageInfo.from_model(LinkedMessages.objects.get(name=name))
+
+
+class MediaFile(models.Model):
+    """
+    file_id картинки, уже загруженной в Telegram: по нему картинка отправляется без повторной загрузки
+    """
+    id = models.AutoField(primary_key=True)
 
+    name = models.CharField(max_length=255, verbose_name='Имя файла в STATIC_ROOT')
+    content_hash = models.CharField(max_length=64, verbose_name='sha256 содержимого файла')
+    file_id = models.CharField(max_length=255, verbose_name='file_id в Telegram')
+    # обновляется при сохранении и при поиске записи в БД; отправки по file_id из кэша в памяти его не обновляют
+    used_at = models.DateTimeField(auto_now=True, verbose_name='Последнее использование')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'content_hash'], name='media_file_name_hash'),
+        ]
+        indexes = [
+            models.Index(fields=['used_at']),
+        ]
+
+
+
+# справочные данные изменяются редко (через админку или скрипты) - сбрасываем их кэш при изменении
+
+@receiver([post_save, post_delete], sender=CluedoRoom)
+def _room_changed(sender, instance: CluedoRoom, update_fields=None, **kwargs) -> None:
+    if update_fields is None or 'name' in update_fields:
+        CluedoRoom.get_all_rooms.cache.invalidate()
+
+@receiver([post_save, post_delete], sender=CluedoPerson)
+@receiver([post_save, post_delete], sender=CluedoPlace)
+@receiver([post_save, post_delete], sender=CluedoWeapon)
+def _card_changed(sender, instance, **kwargs) -> None:
+    loaders = {
+        CluedoPerson: CluedoPerson._get_room_people,
+        CluedoPlace: CluedoPlace._get_room_places,
+        CluedoWeapon: CluedoWeapon._get_room_weapons,
+    }
+    loaders[sender].cache.invalidate((instance.room_id, ))
+    # каталог карт комнаты нумерует карты по списку карт - после изменения его надо собрать заново.
+    # cluedo.catalog импортирует модели, поэтому импорт здесь, а не в начале модуля
+    from cluedo.catalog import invalidate_room_catalog
+    invalidate_room_catalog(instance.room_id)
+
+@receiver([post_save, post_delete], sender=Message)
+def _message_changed(sender, instance: Message, **kwargs) -> None:
+    Message.get_message_by_name.cache.invalidate()
+    Message.filter_message_by_group.cache.invalidate()
+
+@receiver([post_save, post_delete], sender=LinkedMessages)
+def _linked_message_changed(sender, instance: LinkedMessages, **kwargs) -> None:
+    LinkedMessages.get_linked_message_by_name.cache.invalidate()
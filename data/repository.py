@@ -0,0 +1,179 @@
+"""
+асинхронный доступ к данным для обработчиков бота.
+Запросы выполняются в пуле потоков БД (см. aioutils) и не блокируют event loop.
+Связанные объекты, которые нужны обработчикам, загружаются сразу (select_related),
+чтобы обращение к ним в event loop не приводило к новым запросам
+"""
+from typing import Dict, List, Optional, Tuple
+
+from django.db import transaction
+from django.utils import timezone
+from django.db.models import Model
+
+from aioutils import sync_to_async
+from . import models
+from .members import RoomMembers
+from .snapshots import LinkedMessageInfo, MessageInfo, RoomInfo
+
+
+class GameConflict(Exception):
+    """
+    игра изменена в БД другим обработчиком после того, как была загружена
+    """
+    pass
+
+
+@sync_to_async
+def get_user_by_chat_id(chat_id: int) -> models.User:
+    return models.User.objects.select_related('room', 'room__game').get(chat_id=chat_id)
+
+@sync_to_async
+def get_room(room_id: int) -> models.CluedoRoom:
+    return models.CluedoRoom.objects.select_related('game').get(id=room_id)
+
+@sync_to_async
+def get_rooms() -> List[RoomInfo]:
+    return list(models.CluedoRoom.get_all_rooms())
+
+@sync_to_async
+def _load_room_users(room_id: int) -> List[models.User]:
+    return list(models.User.objects.filter(room_id=room_id).select_related('room').order_by('id'))
+
+async def get_room_users(room: models.CluedoRoom) -> List[models.User]:
+    """
+    пользователи комнаты из индекса RoomMembers, при первом обращении к комнате - из БД
+    """
+    users: Optional[List[models.User]] = RoomMembers().get_members(room.id)
+    if users is None:
+        generation: int = RoomMembers().get_generation(room.id)
+        users = await _load_room_users(room.id)
+        RoomMembers().set_members(room.id, users, generation)
+    return users
+
+async def get_other_room_users(user: models.User) -> List[models.User]:
+    return [u for u in await get_room_users(user.room) if u.id != user.id]
+
+async def get_all_players_are_not_ready(user: models.User) -> List[models.User]:
+    return [u for u in await get_room_users(user.room) if u.state != 'GAME_WAITING' and u.id != user.id]
+
+@sync_to_async
+def get_linked_message(name: str) -> LinkedMessageInfo:
+    return models.LinkedMessages.get_linked_message_by_name(name)
+
+@sync_to_async
+def get_message_list(group: str) -> Tuple[MessageInfo, ...]:
+    return tuple(sorted(models.Message.filter_message_by_group(group), key=lambda x: x.order))
+
+def _assign_changed(row: Model, values: Dict) -> List[str]:
+    """
+    присваивает строке новые значения полей и возвращает имена изменившихся полей.
+    Внешние ключи сравниваются по id, без загрузки связанных объектов
+    """
+    changed: List[str] = []
+    for name, value in values.items():
+        field = row._meta.get_field(name)
+        if field.is_relation:
+            old_value = getattr(row, field.attname)
+            new_value = value.pk if value is not None else None
+        else:
+            old_value = getattr(row, name)
+            new_value = value
+        if old_value != new_value:
+            setattr(row, name, value)
+            changed.append(name)
+    return changed
+
+@sync_to_async
+def save_game(room: models.CluedoRoom, game_row: Optional[models.CluedoGame], game_values: Dict,
+              players: List[Tuple[Optional[models.CluedoPlayer], Dict]]) -> Tuple[models.CluedoGame, List[models.CluedoPlayer]]:
+    """
+    сохраняет игру, ее игроков и ссылку комнаты на игру в одной транзакции.
+    В существующие строки записываются только изменившиеся поля (игроки - одним bulk_update),
+    версия игры увеличивается, только если изменилась игра или кто-то из ее игроков.
+    Изменения записываются, только если версия игры в БД не изменилась с загрузки,
+    иначе транзакция откатывается и выбрасывается GameConflict
+    """
+    with transaction.atomic():
+        created: bool = game_row is None
+        changed: List[str] = []
+        if created:
+            game_row = models.CluedoGame(**game_values)
+            game_row.version += 1
+            game_row.save()
+        else:
+            changed = _assign_changed(game_row, game_values)
+
+        new_rows: List[models.CluedoPlayer] = []
+        updated_rows: List[models.CluedoPlayer] = []
+        updated_fields: List[str] = []
+        player_rows: List[models.CluedoPlayer] = []
+        for player_row, values in players:
+            if player_row is None:
+                player_row = models.CluedoPlayer(game=game_row, **values)
+                new_rows.append(player_row)
+            else:
+                player_changed: List[str] = _assign_changed(player_row, dict(values, game=game_row))
+                if player_changed:
+                    updated_rows.append(player_row)
+                    updated_fields.extend(f for f in player_changed if f not in updated_fields)
+            player_rows.append(player_row)
+
+        if not created and (changed or new_rows or updated_rows):
+            # сначала запись строки игры: она проверяет версию и блокирует БД до конца транзакции
+            expected: int = game_row.version
+            updated: int = models.CluedoGame.objects.filter(id=game_row.id, version=expected).update(
+                version=expected + 1, **{name: getattr(game_row, name) for name in changed})
+            if updated == 0:
+                raise GameConflict(f'game {game_row.id} version {expected} is stale')
+            game_row.version = expected + 1
+
+        for player_row in new_rows:
+            player_row.save()
+        if updated_rows:
+            models.CluedoPlayer.objects.bulk_update(updated_rows, updated_fields)
+
+        if room.game_id != game_row.id:
+            room.game = game_row
+            room.save(update_fields=['game'])
+
+    return game_row, player_rows
+
+@sync_to_async
+def get_media_messages() -> Tuple[MessageInfo, ...]:
+    return tuple(MessageInfo.from_model(message) for message in models.Message.objects.exclude(media_name=None).exclude(media_name='').order_by('id'))
+
+@sync_to_async
+def get_media_files(limit: int) -> List[Tuple[str, str, str]]:
+    """
+    последние limit сохраненных file_id (имя, хэш, file_id), от давних к недавним
+    """
+    rows = models.MediaFile.objects.order_by('-used_at').values_list('name', 'content_hash', 'file_id')[:limit]
+    return list(reversed(rows))
+
+@sync_to_async
+def find_media_file(name: str, content_hash: str) -> Optional[str]:
+    """
+    file_id файла с данным содержимым. Найденная запись отмечается использованной (used_at),
+    чтобы ее не вытеснили из limit самых свежих
+    """
+    with transaction.atomic():
+        # сначала запись, как и в save_media_file
+        rows = models.MediaFile.objects.filter(name=name, content_hash=content_hash)
+        if not rows.update(used_at=timezone.now()):
+            return None
+        return rows.values_list('file_id', flat=True).first()
+
+@sync_to_async
+def save_media_file(name: str, content_hash: str, file_id: str, limit: int) -> None:
+    """
+    сохраняет file_id файла. Записи прежнего содержимого файла удаляются,
+    из остальных остаются limit самых свежих
+    """
+    with transaction.atomic():
+        # транзакция начинается с записи: в sqlite переход от чтения к записи при конкурентных
+        # транзакциях сразу завершается ошибкой database is locked, а запись ждет освобождения БД
+        models.MediaFile.objects.filter(name=name).exclude(content_hash=content_hash).delete()
+        models.MediaFile.objects.update_or_create(name=name, content_hash=content_hash, defaults={'file_id': file_id})
+        stale: List[int] = list(models.MediaFile.objects.order_by('-used_at').values_list('id', flat=True)[limit:])
+        if stale:
+            models.MediaFile.objects.filter(id__in=stale).delete()
@@ -0,0 +1,45 @@
+"""
+неизменяемые копии справочных строк БД, которые хранятся в RefCache
+и могут одновременно использоваться разными играми
+"""
+from dataclasses import dataclass
+from typing import Optional
+
+@dataclass(frozen=True)
+class RoomInfo:
+    id: int
+    name: str
+
+    @classmethod
+    def from_model(cls, room) -> 'RoomInfo':
+        return cls(id=room.id, name=room.name)
+
+    def __str__(self):
+        return self.name
+
+
+@dataclass(frozen=True)
+class MessageInfo:
+    id: int
+    name: str
+    text_content: Optional[str]
+    media_name: Optional[str]
+    group: Optional[str]
+    order: Optional[int]
+    actions: Optional[str]
+
+    @classmethod
+    def from_model(cls, message) -> 'MessageInfo':
+        return cls(id=message.id, name=message.name, text_content=message.text_content, media_name=message.media_name,
+                   group=message.group, order=message.order, actions=message.actions)
+
+
+@dataclass(frozen=True)
+class LinkedMessageInfo:
+    id: int
+    name: str
+    group: Optional[str]
+
+    @classmethod
+    def from_model(cls, linked_message) -> 'LinkedMessageInfo':
+        return cls(id=linked_message.id, name=linked_message.name, group=linked_message.group)
@@ -1,17 +1,26 @@
-from aiogram import Bot, Dispatcher, types
+from aiogram import Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 
-from settings import API_TOKEN
+from settings import API_TOKEN, TG_API_SERVER
 
 from django.core.wsgi import get_wsgi_application  # Джанговские штуки, чтоб использовать ORM
 _django_app = get_wsgi_application()  # Джанговские штуки, чтоб использовать ORM
 
 from botstate import machine
+from telegram.bot import InstrumentedBot
+from telegram.middleware import UpdateTraceMiddleware
+from utils.tracing import install_query_wrapper
 
 
-bot: Bot = Bot(token=API_TOKEN)
+if TG_API_SERVER:
+    bot: InstrumentedBot = InstrumentedBot(token=API_TOKEN, server=TelegramAPIServer.from_base(TG_API_SERVER))
+else:
+    bot: InstrumentedBot = InstrumentedBot(token=API_TOKEN)
 
 dp: Dispatcher = Dispatcher(bot)
 dp.middleware.setup(LoggingMiddleware())
+dp.middleware.setup(UpdateTraceMiddleware())
+install_query_wrapper()
 
 engine: machine.Machine = machine.Machine(bot, None)
\ No newline at end of file
@@ -16,7 +16,6 @@ root_logger.setLevel(logging.INFO)
 
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
-os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
@@ -31,11 +30,10 @@ with open(CONFIG_PATH, 'r') as f:
 SERVER_TYPE = config_yaml['server']['type']
 
 if SERVER_TYPE == 'selfhosted':
+    # по умолчанию - локальный db.sqlite3 (не хранится в git), DATABASE_URL задает другую БД,
+    # например одноразовую для нагрузочного теста
     DATABASES = {
-        'default': {
-            'ENGINE': 'django.db.backends.sqlite3',
-            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-        }
+        'default': dj_database_url.config(default='sqlite:///' + os.path.join(BASE_DIR, 'db.sqlite3')),
     }
 elif SERVER_TYPE == 'heroku':
     DATABASES = {
@@ -47,6 +45,19 @@ elif SERVER_TYPE == 'heroku':
     db_from_env = dj_database_url.config(conn_max_age=500)
     DATABASES['default'].update(db_from_env)
 
+# пул потоков для запросов к БД (у каждого потока свое соединение с БД):
+# число потоков, длина очереди, поведение при заполненной очереди (wait/reject)
+# и переиспользование соединения потока между запросами
+DB_MAX_CONNECTIONS = config_yaml.get('db', {}).get('max_connections', 4)
+DB_MAX_QUEUE = config_yaml.get('db', {}).get('max_queue', 64)
+DB_SATURATION_POLICY = config_yaml.get('db', {}).get('saturation_policy', 'wait')
+DB_REUSE_CONNECTIONS = config_yaml.get('db', {}).get('reuse_connections', True)
+
+# строгий режим (для отладки): запрос к БД из потока event loop вызывает SynchronousOnlyOperation
+DB_STRICT_ASYNC = config_yaml.get('db', {}).get('strict_async', False)
+if not DB_STRICT_ASYNC:
+    os.environ["DJANGO_ALLOW_ASYNC_UNSAFE"] = "true"
+
 INSTALLED_APPS = (
     'data',
 )
@@ -60,6 +71,20 @@ WEBHOOK_PORT = config_yaml['telegram']['webhook_port']
 WEBHOOK_CERT = config_yaml['telegram']['webhook_cert']
 WEBHOOK_KEY = config_yaml['telegram']['webhook_key']
 
+# ограничения Telegram на частоту запросов: всего в секунду и в один чат в секунду
+TG_GLOBAL_RATE = config_yaml['telegram'].get('global_rate', 30)
+TG_CHAT_RATE = config_yaml['telegram'].get('chat_rate', 1)
+TG_CHAT_BURST = config_yaml['telegram'].get('chat_burst', 3)
+TG_RETRY_LIMIT = config_yaml['telegram'].get('retry_limit', 3)
+# адрес Bot API (свой сервер Bot API или имитация для нагрузочного теста), по умолчанию - api.telegram.org
+TG_API_SERVER = config_yaml['telegram'].get('api_server', None)
+# служебный чат, в который при старте загружаются картинки сообщений (не задан - картинки не загружаются заранее),
+# сколько картинок загружается одновременно и ограничение частоты сообщений в этот чат
+# (в группу - не более 20 сообщений в минуту)
+MEDIA_PREWARM_CHAT = config_yaml['telegram'].get('media_prewarm_chat', None)
+MEDIA_PREWARM_CONCURRENCY = config_yaml['telegram'].get('media_prewarm_concurrency', 4)
+MEDIA_PREWARM_RATE = config_yaml['telegram'].get('media_prewarm_rate', 20 / 60)
+
 
 # webserver settings
 WEBAPP_HOST = config_yaml['server']['host']
@@ -72,5 +97,20 @@ ALLOWED_HOSTS = config_yaml['django']['allowed_hosts']
 
 LOG_FILE = config_yaml['server']['log_file']
 
+# кэш справочных данных (комнаты, карты, сообщения): число записей и время жизни записи в секундах
+REF_CACHE_SIZE = config_yaml.get('cache', {}).get('ref_size', 256)
+REF_CACHE_TTL = config_yaml.get('cache', {}).get('ref_ttl', 600)
+# сколько file_id загруженных картинок хранится в памяти и в БД
+MEDIA_CACHE_SIZE = config_yaml.get('cache', {}).get('media_size', 256)
+
+# время (в секундах), после которого неактивная игра выгружается из памяти
+GAME_IDLE_TIMEOUT = config_yaml['server'].get('game_idle_timeout', 30 * 60)
+
+# время обработки update (в секундах), после которого она попадает в лог как медленная
+SLOW_UPDATE_THRESHOLD = config_yaml['server'].get('slow_update_threshold', 1.0)
+
+# адрес, по которому webhook-сервер отдает метрики в формате Prometheus (пусто - не отдает)
+METRICS_PATH = config_yaml['server'].get('metrics_path', '/metrics')
+
 WEBHOOK_URL = f"{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}"
 
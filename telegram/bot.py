@@ -0,0 +1,31 @@
+import time
+from typing import Dict, List, Optional, Union
+
+from aiogram import Bot
+
+from utils import Metrics
+from utils.tracing import UpdateTrace, get_trace
+
+
+class InstrumentedBot(Bot):
+    """
+    Bot, который измеряет время и считает ошибки каждого вызова Bot API по методам
+    и относит вызов к update, при обработке которого он сделан. Фоновые вызовы
+    учитываются отдельно, в tg_background_api_seconds
+    """
+    async def request(self, method: str, data: Optional[Dict] = None, files: Optional[Dict] = None, **kwargs) -> Union[List, Dict, bool]:
+        started: float = time.monotonic()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as ex:
+            Metrics().inc('tg_api_errors_total', method=method, error=type(ex).__name__)
+            raise
+        finally:
+            duration: float = time.monotonic() - started
+            Metrics().observe('tg_api_seconds', duration, method=method)
+            trace: Optional[UpdateTrace] = get_trace()
+            if trace is not None:
+                trace.add_api_call(duration)
+            else:
+                # вызовы вне обработки update: фоновые рассылки другим игрокам, загрузка картинок при старте
+                Metrics().observe('tg_background_api_seconds', duration, method=method)
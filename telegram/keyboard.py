@@ -4,17 +4,26 @@ from aiogram import Bot, Dispatcher, executor, types
 from cluedo.game import Game, Player
 
 from data import models
+from data.snapshots import RoomInfo
+from utils.refcache import ref_cached
+
+# клавиатура, собранная заранее: JSON разметки передается в Bot API без повторной сериализации
+CompiledMarkup = str
 
 
 class SimpleKeyboard(object):
 
     @staticmethod
     def get_markup_dict(message: models.Message) -> Dict:
+        return SimpleKeyboard.parse_actions(message.actions)
+
+    @staticmethod
+    def parse_actions(actions: str) -> Dict:
         def _parse_key(x):
             kk = x.split(':')
             return {'row':int(kk[0][1:]), 'col': int(kk[1][1:]), 'key':x}
 
-        markup =  json.loads(message.actions)
+        markup =  json.loads(actions)
         markup_rows = {}
         if markup is not None:
             markup_keys = map(lambda x: _parse_key(x), markup.keys())
@@ -28,51 +37,74 @@ class SimpleKeyboard(object):
         return markup_rows
 
     @staticmethod
-    def get_markup(message: models.Message) -> types.InlineKeyboardMarkup:
+    def build_markup(actions: str) -> types.InlineKeyboardMarkup:
 
         keyboard_markup: types.InlineKeyboardMarkup = types.InlineKeyboardMarkup(
             row_width=3)
 
-        markup_rows = SimpleKeyboard.get_markup_dict(message)
+        markup_rows = SimpleKeyboard.parse_actions(actions)
 
         for r in range(len(markup_rows)):
             keyboard_markup.row(*markup_rows[r])
 
-        return keyboard_markup, types.ParseMode.MARKDOWN
-
-class RoomsKeyboard(object):
+        return keyboard_markup
 
     @staticmethod
-    def get_markup(message: models.Message) -> types.InlineKeyboardMarkup:
-        keyboard_markup, _ = SimpleKeyboard.get_markup(message)
-        rooms = models.CluedoRoom.get_all_rooms()
-        markup_rows = {}
-        for idx, room in enumerate(rooms):
-            r = markup_rows.get(idx, None)
-            if r is None:
-                markup_rows[idx] = []
-            markup_rows[idx].append(types.InlineKeyboardButton(f'Комната: {room.name}', callback_data=f'{{"room": {room.id}}}'))
+    def get_markup(message: models.Message) -> Tuple[CompiledMarkup, str]:
+        return _compile_actions(message.actions), types.ParseMode.MARKDOWN
 
-        for r in range(len(markup_rows)):
-            keyboard_markup.row(*markup_rows[r])
+@ref_cached('keyboards', ttl=0)
+def _compile_actions(actions: str) -> CompiledMarkup:
+    """
+    клавиатура сообщения по его actions. Ключ кэша - сам текст actions,
+    поэтому после изменения строки Message собирается новая клавиатура
+    """
+    return SimpleKeyboard.build_markup(actions).as_json()
 
-        return keyboard_markup, types.ParseMode.HTML
+class RoomsKeyboard(object):
+
+    @staticmethod
+    def get_markup(message: models.Message, rooms: List[RoomInfo]) -> Tuple[CompiledMarkup, str]:
+        return _compile_rooms(message.actions, tuple(rooms)), types.ParseMode.HTML
+
+@ref_cached('rooms_keyboards', ttl=0)
+def _compile_rooms(actions: str, rooms: Tuple[RoomInfo, ...]) -> CompiledMarkup:
+    """
+    клавиатура выбора комнаты. Список комнат кэшируется в CluedoRoom.get_all_rooms
+    и сбрасывается при изменении комнат - тогда меняется и ключ этого кэша
+    """
+    keyboard_markup: types.InlineKeyboardMarkup = SimpleKeyboard.build_markup(actions)
+    markup_rows = {}
+    for idx, room in enumerate(rooms):
+        r = markup_rows.get(idx, None)
+        if r is None:
+            markup_rows[idx] = []
+        markup_rows[idx].append(types.InlineKeyboardButton(f'Комната: {room.name}', callback_data=f'{{"room": {room.id}}}'))
+
+    for r in range(len(markup_rows)):
+        keyboard_markup.row(*markup_rows[r])
+
+    return keyboard_markup.as_json()
 
 class RoomKeyboard(object):
 
     @staticmethod
-    def get_markup(message: models.Message, room) -> types.InlineKeyboardMarkup:
-        keyboard_markup: types.InlineKeyboardMarkup = types.InlineKeyboardMarkup(
-            row_width=3)
-        
-        markup_rows = {0:[], 1:[]}
-        markup_rows[0].append(types.InlineKeyboardButton('СТАРТ', callback_data=f'{{"room": {room.id}}}'))
-        markup_rows[1].append(types.InlineKeyboardButton('выйти из комнаты', callback_data='to_rooms'))
+    def get_markup(message: models.Message, room) -> Tuple[CompiledMarkup, str]:
+        return _compile_room(room.id), types.ParseMode.HTML
 
-        for r in range(len(markup_rows)):
-            keyboard_markup.row(*markup_rows[r])
+@ref_cached('room_keyboards', ttl=0)
+def _compile_room(room_id: int) -> CompiledMarkup:
+    keyboard_markup: types.InlineKeyboardMarkup = types.InlineKeyboardMarkup(
+        row_width=3)
 
-        return keyboard_markup, types.ParseMode.HTML
+    markup_rows = {0:[], 1:[]}
+    markup_rows[0].append(types.InlineKeyboardButton('СТАРТ', callback_data=f'{{"room": {room_id}}}'))
+    markup_rows[1].append(types.InlineKeyboardButton('выйти из комнаты', callback_data='to_rooms'))
+
+    for r in range(len(markup_rows)):
+        keyboard_markup.row(*markup_rows[r])
+
+    return keyboard_markup.as_json()
 
 class PlayerTurnKeyboard(object):
     @staticmethod
@@ -0,0 +1,350 @@
+"""
+нагрузочный тест бота: синтетические игроки комнат нажимают кнопки из полученных сообщений,
+их updates проходят через dp из handlers/handler.py и Machine. Запросы к Bot API принимает
+имитация Bot API (FakeTelegramAPI) с заданной задержкой ответа
+"""
+import os
+import asyncio
+import json
+import logging
+import random as rd
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+from django.db import connections, transaction
+
+import settings
+from aioutils import sync_to_async
+from data import models
+from utils import Metrics
+from telegram.sender import Sender
+
+# chat_id синтетических игроков выбираются среди свободных, начиная с LOAD_CHAT_BASE
+LOAD_CHAT_BASE = 1900000000
+# методы Bot API, которые возвращают отправленное или измененное сообщение
+MESSAGE_METHODS = ('sendmessage', 'sendphoto', 'editmessagetext', 'editmessagecaption', 'editmessagemedia', 'editmessagereplymarkup')
+# порядок, в котором игрок выбирает действия в игре. Выход из игры и комнаты,
+# показ состояния и ожидание игрок не нажимает
+GAME_ACTIONS = ('to_game', 'throw_dice', 'select_place', 'new_location', 'accused_person', 'accused_weapon', 'suspiction')
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered: List[float] = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class FakeTelegramAPI(object):
+    """
+    имитация Bot API: отвечает на каждый запрос через latency секунд,
+    считает вызовы по методам и запоминает последнюю клавиатуру каждого чата.
+    Как и Telegram, не дает изменить чужое сообщение и сообщение без изменений
+    """
+    def __init__(self, latency: float = 0.05):
+        self.latency: float = latency
+        self.calls: Dict[str, int] = {}
+        # chat_id -> (message_id, callback_data кнопок последнего сообщения с клавиатурой)
+        self.keyboards: Dict[int, Tuple[int, List[str]]] = {}
+        self.events: Dict[int, asyncio.Event] = {}
+        self._message_ids: Dict[int, int] = {}
+        # (chat_id, message_id) -> (текст, клавиатура) сообщений бота
+        self._contents: Dict[Tuple[int, int], Tuple[str, str]] = {}
+        self._runner: Optional[web.AppRunner] = None
+        self.url: Optional[str] = None
+
+    def get_event(self, chat_id: int) -> asyncio.Event:
+        event: Optional[asyncio.Event] = self.events.get(chat_id, None)
+        if event is None:
+            event = asyncio.Event()
+            self.events[chat_id] = event
+        return event
+
+    def next_message_id(self, chat_id: int) -> int:
+        message_id: int = self._message_ids.get(chat_id, 0) + 1
+        self._message_ids[chat_id] = message_id
+        return message_id
+
+    def _error(self, description: str) -> web.Response:
+        self.calls['errors'] = self.calls.get('errors', 0) + 1
+        return web.json_response({'ok': False, 'error_code': 400, 'description': f'Bad Request: {description}'}, status=400)
+
+    def _message(self, method: str, data) -> Dict:
+        chat_id: int = int(data['chat_id'])
+        if method.startswith('send'):
+            message_id: int = self.next_message_id(chat_id)
+        else:
+            message_id = int(data['message_id'])
+        self._contents[(chat_id, message_id)] = (data.get('text', data.get('caption', '')), data.get('reply_markup', ''))
+
+        if 'reply_markup' in data:
+            markup: Dict = json.loads(data['reply_markup'])
+            buttons: List[str] = [b['callback_data'] for row in markup.get('inline_keyboard', []) for b in row if 'callback_data' in b]
+            self.keyboards[chat_id] = (message_id, buttons)
+            self.get_event(chat_id).set()
+
+        message: Dict = {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}
+        if method == 'sendphoto':
+            message['photo'] = [{'file_id': f'load-{message_id}', 'file_unique_id': f'load-{message_id}', 'width': 1, 'height': 1}]
+            message['caption'] = data.get('caption', '')
+        else:
+            message['text'] = data.get('text', '')
+        return message
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method: str = request.match_info['method'].lower()
+        data = await request.post()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        await asyncio.sleep(self.latency)
+        if method.startswith('edit') and 'chat_id' in data:
+            content: Optional[Tuple[str, str]] = self._contents.get((int(data['chat_id']), int(data['message_id'])), None)
+            if content is None:
+                return self._error("message can't be edited")
+            if content == (data.get('text', data.get('caption', '')), data.get('reply_markup', '')):
+                return self._error('message is not modified: specified new message content and reply markup are exactly the same as a current content and reply markup of the message')
+        if method in MESSAGE_METHODS:
+            result = self._message(method, data)
+        elif method == 'getme':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'cluedo', 'username': 'cluedo_load_bot'}
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        app: web.Application = web.Application()
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site: web.TCPSite = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://{host}:{port}'
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+def is_test_db() -> bool:
+    """
+    БД создана для тестов: sqlite в памяти или БД с именем test_* (как у тестовых БД Django)
+    """
+    name: str = str(connections['default'].settings_dict.get('NAME') or '')
+    return name == ':memory:' or 'mode=memory' in name or os.path.basename(name).startswith('test_')
+
+
+@dataclass
+class LoadStats:
+    updates: int = 0
+    errors: int = 0
+    queries: int = 0
+    edits_skipped: int = 0
+    edits_coalesced: int = 0
+    elapsed: float = 0.0
+    latencies: List[float] = field(default_factory=list)
+
+    @property
+    def updates_per_second(self) -> float:
+        return self.updates / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def queries_per_update(self) -> float:
+        return self.queries / self.updates if self.updates else 0.0
+
+
+class SyntheticPlayer(object):
+    """
+    игрок комнаты room_id: заходит в комнату и играет, нажимая кнопки последнего полученного сообщения
+    """
+    def __init__(self, test: 'LoadTest', chat_id: int, room_id: int, rng: rd.Random):
+        self.test: 'LoadTest' = test
+        self.chat_id: int = chat_id
+        self.room_id: int = room_id
+        self.rng: rd.Random = rng
+        self.user: Dict = {'id': chat_id, 'is_bot': False, 'first_name': f'load{chat_id}', 'username': f'load{chat_id}'}
+
+    def choose_action(self, buttons: List[str]) -> Optional[str]:
+        room: str = json.dumps({'room': self.room_id})
+        if room in buttons:
+            if 'to_rooms' in buttons:
+                # кнопка СТАРТ в комнате: игра начинается, когда в комнату зашли все ее игроки
+                self.test.joined.add(self.chat_id)
+                if not self.test.is_room_joined(self.room_id):
+                    return None
+            return room
+        accuse: List[str] = [b for b in buttons if b.startswith('{"accuse"')]
+        if accuse and self.rng.random() < self.test.accuse_probability:
+            return accuse[0]
+        for action in GAME_ACTIONS:
+            matched: List[str] = [b for b in buttons if b == action or b.startswith(f'{{"{action}"')]
+            if matched:
+                return self.rng.choice(matched)
+        for action in ('to_rooms', 'to_exit', 'next'):
+            if action in buttons:
+                return action
+        return None
+
+    def _message(self, message_id: int, text: Optional[str] = None) -> Dict:
+        message: Dict = {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': self.chat_id, 'type': 'private'}, 'from': self.user}
+        if text is not None:
+            message['text'] = text
+        return message
+
+    async def run(self) -> None:
+        api: FakeTelegramAPI = self.test.api
+        event: asyncio.Event = api.get_event(self.chat_id)
+        await self.test.process({'message': self._message(api.next_message_id(self.chat_id), '/start')})
+        while not self.test.stopped.is_set():
+            message_id, buttons = api.keyboards.get(self.chat_id, (0, []))
+            action: Optional[str] = self.choose_action(buttons)
+            if action is None:
+                # ждем нового сообщения (например, хода другого игрока)
+                event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            event.clear()
+            if self.test.think_time > 0:
+                await asyncio.sleep(self.rng.uniform(0, 2 * self.test.think_time))
+            await self.test.process({'callback_query': {'id': str(self.test.next_update_id()), 'from': self.user,
+                                                        'chat_instance': str(self.chat_id), 'data': action,
+                                                        'message': self._message(message_id)}})
+            if api.keyboards.get(self.chat_id, (0, []))[1] == buttons and not event.is_set():
+                # нажатие ничего не изменило - ждем, пока что-нибудь не изменится
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+
+
+class LoadTest(object):
+    """
+    rooms комнат по min_players..max_players синтетических игроков.
+    Тест пишет в БД, поэтому запускается только на тестовой БД или с disposable=True.
+    Играет только в комнатах без пользователей и без игры, после теста удаляет
+    только созданных им пользователей и игры
+    """
+    def __init__(self, rooms: int, min_players: int, max_players: int, latency: float = 0.05,
+                 think_time: float = 0.0, accuse_probability: float = 0.05, seed: int = 0, disposable: bool = False):
+        self.disposable: bool = disposable
+        self.rooms: int = rooms
+        self.min_players: int = min_players
+        self.max_players: int = max_players
+        self.think_time: float = think_time
+        self.accuse_probability: float = accuse_probability
+        self.rng: rd.Random = rd.Random(seed)
+        self.api: FakeTelegramAPI = FakeTelegramAPI(latency)
+        self.stats: LoadStats = LoadStats()
+        self.stopped: asyncio.Event = asyncio.Event()
+        self.dp: Optional[Dispatcher] = None
+        self._update_id: int = 0
+        # room_id -> chat_id игроков комнаты и chat_id игроков, уже зашедших в свою комнату
+        self.room_players: Dict[int, List[int]] = {}
+        self.joined: Set[int] = set()
+
+    def is_room_joined(self, room_id: int) -> bool:
+        return all(chat_id in self.joined for chat_id in self.room_players[room_id])
+
+    def next_update_id(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    async def process(self, update: Dict) -> None:
+        update['update_id'] = self.next_update_id()
+        started: float = time.perf_counter()
+        try:
+            # как при webhook: через updates_handler, с middleware уровня update
+            await self.dp.updates_handler.notify(types.Update(**update))
+        except Exception:
+            self.stats.errors += 1
+            logging.exception('load test: update failed')
+        self.stats.latencies.append(time.perf_counter() - started)
+        self.stats.updates += 1
+
+    @sync_to_async
+    def _get_room_ids(self) -> List[int]:
+        """
+        комнаты без пользователей и без игры: иначе игра в комнате не начнется,
+        а очистка после теста затронет чужие данные
+        """
+        busy = set(models.User.objects.filter(room__isnull=False).values_list('room_id', flat=True))
+        return [room.id for room in models.CluedoRoom.objects.filter(game__isnull=True).order_by('id') if room.id not in busy][:self.rooms]
+
+    @sync_to_async
+    def _get_free_chat_ids(self, count: int) -> List[int]:
+        """
+        count chat_id от LOAD_CHAT_BASE, которых нет в БД: пользователей с ними создаст тест
+        """
+        chat_ids: List[int] = []
+        candidate: int = LOAD_CHAT_BASE
+        while len(chat_ids) < count:
+            batch: List[int] = list(range(candidate, candidate + count))
+            used: Set[int] = set(models.User.objects.filter(chat_id__in=batch).values_list('chat_id', flat=True))
+            chat_ids.extend(c for c in batch if c not in used)
+            candidate += count
+        return chat_ids[:count]
+
+    @sync_to_async
+    def _cleanup(self, room_ids: List[int], chat_ids: List[int]) -> None:
+        """
+        удаляет пользователей с chat_id, выданными тестом (до теста их в БД не было),
+        и игры комнат теста (до теста в этих комнатах игры не было)
+        """
+        user_ids: List[int] = list(models.User.objects.filter(chat_id__in=chat_ids).values_list('id', flat=True))
+        game_ids: List[int] = list(models.CluedoRoom.objects.filter(id__in=room_ids, game__isnull=False).values_list('game_id', flat=True))
+        with transaction.atomic():
+            models.CluedoRoom.objects.filter(id__in=room_ids).update(game=None)
+            models.CluedoGame.objects.filter(id__in=game_ids).delete()
+            models.User.objects.filter(id__in=user_ids).delete()
+        logging.info(f'load test: removed {len(user_ids)} users and {len(game_ids)} games')
+
+    async def run(self, duration: float, max_updates: Optional[int] = None) -> LoadStats:
+        if not self.disposable and not is_test_db():
+            raise Exception('load test: БД не тестовая, тест удалил бы из нее данные (см. disposable)')
+        settings.TG_API_SERVER = await self.api.start()
+        # dp и Machine создаются при импорте обработчиков, уже с адресом имитации Bot API
+        from handlers.handler import dp
+        self.dp = dp
+        Bot.set_current(dp.bot)
+        Dispatcher.set_current(dp)
+
+        room_ids: List[int] = await self._get_room_ids()
+        if len(room_ids) < self.rooms:
+            logging.warning(f'load test: only {len(room_ids)} free rooms in DB, {self.rooms} requested')
+
+        sizes: List[int] = [self.rng.randint(self.min_players, self.max_players) for _ in room_ids]
+        chat_ids: List[int] = await self._get_free_chat_ids(sum(sizes))
+        players: List[SyntheticPlayer] = []
+        for room_id, size in zip(room_ids, sizes):
+            for _ in range(size):
+                players.append(SyntheticPlayer(self, chat_ids[len(players)], room_id, rd.Random(self.rng.random())))
+                self.room_players.setdefault(room_id, []).append(players[-1].chat_id)
+
+        queries: float = Metrics().get_counter('db_queries_total')
+        edits_skipped: float = Metrics().get_counter('tg_edits_skipped_total')
+        edits_coalesced: float = Metrics().get_counter('telegram_edits_coalesced_total')
+        started: float = time.perf_counter()
+        tasks: List[asyncio.Task] = [asyncio.ensure_future(p.run()) for p in players]
+        try:
+            deadline: float = started + duration
+            while time.perf_counter() < deadline and (max_updates is None or self.stats.updates < max_updates):
+                await asyncio.sleep(0.1)
+        finally:
+            self.stopped.set()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await Sender().drain()
+            self.stats.elapsed = time.perf_counter() - started
+            self.stats.queries = int(Metrics().get_counter('db_queries_total') - queries)
+            self.stats.edits_skipped = int(Metrics().get_counter('tg_edits_skipped_total') - edits_skipped)
+            self.stats.edits_coalesced = int(Metrics().get_counter('telegram_edits_coalesced_total') - edits_coalesced)
+            await (await dp.bot.get_session()).close()
+            await self.api.stop()
+            await self._cleanup(room_ids, chat_ids)
+        return self.stats
@@ -1,17 +1,21 @@
 import os
 import json
+import time
+import functools
 import logging
-import random
-from typing import List, Optional, Dict, Union
+from typing import List, Optional, Dict, Tuple, Union
 
 from aiogram import Bot, types
-from django.db.models import Q
+from aiogram.utils.payload import prepare_arg
 import settings
 from .keyboard import PlayerTurnKeyboard, RoomKeyboard, RoomsKeyboard, SimpleKeyboard #, QuizKeyboard, DashboardKeyboard
 from botstate import states
-from utils import MediaCache
-from data import models
+from utils import MediaCache, Metrics
+from .sender import Sender, SentMessages
+from .render import GameRender
+from data import models, repository
 from cluedo.game import Game, Player
+from cluedo.registry import GameRegistry
 from aiogram.utils.exceptions import MessageCantBeEdited, MessageNotModified
 
 
@@ -19,6 +23,7 @@ class BaseContext(object):
     def __init__(self):
         self.bot: Optional[Bot] = None
         self.media_cache: MediaCache = MediaCache()
+        self.sender: Sender = Sender()
 
     async def update(self, user: models.User, message_payload: Optional[str] = None, message_id: Optional[int] = None):
         pass
@@ -26,52 +31,109 @@ class BaseContext(object):
     async def update_user_state(self, msg_user: models.User, user: models.User, save: bool=False):
         pass
 
-    def _get_media(self, message: models.Message) -> Optional[Union[types.InputFile, str]]:
+    async def _get_media(self, message: models.Message) -> Tuple[Optional[Union[types.InputFile, str]], Optional[str]]:
+        """
+        file_id картинки сообщения, если она уже загружена в Telegram (в т.ч. другим процессом бота),
+        иначе файл для загрузки. Второе значение - хэш содержимого файла
+        """
         if message.media_name is None:
-            return None
+            return None, None
 
-        file_id: str = self.media_cache.find(message.media_name)
-        if file_id is not None:
-            return file_id
-        try:
-            path: str = os.path.join(settings.STATIC_ROOT, message.media_name)
-            media_file: types.InputFile = types.InputFile(path)
-        except:
+        path: str = os.path.join(settings.STATIC_ROOT, message.media_name)
+        content_hash: Optional[str] = await self.media_cache.get_hash(path)
+        if content_hash is None:
             logging.error("static file %s not found.", message.media_name)
-            return None
-        return media_file
+            return None, None
+
+        file_id: Optional[str] = self.media_cache.find(message.media_name, content_hash)
+        if file_id is None:
+            file_id = await repository.find_media_file(message.media_name, content_hash)
+            if file_id is not None:
+                self.media_cache.update(message.media_name, content_hash, file_id)
+        if file_id is not None:
+            return file_id, content_hash
+        return types.InputFile(path), content_hash
 
     async def send_msg(self, chat_id, message_id, text, keyboard, mode):
+        # пока правка ждет места в ограничении чата, ее может заменить более новая правка того же сообщения
+        await self.sender.edit(chat_id, message_id, functools.partial(self._send_msg, chat_id, message_id, text, keyboard, mode))
+
+    async def _send_msg(self, chat_id, message_id, text, keyboard, mode):
+        # разметка сериализуется один раз: и для отпечатка, и для запроса
+        keyboard = prepare_arg(keyboard)
+        digest: int = SentMessages.digest(text, keyboard, mode)
+        if SentMessages().is_sent(chat_id, message_id, digest):
+            logging.info(f'send_msg: not changed: chat {chat_id}, message {message_id}')
+            Metrics().inc('tg_edits_skipped_total')
+            return
         try:
-            await self.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, reply_markup=keyboard, parse_mode=mode)
+            await self.sender.call(chat_id, lambda: self.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, reply_markup=keyboard, parse_mode=mode))
             logging.warning(f'send_msg: edit: chat {chat_id}, message {message_id}')
+            SentMessages().remember(chat_id, message_id, digest)
         except MessageCantBeEdited as ex:
             logging.warning(f'send_msg: send: chat {chat_id}, message {message_id}')
-            await self.bot.send_message(chat_id=chat_id, text=text, reply_markup=keyboard, parse_mode=mode)
+            SentMessages().forget(chat_id, message_id)
+            await self.sender.call(chat_id, lambda: self.bot.send_message(chat_id=chat_id, text=text, reply_markup=keyboard, parse_mode=mode))
         except  MessageNotModified as ex:
-            logging.warning(f'not modified: send: chat {chat_id}, message {message_id}')
-            await self.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text+'.\n', reply_markup=keyboard, parse_mode=mode)
+            # в сообщении уже это содержимое (например, отправлено до перезапуска бота)
+            logging.warning(f'not modified: chat {chat_id}, message {message_id}')
+            SentMessages().remember(chat_id, message_id, digest)
+
+    async def send_many(self, messages: List[Tuple]):
+        """
+        рассылает сообщения (chat_id, message_id, text, keyboard, mode) остальным игрокам во все чаты одновременно.
+        Рассылка идет в фоне, обработчик ее не ждет, ошибки только логируются (см. Sender.fan_out),
+        поэтому сообщение самого пользователя отправляется через send_msg.
+        Рассылка может закончиться после снятия блокировки комнаты: порядок правок одного
+        сообщения из разных updates обеспечивает очередь Sender.edit
+        """
+        self.sender.post([(m[0], functools.partial(self.send_msg, *m)) for m in messages])
 
     async def send_all(self, users, message_id, text, keyboard, mode):
-        for u in users:
-            await self.send_msg(u.chat_id, u.last_message_id, text, keyboard, mode)
+        await self.send_many([(u.chat_id, u.last_message_id, text, keyboard, mode) for u in users])
 
 
-    def _update_media_cache(self, message: models.Message, response) -> None:
+    async def _update_media_cache(self, message: models.Message, content_hash: str, response) -> None:
         # -1 for get photo with best quality
         file_id: str = response.photo[-1].file_id
-        self.media_cache.update(message.media_name, file_id)
+        self.media_cache.update(message.media_name, content_hash, file_id)
+        await repository.save_media_file(message.media_name, content_hash, file_id, settings.MEDIA_CACHE_SIZE)
+
+    async def upload_media(self, chat_id: int, message: models.Message) -> Optional[float]:
+        """
+        загружает картинку сообщения в чат chat_id, если ее file_id еще неизвестен.
+        Возвращает время запроса send_photo в секундах (без ожидания в ограничителе частоты),
+        0 - если картинка уже загружена, None - если файла картинки нет
+        """
+        media_file, content_hash = await self._get_media(message)
+        if media_file is None:
+            return None
+        if not isinstance(media_file, types.InputFile):
+            return 0.0
+        duration: float = 0.0
+
+        async def _send_photo() -> types.Message:
+            nonlocal duration
+            started: float = time.monotonic()
+            try:
+                return await self.bot.send_photo(chat_id=chat_id, photo=media_file, disable_notification=True)
+            finally:
+                duration = time.monotonic() - started
+
+        response: types.Message = await self.sender.call(chat_id, _send_photo)
+        await self._update_media_cache(message, content_hash, response)
+        return duration
 
     async def send_with_media(self, user: models.User, message: models.Message, reply_markup: types.ReplyKeyboardMarkup) -> None:
         chat_id: int = user.chat_id
         text: str = message.text_content
-        media_file: Optional[Union[types.InputFile, str]
-                             ] = self._get_media(message)
+        media_file, content_hash = await self._get_media(message)
         if media_file is not None:
-            response: types.Message() = await self.bot.send_photo(chat_id=chat_id, photo=media_file, caption=text, reply_markup=reply_markup, parse_mode=types.ParseMode.MARKDOWN)
-            self._update_media_cache(message, response)
+            response: types.Message() = await self.sender.call(chat_id, lambda: self.bot.send_photo(chat_id=chat_id, photo=media_file, caption=text, reply_markup=reply_markup, parse_mode=types.ParseMode.MARKDOWN))
+            if isinstance(media_file, types.InputFile):
+                await self._update_media_cache(message, content_hash, response)
         else:
-            await self.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode=types.ParseMode.MARKDOWN)
+            await self.sender.call(chat_id, lambda: self.bot.send_message(chat_id=chat_id, text=text, reply_markup=reply_markup, parse_mode=types.ParseMode.MARKDOWN))
 
 
 class ExitContext(BaseContext):
@@ -93,18 +155,18 @@ class ExitContext(BaseContext):
 
 
 class MessageContext(BaseContext):
-    def __init__(self, bot: Bot, linked_message: models.LinkedMessages) -> None:
+    def __init__(self, bot: Bot, linked_message: models.LinkedMessages, message_list: Optional[Tuple[models.Message, ...]] = None) -> None:
         super().__init__()
         self.bot: Bot = bot
         self.linked_message: models.LinkedMessages = linked_message
         self.user: Optional[models.User] = None
 
-        self.message_list: Optional[List[models.Message]] = None
+        # список сообщений обычно подготавливается состоянием один раз и передается готовым
+        self.message_list: Optional[Tuple[models.Message, ...]] = message_list
 
     async def init_context(self) -> None:
         message_group: str = self.linked_message.group
-        self.message_list = list(models.Message.filter_message_by_group(message_group))
-        self.message_list.sort(key=lambda x: x.order)
+        self.message_list = await repository.get_message_list(message_group)
 
     def get_message(self, substate: int) -> Optional[models.Message]:
         if substate >= len(self.message_list):
@@ -119,28 +181,28 @@ class MessageContext(BaseContext):
 class RoomsContext(MessageContext):
     async def send_message(self, user: models.User, message: models.Message, message_id: Optional[int]) -> None:
         text: str = message.text_content
-        keyboard, mode = RoomsKeyboard.get_markup(message)
+        rooms: List[models.CluedoRoom] = await repository.get_rooms()
+        keyboard, mode = RoomsKeyboard.get_markup(message, rooms)
         await self.send_msg(user.chat_id, message_id, text, keyboard, mode)
 
 class RoomContext(MessageContext):
 
-    def _get_users(self, user):
-        users = list(models.User.objects.filter(room=user.room))
+    def _get_users(self, user, users):
         if users:
             return ', '.join(list(map(lambda x: x.name, users)) + [user.name, ])
         else:
             return user.name
 
     async def send_message(self, user: models.User, message: models.Message, message_id: Optional[int]) -> None:
-        users = list(models.User.objects.filter(Q(room=user.room) & ~Q(name=user.name)))
+        room_users: List[models.User] = await repository.get_room_users(user.room)
+        users = [u for u in room_users if u.id != user.id]
         text: str = f"Комната: {user.room.name}" + '\n'+ \
-                    f"В комнате: {self._get_users(user)}" + '\n' + \
+                    f"В комнате: {self._get_users(user, room_users)}" + '\n' + \
                     f"{message.text_content}"
 
         keyboard, mode = RoomKeyboard.get_markup(message, user.room)
         await self.send_msg(user.chat_id, message_id, text, keyboard, mode)
-        for u in users:
-            await self.send_msg(u.chat_id, u.last_message_id, text, keyboard, mode)
+        await self.send_many([(u.chat_id, u.last_message_id, text, keyboard, mode) for u in users])
 
 class GameFinishedContext(MessageContext):
 
@@ -152,29 +214,28 @@ class GameFinishedContext(MessageContext):
 
 class GameWonContext(MessageContext):
     async def send_message(self, user: models.User, message: models.Message, message_id: Optional[int]) -> None:
-        users = list(models.User.objects.filter(Q(room=user.room) & ~Q(name=user.name)))
+        users = await repository.get_other_room_users(user)
 
         text: str = 'Вы выиграли.\nЗавершить игру?'
 
         keyboard, mode =  SimpleKeyboard.get_markup(message)
         await self.send_msg(user.chat_id, message_id, text, keyboard, mode)
-        for u in users:
-            await self.send_msg(u.chat_id, u.last_message_id, text, keyboard, mode)
+        await self.send_many([(u.chat_id, u.last_message_id, text, keyboard, mode) for u in users])
 
 class GameWaitingContext(MessageContext):
 
-    def _get_users(self, user):
-        users = list(models.User.objects.filter(room=user.room))
+    def _get_users(self, user, users):
         if users:
             return ', '.join(map(lambda x: x.name, users))
         else:
             return user.name
 
     async def send_message(self, user: models.User, message: models.Message, message_id: Optional[int]) -> None:
-        users = list(await models.User.get_all_players_are_not_ready(user))
+        users = await repository.get_all_players_are_not_ready(user)
+        room_users: List[models.User] = await repository.get_room_users(user.room)
         users_text = ', '.join(map(lambda x: x.name, users))
         text: str = f"Комната: {user.room.name}" + '\n' + \
-                    f"В комнате: {self._get_users(user)}" + '\n' + \
+                    f"В комнате: {self._get_users(user, room_users)}" + '\n' + \
                     f"Ожидаем: {users_text}" + '\n' + \
                     f"{message.text_content}"
 
@@ -184,186 +245,23 @@ class GameWaitingContext(MessageContext):
         #     await self.send_msg(u.chat_id, u.last_message_id, text, keyboard, mode)
 
 class GameContext(MessageContext):
-    def __init__(self, bot: Bot, linked_message: models.LinkedMessages, **kwargs) -> None:
-        super().__init__(bot, linked_message)
+    def __init__(self, bot: Bot, linked_message: models.LinkedMessages, message_list: Optional[Tuple[models.Message, ...]] = None, **kwargs) -> None:
+        super().__init__(bot, linked_message, message_list)
         self.game: Game = None
         self.accuse_location = kwargs.get('location', -1)
         self.accuse_person = kwargs.get('accuse_person', -1)
         self.accuse_weapon = kwargs.get('accuse_weapon', -1)
         self.suspiction = kwargs.get('suspiction', None)
 
-    def _get_users_in_room(self, users):
-        if users:
-            return ', '.join(map(lambda x: x.name, users))
-        else:
-            return random.choice(['пусто', 'пустота', 'никогошеньки', 'нет игроков'])
-
-    def _get_room_message(self, user: models.User, users: List[models.User]) -> str:
-        if user.substate == 0:
-            return f"Комната: {user.room.name}" + '\n' + \
-                        f"В комнате: {self._get_users_in_room([*users, user])}" + '\n' + \
-                        f"{self.game.get_general_game_info()}" + '\n' + \
-                        f"{self.game.get_open_cards_info()}" + '\n'
-        elif user.substate == 1:
-            return ''
-
-    def _get_turn_message(self, player_turn: Player) -> str:
-        return f'ХОД ИГРОКА {player_turn.alias.name} ({player_turn.user.name})'+'\n'+f'ЖДЕМ ХОДА {player_turn.alias.name} ({player_turn.user.name})' + '\n'
-
-    def _get_current_place(self, player: Player) -> str:
-        return f'ВЫ {player.place.name}' + '\n'
-
-    def _get_accessible_places(self, player: Player):
-        return '\n'.join(map(lambda x: x.name, player.accessible_places)) + '\n'
-
-    def _get_dice_message(self, player: Player, player_turn: Player) -> str:
-        if player_turn.user.state == 'THROW_DICE':
-            if player.user.id == player_turn.user.id:
-                return f'ВЫ бросили кости.\nВам выпало {player.dice_throw_result}. Вы можете выбрать одну из локаций: '+'\n'+f'{self._get_accessible_places(player)}' + '\n'
-            else: 
-                return f'{player_turn.alias} бросил(а,о,и) кости.'+'\n' + f'Выпало {player_turn.dice_throw_result}. {player_turn.alias}  выбирает новую комнату' + '\n'
-        else:
-            return ''
-        
-    def _get_new_location_text(self, player: Player, player_turn: Player):
-        if player_turn.user.state == 'SELECT_PLACE':
-            if player.user.id == player_turn.user.id:
-                return f'{player.alias.name}, выберите локацию с местом преступления:' + '\n'
-        return ''
-
-    def _get_accused_person_text(self, player: Player, player_turn: Player):
-        if player_turn.user.state == 'ACCUSE_PERSON':
-            if player.user.id == player_turn.user.id:
-                return f'{player.alias.name}, ваша текущая локация - предполагаемое место преступления'+'\nтеперь вам надо выбрать подозреваемого:\n'
-        return ''
-
-    def _get_accused_weapon_text(self, player: Player, player_turn: Player):
-        if player_turn.user.state == 'ACCUSE_WEAPON':
-            if player.user.id == player_turn.user.id:
-                return f'{player.alias.name}, итак, место преступления - {self.game.accused_place}, '+ \
-                       '\n' + f'подозреваемый - {self.game.accused_person}'+ \
-                       '\n' + 'теперь надо выбрать орудие преступления\n'
-        return ''
-
-    def _get_accuse_finished_text(self, player: Player, player_turn: Player):
-        if player_turn.user.state == 'CONFIRM_ACCUSE':
-            if player.user.id == player_turn.user.id:
-                return f'Вы, {player_turn.alias.name}, сформировали свои подозрения - ' + '\n' + \
-                    f'Место преступления: {self.game.accused_place}, ' + '\n' + \
-                    f'Подозреваемый: {self.game.accused_person}, ' + '\n' + \
-                    f'Орудие: {self.game.accused_weapon}' + '\n' + \
-                    'теперь надо либо высказать свои подозрения, либо выдвинуть обвинение\n'
-        return ''
-
-    def _get_check_suspiction_text(self, player: Player, player_turn: Player, next_player: Player):
-        if player_turn.user.state == 'CHECK_SUSPICTION':
-            refute_players = self.game.reflute_players
-            if player.user.id == player_turn.user.id:
-                if len(refute_players) > 0:
-                    players_text = '\n'.join(map(lambda x: f'{x[0].alias.name}: {x[1].get_name_str()}', refute_players))
-                    return f'Игроки опровергли ваше подозрение:' + '\n' + players_text + '\n\n' + \
-                          f'Ход переходит к игроку {next_player.alias.name}' + '\n' 
-                else:
-                    return f'Никто не опроверг ваше подозрение' + '\n\n' + \
-                           f'Ход переходит к игроку {next_player.alias.name}' + '\n' 
-            else:
-                if len(refute_players) > 0:
-                    players_text = '\n'.join(set(map(lambda x: x[0].alias.name, refute_players)))
-                    return f'Игроки опровергли подозрение:' + '\n' + players_text + '\n\n' + \
-                          f'Ход переходит к игроку {next_player.alias.name}' + '\n'
-                else:
-                    return f'Никто не опроверг подозрение {player_turn.alias.name}' + '\n\n' + \
-                           f'Ход переходит к игроку {next_player.alias.name}' + '\n' 
-            
-
-        return ''
-
-    def _get_check_accuse_text(self, player: Player, player_turn: Player, next_player: Player):
-        if player_turn.user.state == 'CHECK_ACCUSE':
-            accuse_matches = self.game.accuse_matches
-            if player.user.id == player_turn.user.id:
-                if accuse_matches:
-                    return f'ВЫ ВЫИГРАЛИ !!!' + '\n' + 'действительно,\n\n' + \
-                          f'Преступник: {self.game.accused_person.name}' + '\n' + \
-                          f'Место преступления: {self.game.accused_place.name}' + '\n' + \
-                          f'Орудие преступления: {self.game.accused_place.name}' + '\n\n' + \
-                          f'Поздравляю, {player_turn.alias.name}' + '\n'   
-                else:
-                    return f'ВЫ   П Р О И Г Р А Л И ! ! !\n' + \
-                           f'Вот картина реального преступления:' + '\n' + \
-                           f"Преступник: {self.game.secret['person'].name}" + '\n' + \
-                           f"Место преступления: {self.game.secret['place'].name}" + '\n' + \
-                           f"Орудие преступления: {self.game.secret['weapon'].name}" + '\n\n' + \
-                           'Тогда как вы предположили, что дело было так:\n' + \
-                           f'Преступник: {self.game.accused_person.name}' + '\n' + \
-                           f'Место преступления: {self.game.accused_place.name}' + '\n' + \
-                           f'Орудие преступления: {self.game.accused_weapon.name}' + '\n\n' + \
-                           'Вы выкладываете карты на стол и покидаете игру\n\n' + \
-                           f'Ход переходит к {next_player.alias.name}' + '\n'
-            else:
-                if accuse_matches:
-                    return f'Игрок {player_turn.alias.name} выиграл!!!' + '\n' + \
-                           'Игра завершается. Поздравьте победителя!!!'
-                else:
-                    return f'Игрок {player_turn.alias.name} проиграл' + '\n' + \
-                           'Он выкладывает карты на стол и покидает игру\n' + \
-                           f'Ход переходит к {next_player.alias.name}' + '\n'
-            
-
-        return ''
-
-    def _compose_player_message(self, 
-               player: Player, 
-               room_text: str, 
-               turn_text: str, 
-               place_text:str, 
-               dice_text: str, 
-               new_location_text: str,
-               new_person_text: str,
-               new_weapon_text: str,
-               accuse_finished_text: str,
-               check_suspiction_text: str,
-               check_accuse_text: str
-               ) -> str:
-        if player.user.substate == 0:
-            return room_text + \
-                player.get_cards_info() + '\n\n' + \
-                player.get_known_cards_info() + '\n\n' + \
-                f"ВЫ: {player.alias.name} ({player.user.name})" + '\n' + \
-                turn_text + \
-                place_text + \
-                dice_text + \
-                new_location_text + \
-                new_person_text + \
-                new_weapon_text + \
-                accuse_finished_text + \
-                check_suspiction_text + \
-                check_accuse_text
-        elif player.user.substate == 1:
-            return room_text + \
-                f"ВЫ: {player.alias.name} ({player.user.name})" + '\n' + \
-                place_text + \
-                turn_text + \
-                dice_text + \
-                new_location_text + \
-                new_person_text + \
-                new_weapon_text + \
-                accuse_finished_text + \
-                check_suspiction_text + \
-                check_accuse_text
-        else:
-            return ''
-
     async def send_message(self, user: models.User, message: models.Message, message_id: Optional[int]) -> None:
 
         player_turn: Player = self.game.get_player_whos_turn()
         next_player: Player = self.game.get_next_player()
-        users = list(models.User.objects.filter(Q(room=user.room) & ~Q(name=user.name)))
+        users = await repository.get_other_room_users(user)
 
         player_turn.update_known_cards(self.game.reflute_players)
 
-        room_text: str = self._get_room_message(user, users)
-        turn_text: str = self._get_turn_message(player_turn)
+        render: GameRender = GameRender(self.game, user, users, player_turn, next_player)
 
         player: Player = self.game.get_player(user)
         logging.info(f'send_message: user: {user.id}:{user.name}, message {message_id}, state:{user.state}:{user.substate}')
@@ -371,108 +269,71 @@ class GameContext(MessageContext):
         logging.info(f'send_message: player: {player.alias.name}, id: {player.id}, number: {player.number}')
         logging.info(f'send_message: player_turn: {player_turn.alias.name}, id:{player_turn.id}, number:{player.number}')
 
-        
-        dice_text: str = self._get_dice_message(player, player_turn)
-        place_text: str = self._get_current_place(player)
-        accuse_location_text: str = self._get_new_location_text(player, player_turn)
-        accuse_person_text: str = self._get_accused_person_text(player, player_turn)
-        accuse_weapon_text: str = self._get_accused_weapon_text(player, player_turn)
-        accuse_finished_text: str = self._get_accuse_finished_text(player, player_turn)
-        check_suspiction_text: str = self._get_check_suspiction_text(player, player_turn, next_player)
-        check_accuse_text: str = self._get_check_accuse_text(player, player_turn, next_player)
-        player_msg : str = self._compose_player_message(
-            player, 
-            room_text, 
-            turn_text, 
-            place_text, 
-            dice_text, 
-            accuse_location_text,
-            accuse_person_text,
-            accuse_weapon_text,
-            accuse_finished_text,
-            check_suspiction_text,
-            check_accuse_text)
+        player_msg: str = render.render(user, player)
         keyboard, mode = PlayerTurnKeyboard.get_markup(message, player, player_turn, self.game)
 
-        await self.send_msg(user.chat_id, message_id, player_msg, keyboard, mode)
-
         await self.game.update_after_send(user)
         await self.update_user_state(user, user)
+        # ход отправляется игрокам, только если он сохранен: при GameConflict обработка прерывается
         await self.persist_game(user)
 
+        await self.send_msg(user.chat_id, message_id, player_msg, keyboard, mode)
+
+        messages: List[Tuple] = []
         for u in users:
             await self.update_user_state(user, u, True)
 
             player = self.game.get_player(u)
-            room_text = self._get_room_message(u, users)
-            dice_text = self._get_dice_message(player, player_turn)
-            place_text = self._get_current_place(player)
-            accuse_location_text = self._get_new_location_text(player, player_turn)
-            accuse_person_text = self._get_accused_person_text(player, player_turn)
-            accuse_weapon_text = self._get_accused_weapon_text(player, player_turn)
-            accuse_finished_text = self._get_accuse_finished_text(player, player_turn)
-            check_suspiction_text = self._get_check_suspiction_text(player, player_turn, next_player)
-            check_accuse_text: str = self._get_check_accuse_text(player, player_turn, next_player)
-            player_msg = self._compose_player_message(
-                player, 
-                room_text, 
-                turn_text, 
-                place_text, 
-                dice_text, 
-                accuse_location_text,
-                accuse_person_text,
-                accuse_weapon_text,
-                accuse_finished_text,
-                check_suspiction_text,
-                check_accuse_text)
+            player_msg = render.render(u, player)
             keyboard, mode = PlayerTurnKeyboard.get_markup(message, player, self.game.get_player_whos_turn(), self.game)
+            messages.append((u.chat_id, u.last_message_id, player_msg, keyboard, mode))
 
-            await self.send_msg(u.chat_id, u.last_message_id, player_msg, keyboard, mode)
+        await self.send_many(messages)
 
     async def persist_game(self, user: models.User):
         logging.info(f'persist game: user:{user.id}')
-        cluedo_game = await models.CluedoGame.create(
-            user.room.game,
-            user.room, 
-            self.game.winner,
-            self.game.get_secret(), 
-            self.game.place_distances,
-            self.game.get_open_cards(),
-            True,
-            self.game.alive,
-            self.game.won,
-            self.game.turn_number,
-            self.game.accused_place,
-            self.game.accused_person,
-            self.game.accused_weapon
-            )
+        game_values: Dict = self.game.get_changed_values()
+        if user.room.game is not None and not game_values:
+            Metrics().inc('db_writes_skipped_total', model='game')
 
+        players: List[Tuple] = []
+        persisted_players: List[Player] = []
         for p in self.game.players:
+            if p.player is not None and not p.is_dirty():
+                Metrics().inc('db_writes_skipped_total', model='player')
+                continue
             logging.info(f'persist player: player: {p.id}, user:{p.user.id}, game for user:{user.id}')
-            await models.CluedoPlayer.create(
-                p.player,
-                p.user,
-                cluedo_game, 
-                p.number,
-                p.dice_throw_result,
-                p.place,
-                p.alias,
-                p.alive,
-                p.get_cards(),
-                p.get_known_cards()
-            )
-
-        user.room.game = cluedo_game
-        await user.room.async_save()
-        
+            players.append((p.player, p.get_changed_values()))
+            persisted_players.append(p)
+
+        cluedo_game: models.CluedoGame = user.room.game
+        if cluedo_game is None or game_values or players:
+            try:
+                cluedo_game, player_rows = await repository.save_game(user.room, cluedo_game, game_values, players)
+            except repository.GameConflict:
+                # игру уже изменил другой обработчик: ход не сохраняется, игра из реестра
+                # выгружается (Machine), при следующем событии она загрузится из БД
+                logging.warning(f'persist game: room {user.room.id} game {cluedo_game.id} changed concurrently')
+                Metrics().inc('game_save_conflicts_total')
+                raise
+            for p, player_row in zip(persisted_players, player_rows):
+                p.player = player_row
+            self.game.mark_clean()
+
+        GameRegistry().update(user.room.id, self.game, cluedo_game.version)
+
     async def update(self, user: models.User, message_payload: Optional[str] = None, message_id: Optional[int] = None):
         cluedo_game: models.CluedoGame = user.room.game
         if cluedo_game is None:
             self.game = Game(user)
-            self.game.create()
+            await self.game.async_create(await repository.get_room_users(user.room))
         else:
-            self.game = Game(user)
-            self.game.from_model(cluedo_game)
+            self.game = GameRegistry().find(user.room.id, cluedo_game.version)
+            if self.game is None:
+                self.game = Game(user)
+                await self.game.async_from_model(cluedo_game)
+            else:
+                self.game.bind_users(user, await repository.get_room_users(user.room))
         self.game.update_state(
             accused_location=self.accuse_location, 
             accused_person=self.accuse_person, 
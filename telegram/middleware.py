@@ -0,0 +1,52 @@
+import time
+import json
+from typing import Dict, Optional
+
+from aiogram import types
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+import settings
+from utils import Metrics
+from utils.tracing import UpdateTrace, current_trace, update_logger
+
+
+class UpdateTraceMiddleware(BaseMiddleware):
+    """
+    заводит UpdateTrace на время обработки update и после обработки пишет его сводку
+    (запросы к БД, время БД и Bot API, общее время) в логгер updates.
+    Обработка дольше settings.SLOW_UPDATE_THRESHOLD секунд попадает в лог как медленная,
+    вместе с повторяющимися запросами
+    """
+    def __init__(self, slow_threshold: float = settings.SLOW_UPDATE_THRESHOLD):
+        super().__init__()
+        self.slow_threshold: float = slow_threshold
+
+    async def on_pre_process_update(self, update: types.Update, data: Dict) -> None:
+        if update.message is not None:
+            kind, chat_id = 'message', update.message.chat.id
+        elif update.callback_query is not None and update.callback_query.message is not None:
+            kind, chat_id = 'callback', update.callback_query.message.chat.id
+        else:
+            kind, chat_id = 'other', None
+        data['trace_token'] = current_trace.set(UpdateTrace(update.update_id, kind, chat_id))
+
+    async def on_post_process_update(self, update: types.Update, results, data: Dict) -> None:
+        trace: Optional[UpdateTrace] = current_trace.get()
+        token = data.pop('trace_token', None)
+        if token is not None:
+            current_trace.reset(token)
+        if trace is None:
+            return
+
+        total: float = time.monotonic() - trace.started
+        summary: Dict = trace.summary(total)
+        state: str = trace.state or 'UNKNOWN'
+        Metrics().observe('update_seconds', total, state=state, new_state=trace.new_state or state, kind=trace.kind)
+        Metrics().inc('update_queries_total', trace.queries, state=state)
+        update_logger.info(json.dumps(summary))
+
+        if total > self.slow_threshold:
+            Metrics().inc('slow_updates_total', state=state)
+            repeated: Dict[str, int] = trace.get_repeated()
+            update_logger.warning(f'slow update: {json.dumps(summary)}' +
+                                  ''.join(f'\n    {count} x {sql}' for sql, count in sorted(repeated.items(), key=lambda x: -x[1])))
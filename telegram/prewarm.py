@@ -0,0 +1,69 @@
+"""
+загрузка картинок сообщений в служебный чат при старте бота: file_id всех картинок
+попадают в MediaCache заранее, и при отправке пользователям картинки не загружаются
+"""
+import time
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import Bot
+
+from data import models, repository
+from utils import Metrics
+from .message import BaseContext
+
+
+@dataclass
+class PrewarmStats:
+    uploaded: int = 0
+    cached: int = 0
+    failed: int = 0
+    elapsed: float = 0.0
+    # имя файла -> время запроса send_photo, в секундах
+    timings: Dict[str, float] = field(default_factory=dict)
+
+    def slowest(self, count: int = 3) -> List[Tuple[str, float]]:
+        return sorted(self.timings.items(), key=lambda x: x[1], reverse=True)[:count]
+
+
+async def prewarm_media(bot: Bot, chat_id: int, concurrency: int, rate: float) -> PrewarmStats:
+    """
+    загружает картинки всех сообщений, не более concurrency одновременно и не чаще rate в секунду
+    (ограничение Telegram для служебного чата). Каждая картинка загружается один раз,
+    даже если она есть у нескольких сообщений
+    """
+    stats: PrewarmStats = PrewarmStats()
+    context: BaseContext = BaseContext()
+    context.bot = bot
+    context.sender.set_chat_limit(chat_id, rate, 1)
+    semaphore: asyncio.Semaphore = asyncio.Semaphore(concurrency)
+
+    messages: Dict[str, models.Message] = {}
+    for message in await repository.get_media_messages():
+        messages.setdefault(message.media_name, message)
+
+    async def _upload(message: models.Message) -> None:
+        async with semaphore:
+            try:
+                duration: Optional[float] = await context.upload_media(chat_id, message)
+            except Exception:
+                logging.exception(f'media prewarm: {message.media_name} failed')
+                duration = None
+            if duration is None:
+                Metrics().inc('media_prewarm_errors_total')
+                stats.failed += 1
+                return
+            if not duration:
+                stats.cached += 1
+                return
+            stats.uploaded += 1
+            stats.timings[message.media_name] = duration
+            Metrics().observe('media_prewarm_seconds', duration)
+            logging.info(f'media prewarm: {message.media_name} uploaded in {duration * 1000:.0f}ms')
+
+    started: float = time.monotonic()
+    await asyncio.gather(*(_upload(m) for m in messages.values()))
+    stats.elapsed = time.monotonic() - started
+    return stats
@@ -0,0 +1,182 @@
+"""
+сборка текстов игрового сообщения. Общие для всех игроков части (заголовок комнаты,
+строка хода, тексты состояния для наблюдателей) собираются один раз на update,
+сообщение каждого игрока склеивается из готовых частей
+"""
+from typing import Dict, List, Optional, Tuple
+
+from data import models
+from cluedo.game import Game, Player
+
+
+class GameRender(object):
+    def __init__(self, game: Game, user: models.User, users: List[models.User], player_turn: Player, next_player: Player):
+        self.game: Game = game
+        self.player_turn: Player = player_turn
+        self.next_player: Player = next_player
+
+        self.room_title: str = f"Комната: {user.room.name}" + '\n' + "В комнате: "
+        self.users_text: str = ', '.join(map(lambda x: x.name, users))
+        self.turn_text: str = self._get_turn_message(player_turn)
+        self._room_info: Optional[str] = None
+        # тексты состояния по (ход этого игрока, состояние игрока, чей ход)
+        self._state_texts: Dict[Tuple[bool, str], str] = {}
+
+    def get_room_info(self) -> str:
+        # карты в игре не меняются, их описание кэширует игра; открытые карты известны после раздачи
+        if self._room_info is None:
+            self._room_info = '\n' + f"{self.game.get_general_game_info()}" + '\n' + \
+                                     f"{self.game.get_open_cards_info()}" + '\n'
+        return self._room_info
+
+    def get_room_message(self, user: models.User) -> str:
+        if user.substate == 0:
+            users_text: str = f'{self.users_text}, {user.name}' if self.users_text else user.name
+            return self.room_title + users_text + self.get_room_info()
+        elif user.substate == 1:
+            return ''
+
+    def _get_turn_message(self, player_turn: Player) -> str:
+        return f'ХОД ИГРОКА {player_turn.alias.name} ({player_turn.user.name})'+'\n'+f'ЖДЕМ ХОДА {player_turn.alias.name} ({player_turn.user.name})' + '\n'
+
+    def _get_current_place(self, player: Player) -> str:
+        return f'ВЫ {player.place.name}' + '\n'
+
+    def _get_accessible_places(self, player: Player):
+        return '\n'.join(map(lambda x: x.name, player.accessible_places)) + '\n'
+
+    def _get_dice_message(self, player: Player, player_turn: Player) -> str:
+        if player_turn.user.state == 'THROW_DICE':
+            if player.user.id == player_turn.user.id:
+                return f'ВЫ бросили кости.\nВам выпало {player.dice_throw_result}. Вы можете выбрать одну из локаций: '+'\n'+f'{self._get_accessible_places(player)}' + '\n'
+            else:
+                return f'{player_turn.alias} бросил(а,о,и) кости.'+'\n' + f'Выпало {player_turn.dice_throw_result}. {player_turn.alias}  выбирает новую комнату' + '\n'
+        else:
+            return ''
+
+    def _get_new_location_text(self, player: Player, player_turn: Player):
+        if player_turn.user.state == 'SELECT_PLACE':
+            if player.user.id == player_turn.user.id:
+                return f'{player.alias.name}, выберите локацию с местом преступления:' + '\n'
+        return ''
+
+    def _get_accused_person_text(self, player: Player, player_turn: Player):
+        if player_turn.user.state == 'ACCUSE_PERSON':
+            if player.user.id == player_turn.user.id:
+                return f'{player.alias.name}, ваша текущая локация - предполагаемое место преступления'+'\nтеперь вам надо выбрать подозреваемого:\n'
+        return ''
+
+    def _get_accused_weapon_text(self, player: Player, player_turn: Player):
+        if player_turn.user.state == 'ACCUSE_WEAPON':
+            if player.user.id == player_turn.user.id:
+                return f'{player.alias.name}, итак, место преступления - {self.game.accused_place}, '+ \
+                       '\n' + f'подозреваемый - {self.game.accused_person}'+ \
+                       '\n' + 'теперь надо выбрать орудие преступления\n'
+        return ''
+
+    def _get_accuse_finished_text(self, player: Player, player_turn: Player):
+        if player_turn.user.state == 'CONFIRM_ACCUSE':
+            if player.user.id == player_turn.user.id:
+                return f'Вы, {player_turn.alias.name}, сформировали свои подозрения - ' + '\n' + \
+                    f'Место преступления: {self.game.accused_place}, ' + '\n' + \
+                    f'Подозреваемый: {self.game.accused_person}, ' + '\n' + \
+                    f'Орудие: {self.game.accused_weapon}' + '\n' + \
+                    'теперь надо либо высказать свои подозрения, либо выдвинуть обвинение\n'
+        return ''
+
+    def _get_check_suspiction_text(self, player: Player, player_turn: Player, next_player: Player):
+        if player_turn.user.state == 'CHECK_SUSPICTION':
+            refute_players = self.game.reflute_players
+            if player.user.id == player_turn.user.id:
+                if len(refute_players) > 0:
+                    players_text = '\n'.join(map(lambda x: f'{x[0].alias.name}: {self.game.catalog.get_card(x[1]).get_name_str()}', refute_players))
+                    return f'Игроки опровергли ваше подозрение:' + '\n' + players_text + '\n\n' + \
+                          f'Ход переходит к игроку {next_player.alias.name}' + '\n'
+                else:
+                    return f'Никто не опроверг ваше подозрение' + '\n\n' + \
+                           f'Ход переходит к игроку {next_player.alias.name}' + '\n'
+            else:
+                if len(refute_players) > 0:
+                    players_text = '\n'.join(set(map(lambda x: x[0].alias.name, refute_players)))
+                    return f'Игроки опровергли подозрение:' + '\n' + players_text + '\n\n' + \
+                          f'Ход переходит к игроку {next_player.alias.name}' + '\n'
+                else:
+                    return f'Никто не опроверг подозрение {player_turn.alias.name}' + '\n\n' + \
+                           f'Ход переходит к игроку {next_player.alias.name}' + '\n'
+
+
+        return ''
+
+    def _get_check_accuse_text(self, player: Player, player_turn: Player, next_player: Player):
+        if player_turn.user.state == 'CHECK_ACCUSE':
+            accuse_matches = self.game.accuse_matches
+            if player.user.id == player_turn.user.id:
+                if accuse_matches:
+                    return f'ВЫ ВЫИГРАЛИ !!!' + '\n' + 'действительно,\n\n' + \
+                          f'Преступник: {self.game.accused_person.name}' + '\n' + \
+                          f'Место преступления: {self.game.accused_place.name}' + '\n' + \
+                          f'Орудие преступления: {self.game.accused_place.name}' + '\n\n' + \
+                          f'Поздравляю, {player_turn.alias.name}' + '\n'
+                else:
+                    return f'ВЫ   П Р О И Г Р А Л И ! ! !\n' + \
+                           f'Вот картина реального преступления:' + '\n' + \
+                           f"Преступник: {self.game.secret['person'].name}" + '\n' + \
+                           f"Место преступления: {self.game.secret['place'].name}" + '\n' + \
+                           f"Орудие преступления: {self.game.secret['weapon'].name}" + '\n\n' + \
+                           'Тогда как вы предположили, что дело было так:\n' + \
+                           f'Преступник: {self.game.accused_person.name}' + '\n' + \
+                           f'Место преступления: {self.game.accused_place.name}' + '\n' + \
+                           f'Орудие преступления: {self.game.accused_weapon.name}' + '\n\n' + \
+                           'Вы выкладываете карты на стол и покидаете игру\n\n' + \
+                           f'Ход переходит к {next_player.alias.name}' + '\n'
+            else:
+                if accuse_matches:
+                    return f'Игрок {player_turn.alias.name} выиграл!!!' + '\n' + \
+                           'Игра завершается. Поздравьте победителя!!!'
+                else:
+                    return f'Игрок {player_turn.alias.name} проиграл' + '\n' + \
+                           'Он выкладывает карты на стол и покидает игру\n' + \
+                           f'Ход переходит к {next_player.alias.name}' + '\n'
+
+
+        return ''
+
+    def get_state_text(self, player: Player) -> str:
+        """
+        тексты состояния игры (кости, выбор места, подозрения, обвинение) для игрока.
+        Они зависят только от того, его ли сейчас ход, поэтому у всех наблюдателей одинаковы
+        """
+        player_turn: Player = self.player_turn
+        key: Tuple[bool, str] = (player.user.id == player_turn.user.id, player_turn.user.state)
+        text: Optional[str] = self._state_texts.get(key, None)
+        if text is None:
+            text = self._get_dice_message(player, player_turn) + \
+                self._get_new_location_text(player, player_turn) + \
+                self._get_accused_person_text(player, player_turn) + \
+                self._get_accused_weapon_text(player, player_turn) + \
+                self._get_accuse_finished_text(player, player_turn) + \
+                self._get_check_suspiction_text(player, player_turn, self.next_player) + \
+                self._get_check_accuse_text(player, player_turn, self.next_player)
+            self._state_texts[key] = text
+        return text
+
+    def render(self, user: models.User, player: Player) -> str:
+        room_text: str = self.get_room_message(user)
+        place_text: str = self._get_current_place(player)
+        state_text: str = self.get_state_text(player)
+        if player.user.substate == 0:
+            return room_text + \
+                player.get_cards_info() + '\n\n' + \
+                player.get_known_cards_info() + '\n\n' + \
+                f"ВЫ: {player.alias.name} ({player.user.name})" + '\n' + \
+                self.turn_text + \
+                place_text + \
+                state_text
+        elif player.user.substate == 1:
+            return room_text + \
+                f"ВЫ: {player.alias.name} ({player.user.name})" + '\n' + \
+                place_text + \
+                self.turn_text + \
+                state_text
+        else:
+            return ''
@@ -0,0 +1,253 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple, Union
+
+from aiogram.utils.exceptions import RetryAfter
+
+import settings
+from utils import Metrics
+from utils.cache import SingletonMeta
+from utils.tracing import current_trace
+
+# при превышении этого числа корзин чатов удаляются неактивные
+MAX_CHAT_BUCKETS = 1024
+# сколько сообщений помнит SentMessages (давно не обновлявшиеся забываются первыми)
+MAX_SENT_MESSAGES = 4096
+
+
+MessageKey = Tuple[int, Optional[int]]
+
+
+def message_key(chat_id: int, message_id: Optional[Union[int, str]]) -> MessageKey:
+    """
+    ключ сообщения (chat_id, message_id). message_id из Telegram - число,
+    а last_message_id пользователя из БД - строка, поэтому оба приводятся к int
+    """
+    return int(chat_id), int(message_id) if message_id else None
+
+
+class TokenBucket:
+    """
+    ограничитель частоты запросов: rate запросов в секунду, не более capacity подряд.
+    Каждый вызов acquire резервирует запрос и ждет, пока до него дойдет очередь
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate: float = rate
+        self.capacity: float = capacity
+        self.tokens: float = capacity
+        self.updated: float = time.monotonic()
+
+    def _refill(self) -> None:
+        now: float = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def is_idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    def reserve(self) -> float:
+        self._refill()
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def pause(self, seconds: float) -> None:
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+    async def acquire(self) -> None:
+        delay: float = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def wait_ready(self) -> None:
+        """
+        ждет, пока освободится место для запроса, но не резервирует его
+        """
+        self._refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+
+
+class PendingEdit:
+    """
+    ожидающая отправки правка сообщения: job заменяется более новой правкой того же сообщения,
+    результат получают все, кто ее ждет
+    """
+    def __init__(self, job: Callable[[], Awaitable], future: asyncio.Future):
+        self.job: Callable[[], Awaitable] = job
+        self.future: asyncio.Future = future
+
+
+class Sender(metaclass=SingletonMeta):
+    """
+    отправляет запросы к Telegram с учетом общего ограничения и ограничения на чат,
+    повторяет запросы после RetryAfter
+    """
+    def __init__(self):
+        self.global_bucket: TokenBucket = TokenBucket(settings.TG_GLOBAL_RATE, settings.TG_GLOBAL_RATE)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        # чаты со своим ограничением частоты: chat_id -> (запросов в секунду, подряд)
+        self.chat_limits: Dict[int, Tuple[float, float]] = {}
+        self.retry_limit: int = settings.TG_RETRY_LIMIT
+        # правки, ждущие своей очереди, и выполняемые правки по (chat_id, message_id)
+        self.pending_edits: Dict[MessageKey, PendingEdit] = {}
+        self.running_edits: Dict[MessageKey, asyncio.Future] = {}
+        # рассылки, выполняемые в фоне (см. post)
+        self.background: Set[asyncio.Task] = set()
+        Metrics().add_collector(self.collect_metrics)
+
+    def _get_chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket: TokenBucket = self.chat_buckets.get(chat_id, None)
+        if bucket is None:
+            if len(self.chat_buckets) >= MAX_CHAT_BUCKETS:
+                self.chat_buckets = {k: v for k, v in self.chat_buckets.items() if not v.is_idle()}
+            rate, burst = self.chat_limits.get(chat_id, (settings.TG_CHAT_RATE, settings.TG_CHAT_BURST))
+            bucket = TokenBucket(rate, burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def set_chat_limit(self, chat_id: int, rate: float, burst: float) -> None:
+        """
+        задает чату свое ограничение частоты запросов (например, группе - 20 сообщений в минуту)
+        """
+        self.chat_limits[chat_id] = (rate, burst)
+        self.chat_buckets.pop(chat_id, None)
+
+    async def call(self, chat_id: int, request: Callable[[], Awaitable]) -> Any:
+        attempt: int = 0
+        while True:
+            await self._get_chat_bucket(chat_id).acquire()
+            await self.global_bucket.acquire()
+            try:
+                return await request()
+            except RetryAfter as ex:
+                attempt += 1
+                if attempt > self.retry_limit:
+                    raise
+                delay: float = max(ex.timeout, 2 ** (attempt - 1))
+                logging.warning(f'sender: chat {chat_id} flood control, retry {attempt} in {delay}s')
+                Metrics().inc('telegram_retry_after_total')
+                self._get_chat_bucket(chat_id).pause(delay)
+
+    async def fan_out(self, jobs: List[Tuple[int, Callable[[], Awaitable]]]) -> None:
+        """
+        выполняет отправку сообщений в несколько чатов одновременно.
+        Ошибка отправки в один чат не мешает отправке в остальные
+        """
+        async def _run(chat_id: int, job: Callable[[], Awaitable]) -> None:
+            started: float = time.monotonic()
+            try:
+                await job()
+            except Exception:
+                logging.exception(f'fan out: chat {chat_id} failed')
+                Metrics().inc('telegram_fanout_errors_total')
+            finally:
+                latency: float = time.monotonic() - started
+                logging.info(f'fan out: chat {chat_id} latency {latency * 1000:.0f}ms')
+                Metrics().observe('telegram_fanout_latency_seconds', latency)
+
+        await asyncio.gather(*(_run(chat_id, job) for chat_id, job in jobs))
+
+    async def edit(self, chat_id: int, message_id: Optional[Union[int, str]], job: Callable[[], Awaitable]) -> Any:
+        """
+        выполняет правку сообщения (chat_id, message_id), когда у чата освободится место для запроса.
+        Пока правка ждет, более новая правка того же сообщения заменяет ее: отправляется
+        только последняя, ее результат получают все ожидающие. Правки одного сообщения
+        выполняются по очереди, поэтому старая не может перезаписать новую
+        """
+        key: MessageKey = message_key(chat_id, message_id)
+        pending: Optional[PendingEdit] = self.pending_edits.get(key, None)
+        if pending is not None:
+            pending.job = job
+            Metrics().inc('telegram_edits_coalesced_total')
+            return await asyncio.shield(pending.future)
+
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        pending = PendingEdit(job, loop.create_future())
+        self.pending_edits[key] = pending
+        try:
+            running: Optional[asyncio.Future] = self.running_edits.get(key, None)
+            if running is not None:
+                await asyncio.shield(running)
+            await self._get_chat_bucket(chat_id).wait_ready()
+        except BaseException:
+            self.pending_edits.pop(key, None)
+            pending.future.cancel()
+            raise
+
+        self.pending_edits.pop(key, None)
+        running = loop.create_future()
+        self.running_edits[key] = running
+        try:
+            pending.future.set_result(await pending.job())
+        except Exception as ex:
+            pending.future.set_exception(ex)
+        except BaseException:
+            pending.future.cancel()
+            raise
+        finally:
+            if self.running_edits.get(key, None) is running:
+                del self.running_edits[key]
+            running.set_result(None)
+        return await pending.future
+
+    async def _fan_out_background(self, jobs: List[Tuple[int, Callable[[], Awaitable]]]) -> None:
+        # задача получила копию контекста обработчика, но к его update рассылка уже не относится:
+        # сводка update к этому времени записана, время вызовов Bot API учитывается отдельно
+        current_trace.set(None)
+        await self.fan_out(jobs)
+
+    def post(self, jobs: List[Tuple[int, Callable[[], Awaitable]]]) -> None:
+        """
+        запускает fan_out в фоне: обработчик не ждет, пока у всех чатов освободится место для запроса
+        """
+        task: asyncio.Task = asyncio.ensure_future(self._fan_out_background(jobs))
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+
+    async def drain(self) -> None:
+        """
+        дожидается фоновых рассылок (перед остановкой бота)
+        """
+        while self.background:
+            await asyncio.gather(*self.background, return_exceptions=True)
+
+    def collect_metrics(self, metrics: Metrics) -> None:
+        metrics.set('telegram_edits_pending', len(self.pending_edits))
+        metrics.set('telegram_background_sends', len(self.background))
+
+
+class SentMessages(metaclass=SingletonMeta):
+    """
+    отпечатки содержимого (текст, разметка, режим), последним отправленного в каждое
+    сообщение (chat_id, message_id). Редактирование тем же содержимым Telegram отклоняет
+    (MessageNotModified), поэтому такие запросы не отправляются вовсе
+    """
+    def __init__(self, maxsize: int = MAX_SENT_MESSAGES):
+        self.maxsize: int = maxsize
+        self._digests: 'OrderedDict[MessageKey, int]' = OrderedDict()
+        Metrics().add_collector(self.collect_metrics)
+
+    @staticmethod
+    def digest(text: str, markup: Optional[str], mode: Optional[str]) -> int:
+        return hash((text, markup, mode))
+
+    def is_sent(self, chat_id: int, message_id: Optional[Union[int, str]], digest: int) -> bool:
+        return self._digests.get(message_key(chat_id, message_id), None) == digest
+
+    def remember(self, chat_id: int, message_id: Optional[Union[int, str]], digest: int) -> None:
+        key: MessageKey = message_key(chat_id, message_id)
+        self._digests[key] = digest
+        self._digests.move_to_end(key)
+        while len(self._digests) > self.maxsize:
+            self._digests.popitem(last=False)
+
+    def forget(self, chat_id: int, message_id: Optional[Union[int, str]]) -> None:
+        self._digests.pop(message_key(chat_id, message_id), None)
+
+    def collect_metrics(self, metrics: Metrics) -> None:
+        metrics.set('sent_messages_tracked', len(self._digests))
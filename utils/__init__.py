@@ -1,4 +1,6 @@
 
 from .cache import MediaCache
+from .locks import KeyedLock
+from .metrics import Metrics
 
-__all__ = ['MediaCache']
+__all__ = ['MediaCache', 'KeyedLock', 'Metrics']
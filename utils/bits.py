@@ -0,0 +1,11 @@
+from typing import Iterator
+
+
+def iter_indices(mask: int) -> Iterator[int]:
+    """
+    номера установленных битов маски в порядке возрастания
+    """
+    while mask:
+        low: int = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
@@ -1,25 +1,79 @@
+import os
+import asyncio
+import hashlib
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
 
-from typing import Dict, Optional
+import settings
+from .metrics import Metrics
+from .singleton import SingletonMeta
 
+MediaKey = Tuple[str, str]
 
-class SingletonMeta(type):
-    _instances = {}
 
-    def __call__(cls, *args, **kwargs):
+class MediaCache(metaclass=SingletonMeta):
+    """
+    file_id загруженных в Telegram картинок по (имени файла, хэшу содержимого), не более maxsize (LRU).
+    Хэш входит в ключ, поэтому после замены файла картинка загружается заново.
+    Копия хранится в БД (MediaFile) и загружается при старте бота
+    """
+    def __init__(self, maxsize: int = settings.MEDIA_CACHE_SIZE):
+        self.maxsize: int = maxsize
+        self._cache: 'OrderedDict[MediaKey, str]' = OrderedDict()
+        # путь -> ((время изменения, размер), хэш): файл перечитывается, только если изменился
+        self._hashes: Dict[str, Tuple[Tuple[int, int], str]] = {}
+        Metrics().add_collector(self.collect_metrics)
 
-        if cls not in cls._instances:
-            instance = super().__call__(*args, **kwargs)
-            cls._instances[cls] = instance
-        return cls._instances[cls]
+    def __len__(self) -> int:
+        return len(self._cache)
 
+    async def get_hash(self, path: str) -> Optional[str]:
+        """
+        хэш содержимого файла. Обращения к диску выполняются в пуле потоков, а не в event loop
+        """
+        cached: Optional[Tuple[Tuple[int, int], str]] = await asyncio.get_running_loop().run_in_executor(
+            None, self._read_hash, path, self._hashes.get(path, None))
+        if cached is None:
+            self._hashes.pop(path, None)
+            return None
+        self._hashes[path] = cached
+        return cached[1]
 
-class MediaCache(metaclass=SingletonMeta):
-    def __init__(self):
-        self._cache: Dict[str, str] = {}
+    @staticmethod
+    def _read_hash(path: str, cached: Optional[Tuple[Tuple[int, int], str]]) -> Optional[Tuple[Tuple[int, int], str]]:
+        try:
+            stat: os.stat_result = os.stat(path)
+        except OSError:
+            return None
+        version: Tuple[int, int] = (stat.st_mtime_ns, stat.st_size)
+        if cached is None or cached[0] != version:
+            with open(path, 'rb') as media_file:
+                cached = (version, hashlib.sha256(media_file.read()).hexdigest())
+        return cached
+
+    def find(self, name: str, content_hash: str) -> Optional[str]:
+        key: MediaKey = (name, content_hash)
+        file_id: Optional[str] = self._cache.get(key, None)
+        if file_id is not None:
+            self._cache.move_to_end(key)
+            Metrics().inc('media_cache_hits_total')
+            return file_id
+        Metrics().inc('media_cache_misses_total')
+        return None
+
+    def update(self, name: str, content_hash: str, file_id: str) -> None:
+        key: MediaKey = (name, content_hash)
+        self._cache[key] = file_id
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
 
-    def find(self, key: str) -> Optional[str]:
-        return self._cache[key] if key in self._cache else None
+    def load(self, entries: Iterable[Tuple[str, str, str]]) -> None:
+        """
+        заполняет кэш записями (имя, хэш, file_id) от давних к недавним
+        """
+        for name, content_hash, file_id in entries:
+            self.update(name, content_hash, file_id)
 
-    def update(self, key: str, value: str) -> None:
-        if key not in self._cache:
-            self._cache[key] = value
+    def collect_metrics(self, metrics: Metrics) -> None:
+        metrics.set('media_cache_size', len(self._cache))
@@ -1,7 +1,16 @@
 import json
-from typing import Dict, List, Union
+from typing import Dict, List, Optional, Set, Tuple, Union
 from data.models import CluedoPerson, CluedoPlace, CluedoWeapon
 
+CARD_MODELS = {
+    'person': CluedoPerson,
+    'place': CluedoPlace,
+    'weapon': CluedoWeapon,
+}
+
+CardKey = Tuple[str, int]
+Card = Union[CluedoPerson, CluedoPlace, CluedoWeapon]
+
 def cards_to_json(cards: List[Union[CluedoPerson, CluedoPlace, CluedoWeapon]]) -> List:
     r = []
     for card in cards:
@@ -16,19 +25,44 @@ def cards_to_json(cards: List[Union[CluedoPerson, CluedoPlace, CluedoWeapon]]) -
     
     return json.dumps(r)
 
-def json_to_cards(cards: List) -> List[Union[CluedoPerson, CluedoPlace, CluedoWeapon]]:
-    r = []
-    for card in cards:
-        if card['type'] == 'person':
-            r.append(CluedoPerson.objects.filter(id=card['id']).first())
-        elif card['type'] == 'place':
-            r.append(CluedoPlace.objects.filter(id=card['id']).first())
-        elif card['type'] == 'weapon':
-            r.append(CluedoWeapon.objects.filter(id=card['id']).first())
-        else:
-            raise NotImplementedError()
-    
-    return r
+def card_key(card: Card) -> CardKey:
+    for card_type, model in CARD_MODELS.items():
+        if type(card) is model:
+            return (card_type, card.id)
+    raise NotImplementedError()
+
+def cards_to_catalog(cards: List[Card]) -> Dict[CardKey, Card]:
+    return {card_key(card): card for card in cards}
+
+def json_lists_to_cards(card_lists: List[List], catalog: Optional[Dict[CardKey, Card]] = None) -> List[List[Card]]:
+    """
+    восстанавливает сразу несколько списков карт: сначала из каталога карт комнаты,
+    а недостающие карты - одним запросом на каждый тип карт
+    """
+    if catalog is None:
+        catalog = {}
+
+    missing: Dict[str, Set[int]] = {}
+    for cards in card_lists:
+        for card in cards:
+            if card['type'] not in CARD_MODELS:
+                raise NotImplementedError()
+            if (card['type'], card['id']) not in catalog:
+                missing.setdefault(card['type'], set()).add(card['id'])
+
+    loaded: Dict[CardKey, Card] = {}
+    for card_type, ids in missing.items():
+        for card in CARD_MODELS[card_type].objects.filter(id__in=ids):
+            loaded[(card_type, card.id)] = card
+
+    def _get_card(card: Dict) -> Optional[Card]:
+        key: CardKey = (card['type'], card['id'])
+        return catalog[key] if key in catalog else loaded.get(key, None)
+
+    return [[_get_card(card) for card in cards] for cards in card_lists]
+
+def json_to_cards(cards: List, catalog: Optional[Dict[CardKey, Card]] = None) -> List[Union[CluedoPerson, CluedoPlace, CluedoWeapon]]:
+    return json_lists_to_cards([cards], catalog)[0]
 
 def cards_to_info(cards: List[Union[CluedoPerson, CluedoPlace, CluedoWeapon]]) -> Dict:
     r = []
@@ -0,0 +1,36 @@
+import asyncio
+import contextlib
+from typing import AsyncIterator, Dict, Hashable, Optional, Tuple
+
+
+class KeyedLock(object):
+    """
+    набор asyncio.Lock по ключам (чат, комната).
+    Ожидающие получают блокировку в порядке поступления,
+    блокировка удаляется, когда ее больше никто не держит и не ждет
+    """
+    def __init__(self):
+        self._locks: Dict[Hashable, Tuple[asyncio.Lock, int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+    def is_locked(self, key: Hashable) -> bool:
+        entry: Optional[Tuple[asyncio.Lock, int]] = self._locks.get(key, None)
+        return entry is not None and entry[0].locked()
+
+    @contextlib.asynccontextmanager
+    async def hold(self, key: Hashable) -> AsyncIterator[None]:
+        lock, count = self._locks.get(key, (None, 0))
+        if lock is None:
+            lock = asyncio.Lock()
+        self._locks[key] = (lock, count + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, count = self._locks[key]
+            if count > 1:
+                self._locks[key] = (lock, count - 1)
+            else:
+                del self._locks[key]
@@ -0,0 +1,106 @@
+import threading
+from typing import Callable, Dict, List, Tuple
+
+from .singleton import SingletonMeta
+
+# границы корзин гистограммы времени выполнения, в секундах
+TIMING_BUCKETS: Tuple[float, ...] = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+MetricKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _key(name: str, labels: Dict) -> MetricKey:
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in labels) + '}'
+
+
+class Timing:
+    def __init__(self, bounds: Tuple[float, ...] = TIMING_BUCKETS):
+        self.bounds: Tuple[float, ...] = bounds
+        self.count: int = 0
+        self.total: float = 0.0
+        self.max: float = 0.0
+        self.buckets = [0] * len(bounds)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+        for idx, bound in enumerate(self.bounds):
+            if value <= bound:
+                self.buckets[idx] += 1
+
+
+class Metrics(metaclass=SingletonMeta):
+    """
+    счетчики, текущие значения и времена выполнения операций бота.
+    Обновляются из event loop и из потоков executor'а
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[MetricKey, float] = {}
+        self.gauges: Dict[MetricKey, float] = {}
+        self.timings: Dict[MetricKey, Timing] = {}
+        # функции, которые обновляют текущие значения (размеры кэшей, число игр) перед выдачей метрик
+        self.collectors: List[Callable[['Metrics'], None]] = []
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key: MetricKey = _key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self.gauges[_key(name, labels)] = value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key: MetricKey = _key(name, labels)
+        with self._lock:
+            timing: Timing = self.timings.get(key, None)
+            if timing is None:
+                timing = Timing()
+                self.timings[key] = timing
+            timing.observe(value)
+
+    def get_counter(self, name: str, **labels) -> float:
+        return self.counters.get(_key(name, labels), 0)
+
+    def add_collector(self, collector: Callable[['Metrics'], None]) -> None:
+        with self._lock:
+            self.collectors.append(collector)
+
+    def render(self) -> str:
+        """
+        все метрики в текстовом формате Prometheus (text/plain; version=0.0.4)
+        """
+        for collector in list(self.collectors):
+            collector(self)
+
+        lines: List[str] = []
+        with self._lock:
+            for kind, values in (('counter', self.counters), ('gauge', self.gauges)):
+                for name in sorted({key[0] for key in values}):
+                    lines.append(f'# TYPE {name} {kind}')
+                    for key in sorted(key for key in values if key[0] == name):
+                        lines.append(f'{name}{_format_labels(key[1])} {float(values[key])!r}')
+
+            for name in sorted({key[0] for key in self.timings}):
+                lines.append(f'# TYPE {name} histogram')
+                for key in sorted(key for key in self.timings if key[0] == name):
+                    timing: Timing = self.timings[key]
+                    # корзины Timing уже накопительные: значение попадает во все корзины с большей границей
+                    for bound, count in zip(timing.bounds, timing.buckets):
+                        lines.append(f'{name}_bucket{_format_labels(key[1] + (("le", repr(bound)),))} {count}')
+                    lines.append(f'{name}_bucket{_format_labels(key[1] + (("le", "+Inf"),))} {timing.count}')
+                    lines.append(f'{name}_sum{_format_labels(key[1])} {timing.total!r}')
+                    lines.append(f'{name}_count{_format_labels(key[1])} {timing.count}')
+        return '\n'.join(lines) + '\n'
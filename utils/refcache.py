@@ -0,0 +1,78 @@
+import time
+import functools
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, List, Optional, Tuple
+
+import settings
+from .metrics import Metrics
+
+_ALL = object()
+
+
+class RefCache(object):
+    """
+    кэш справочных данных (комнаты, карты, сообщения): не более maxsize записей (LRU),
+    запись живет ttl секунд (ttl = None - пока ее не сбросят через invalidate).
+    Хранит готовые неизменяемые значения, а не ленивые querysets
+    """
+    def __init__(self, name: str, maxsize: int, ttl: Optional[float]):
+        self.name: str = name
+        self.maxsize: int = maxsize
+        self.ttl: Optional[float] = ttl
+        self.hits: int = 0
+        self.misses: int = 0
+        self._lock = threading.Lock()
+        self._entries: 'OrderedDict[Hashable, Tuple[Any, Optional[float]]]' = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        now: float = time.monotonic()
+        with self._lock:
+            entry: Optional[Tuple[Any, Optional[float]]] = self._entries.get(key, None)
+            if entry is not None and (entry[1] is None or entry[1] > now):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                Metrics().inc('refcache_hits_total', cache=self.name)
+                return entry[0]
+            self.misses += 1
+            Metrics().inc('refcache_misses_total', cache=self.name)
+
+        value: Any = loader()
+        with self._lock:
+            self._entries[key] = (value, now + self.ttl if self.ttl else None)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key: Hashable = _ALL) -> None:
+        with self._lock:
+            if key is _ALL:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+ref_caches: List[RefCache] = []
+
+def ref_cached(name: str, maxsize: int = None, ttl: Optional[float] = None) -> Callable:
+    """
+    кэширует результат функции по ее аргументам в RefCache.
+    Кэш доступен как атрибут cache обернутой функции.
+    ttl=0 - записи не устаревают (если аргументы сами меняются вместе с данными)
+    """
+    cache: RefCache = RefCache(name,
+                               maxsize if maxsize is not None else settings.REF_CACHE_SIZE,
+                               ttl if ttl is not None else settings.REF_CACHE_TTL)
+    ref_caches.append(cache)
+
+    def decorator(func: Callable) -> Callable:
+        @functools.wraps(func)
+        def wraps(*args) -> Any:
+            return cache.get(args, lambda: func(*args))
+        wraps.cache = cache
+        return wraps
+    return decorator
@@ -0,0 +1,121 @@
+import time
+import logging
+import threading
+import contextvars
+from typing import Dict, Optional
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from .metrics import Metrics
+
+# логгер сводок по обработке updates
+update_logger: logging.Logger = logging.getLogger('updates')
+
+
+class UpdateTrace(object):
+    """
+    все, что сделано при обработке одного update: запросы к БД, переходы в пул потоков БД
+    и вызовы Bot API. Запросы выполняются в потоках пула, поэтому счетчики под блокировкой.
+    Рассылка сообщений другим игрокам идет в фоне (Sender.post) и в сводку не входит
+    """
+    def __init__(self, update_id: int, kind: str, chat_id: Optional[int]):
+        self.update_id: int = update_id
+        self.kind: str = kind
+        self.chat_id: Optional[int] = chat_id
+        self.state: Optional[str] = None
+        self.new_state: Optional[str] = None
+        self.started: float = time.monotonic()
+        self.queries: int = 0
+        self.db_time: float = 0.0
+        self.db_hops: int = 0
+        self.db_wait_time: float = 0.0
+        self.api_calls: int = 0
+        self.api_time: float = 0.0
+        # число выполнений каждого текста запроса: повторяющиеся запросы - признак N+1
+        self.statements: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add_query(self, sql: str, duration: float) -> None:
+        with self._lock:
+            self.queries += 1
+            self.db_time += duration
+            self.statements[sql] = self.statements.get(sql, 0) + 1
+
+    def add_db_hop(self, wait: float) -> None:
+        with self._lock:
+            self.db_hops += 1
+            self.db_wait_time += wait
+
+    def add_api_call(self, duration: float) -> None:
+        with self._lock:
+            self.api_calls += 1
+            self.api_time += duration
+
+    def get_repeated(self, min_count: int = 2) -> Dict[str, int]:
+        with self._lock:
+            return {sql: count for sql, count in self.statements.items() if count >= min_count}
+
+    def summary(self, total: float) -> Dict:
+        return {
+            'update_id': self.update_id,
+            'kind': self.kind,
+            'chat_id': self.chat_id,
+            'state': self.state,
+            'new_state': self.new_state,
+            'queries': self.queries,
+            'db_ms': round(self.db_time * 1000, 1),
+            'db_hops': self.db_hops,
+            'db_wait_ms': round(self.db_wait_time * 1000, 1),
+            'api_calls': self.api_calls,
+            'api_ms': round(self.api_time * 1000, 1),
+            'total_ms': round(total * 1000, 1),
+        }
+
+
+current_trace: contextvars.ContextVar = contextvars.ContextVar('current_trace', default=None)
+
+
+def get_trace() -> Optional[UpdateTrace]:
+    return current_trace.get()
+
+
+def tag(**values) -> None:
+    """
+    дополняет сводку текущего update (state, new_state)
+    """
+    trace: Optional[UpdateTrace] = current_trace.get()
+    if trace is not None:
+        for name, value in values.items():
+            setattr(trace, name, value)
+
+
+def query_wrapper(execute, sql, params, many, context):
+    """
+    execute_wrapper соединений с БД: относит запрос к update, при обработке которого он выполнен
+    """
+    started: float = time.monotonic()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration: float = time.monotonic() - started
+        trace: Optional[UpdateTrace] = current_trace.get()
+        if trace is not None:
+            trace.add_query(sql, duration)
+        Metrics().inc('db_queries_total')
+        Metrics().observe('db_query_seconds', duration)
+
+
+def _install_query_wrapper(sender, connection, **kwargs) -> None:
+    if query_wrapper not in connection.execute_wrappers:
+        connection.execute_wrappers.append(query_wrapper)
+
+
+def install_query_wrapper() -> None:
+    """
+    подключает query_wrapper ко всем соединениям, в т.ч. к тем, что откроют потоки пула БД
+    """
+    connection_created.connect(_install_query_wrapper, weak=False)
+    for connection in connections.all():
+        if connection.connection is not None:
+            _install_query_wrapper(None, connection)